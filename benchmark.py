@@ -0,0 +1,461 @@
+#######################################
+# Benchmarks for plaid2qfx.py
+#
+# Nothing here talks to Plaid. Each benchmark sets up a scratch directory with its own config file and runs
+# the script (or pieces of it) there, so your real plaid2qfx.conf and plaid2qfx.db are never touched.
+#
+#   py benchmark.py startup                 How long `plaid2qfx.py --help` and `plaid2qfx.py -s` take to start
+#   py benchmark.py startup --compare HEAD~1   ...and the same for an older version, for comparison
+#   py benchmark.py pipeline                How the download, conversion and export steps scale with the number
+#                                           of transactions, using made-up but Plaid-shaped data
+#   py benchmark.py ofxwriter               Checks that --fastofx writes exactly what ofxtools would, then times both
+#
+# Add --json FILE to any benchmark to also save the results in a machine-readable form. The pipeline
+# benchmark can also take --baseline FILE, an earlier --json result, to show how each step changed.
+
+#### Imports ####
+import sys
+import os.path
+import argparse
+import contextlib
+import datetime
+import decimal
+import json
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import warnings
+from configparser import ConfigParser
+
+here = os.path.dirname(os.path.abspath(__file__))
+script = os.path.join(here, 'plaid2qfx.py')
+
+
+##########################
+#### Shared Utilities ####
+##########################
+def make_workdir(parent, name):
+    # A scratch directory with a config file holding one (fake) linked account, like a typical setup
+    workdir = os.path.join(parent, name)
+    outdir = os.path.join(workdir, 'out')
+    os.makedirs(outdir)
+    with open(os.path.join(workdir, 'plaid2qfx.conf'), 'w') as file_handle:
+        file_handle.write("[PLAID]\n"
+                          "client_id = benchmark\n"
+                          "client_user_id = benchmark\n"
+                          "ofxloc = " + outdir + "\n"
+                          "firstlink = BENCH\n"
+                          "\n"
+                          "[BENCH]\n"
+                          "access_token = access-benchmark-0\n"
+                          "item_id = item-benchmark-0\n"
+                          "ins_id = ins_0\n"
+                          "routing_number = 000000000\n"
+                          "bid = 00000\n")
+    return(workdir)
+
+def git_revision():
+    result = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=here, capture_output=True, text=True)
+    return(result.stdout.strip() or None)
+
+def write_results(results, path):
+    with open(path, 'w') as file_handle:
+        json.dump(results, file_handle, indent=2)
+    print("Results saved to: " + path)
+
+
+#################
+#### Startup ####
+#################
+def bench_startup(opts):
+    results = {'benchmark': 'startup', 'python': sys.version.split()[0], 'runs': opts.runs, 'results': []}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Which versions of the script are we timing?
+        versions = [('working tree', script)]
+        for rev in opts.compare or []:
+            path = os.path.join(tmp, 'plaid2qfx_' + str(len(versions)) + '.py')
+            with open(path, 'w') as file_handle:
+                file_handle.write(subprocess.run(['git', 'show', rev + ':plaid2qfx.py'], cwd=here, check=True, capture_output=True, text=True).stdout)
+            versions.append((rev, path))
+
+        for (label, path) in versions:
+            workdir = make_workdir(tmp, 'work_' + str(len(results['results'])))
+            for command in (['--help'], ['-s']):
+                # Once untimed, so one-time work (like moving linked accounts into plaid2qfx.db) isn't counted
+                subprocess.run([sys.executable, path] + command, cwd=workdir, check=True, capture_output=True)
+                times = []
+                for i in range(opts.runs):
+                    start = time.perf_counter()
+                    subprocess.run([sys.executable, path] + command, cwd=workdir, check=True, capture_output=True)
+                    times.append(time.perf_counter() - start)
+                results['results'].append({'version': label,
+                                           'command': ' '.join(command),
+                                           'min_s': min(times),
+                                           'median_s': statistics.median(times)})
+
+    print("Version".ljust(20) + "Command".ljust(12) + "Min (ms)".rjust(10) + "Median (ms)".rjust(13))
+    for result in results['results']:
+        print(result['version'][:19].ljust(20) + result['command'].ljust(12) + f"{result['min_s']*1000:10.1f}" + f"{result['median_s']*1000:13.1f}")
+    return(results)
+
+
+######################################
+#### Synthetic Plaid Transactions ####
+######################################
+# Made-up accounts and transactions with the same shape (and Python types) as what the Plaid client hands back:
+# a mix of checking, savings and credit card accounts, a USD and a CAD account, check numbers now and then,
+# the usual spread of Plaid categories, and dates that are sometimes just a date and sometimes a datetime.
+SYNTHETIC_ACCOUNTS = [
+    # (account type, subtype, currency)
+    ('depository', 'checking', 'USD'),
+    ('depository', 'savings', 'USD'),
+    ('credit', 'credit card', 'USD'),
+    ('depository', 'checking', 'CAD'),
+]
+SYNTHETIC_CATEGORIES = [
+    (["Food and Drink", "Restaurants"], "FOOD_AND_DRINK", "FOOD_AND_DRINK_RESTAURANT"),
+    (["Shops", "Supermarkets and Groceries"], "FOOD_AND_DRINK", "FOOD_AND_DRINK_GROCERIES"),
+    (["Travel", "Gas Stations"], "TRANSPORTATION", "TRANSPORTATION_GAS"),
+    (["Service", "Utilities", "Electric"], "RENT_AND_UTILITIES", "RENT_AND_UTILITIES_GAS_AND_ELECTRICITY"),
+    (["Payment", "Credit Card"], "LOAN_PAYMENTS", "LOAN_PAYMENTS_CREDIT_CARD_PAYMENT"),
+    (["Transfer", "Deposit"], "INCOME", "INCOME_WAGES"),
+    (["Transfer", "Debit"], "TRANSFER_OUT", "TRANSFER_OUT_ACCOUNT_TRANSFER"),
+    (["Transfer", "Withdrawal", "ATM"], "TRANSFER_OUT", "TRANSFER_OUT_WITHDRAWAL"),
+    (["Transfer", "Check"], "TRANSFER_OUT", "TRANSFER_OUT_OTHER_TRANSFER_OUT"),
+    (["Bank Fees", "Overdraft"], "BANK_FEES", "BANK_FEES_OVERDRAFT_FEES"),
+    (["Interest", "Interest Earned"], "INCOME", "INCOME_INTEREST_EARNED"),
+    (["Tax", "Refund"], "INCOME", "INCOME_TAX_REFUND"),
+    (["Cash Advance"], "TRANSFER_IN", "TRANSFER_IN_CASH_ADVANCES_AND_LOANS"),
+]
+SYNTHETIC_MERCHANTS = ["Corner Cafe", "Big Box Store", "Gas & Go", "City Utilities", None, "Book Nook", "Grocery Mart", None]
+SYNTHETIC_LOCATION_KEYS = ['address', 'city', 'region', 'postal_code', 'country', 'lat', 'lon', 'store_number']
+SYNTHETIC_PAYMENT_META_KEYS = ['reference_number', 'ppd_id', 'payee', 'by_order_of', 'payer', 'payment_method', 'payment_processor', 'reason']
+
+def synthetic_accounts(seed):
+    return([{'account_id': 'bench' + str(seed) + 'acct' + str(i) + 'x' * 24,
+             'balances': {'available': 1234.56 if typ == 'depository' else None,
+                          'current': 2345.67,
+                          'iso_currency_code': currency,
+                          'limit': 5000.0 if typ == 'credit' else None,
+                          'unofficial_currency_code': None},
+             'mask': str(1000 + i),
+             'name': subtype.title() + " " + str(i),
+             'official_name': None,
+             'type': typ,
+             'subtype': subtype}
+            for (i, (typ, subtype, currency)) in enumerate(SYNTHETIC_ACCOUNTS)])
+
+def synthetic_transactions(count, accounts, seed):
+    rnd = random.Random(seed)
+    start = datetime.date(2022, 1, 1)
+    transactions = []
+    for n in range(count):
+        (account, (typ, subtype, currency)) = rnd.choice(list(zip(accounts, SYNTHETIC_ACCOUNTS)))
+        (category, primary, detailed) = rnd.choice(SYNTHETIC_CATEGORIES)
+        date = start + datetime.timedelta(days=rnd.randrange(730))
+        when = datetime.datetime.combine(date, datetime.time(rnd.randrange(24), rnd.randrange(60)), tzinfo=datetime.timezone.utc)
+        dates = rnd.randrange(3) # 0: date only, 1: datetime only, 2: both authorized and posted datetimes
+        transactions.append({
+            'account_id': account['account_id'],
+            'amount': round(rnd.uniform(-2500, 2500), 2),
+            'iso_currency_code': currency if rnd.random() > 0.01 else None,
+            'unofficial_currency_code': None,
+            'date': date,
+            'authorized_date': date if dates == 2 else None,
+            'authorized_datetime': when if dates == 2 else None,
+            'datetime': when if dates >= 1 else None,
+            'location': dict.fromkeys(SYNTHETIC_LOCATION_KEYS),
+            'name': "POS PURCHASE " + str(rnd.randrange(100000)) + " " + (rnd.choice(SYNTHETIC_MERCHANTS) or "MISC"),
+            'merchant_name': rnd.choice(SYNTHETIC_MERCHANTS),
+            'payment_meta': dict.fromkeys(SYNTHETIC_PAYMENT_META_KEYS),
+            'pending': False,
+            'pending_transaction_id': None,
+            'account_owner': None,
+            'transaction_id': 'bench' + str(seed) + 'txn' + str(n).zfill(10) + 'y' * 20,
+            'payment_channel': rnd.choice(['online', 'in store', 'other']),
+            'transaction_code': None,
+            'category': category,
+            'category_id': None,
+            'check_number': str(rnd.randrange(1000, 9999)) if category == ["Transfer", "Check"] or rnd.random() < 0.02 else None,
+            'personal_finance_category': {'primary': primary, 'detailed': detailed, 'confidence_level': 'HIGH'},
+            'counterparties': [],
+            'merchant_entity_id': None,
+        })
+    return(transactions)
+
+class SyntheticPlaid:
+    # Stands in for the Plaid client, serving synthetic transactions a page at a time (the cursor is just an offset)
+    def __init__(self, transactions, accounts, ins_id):
+        import plaid2qfx
+        from plaid.model.accounts_get_response import AccountsGetResponse
+        from plaid.model.item_get_response import ItemGetResponse
+
+        self.transactions = transactions
+        item = {'item_id': 'item-benchmark-0', 'institution_id': ins_id, 'webhook': None, 'error': None,
+                'available_products': [], 'billed_products': ['transactions'], 'consent_expiration_time': None,
+                'update_type': 'background'}
+        self.accounts_response = plaid2qfx.from_json(json.dumps({'accounts': accounts, 'item': item, 'request_id': 'benchmark'}), AccountsGetResponse)
+        self.item_response = plaid2qfx.from_json(json.dumps({'item': item, 'request_id': 'benchmark',
+                                                             'status': {'transactions': {'last_successful_update': '2024-01-01T12:00:00Z', 'last_failed_update': None}}}), ItemGetResponse)
+
+    def accounts_get(self, request):
+        return(self.accounts_response)
+
+    def item_get(self, request):
+        return(self.item_response)
+
+    def transactions_sync(self, request):
+        start = int(request['cursor'] or 0)
+        end = min(start + request['count'], len(self.transactions))
+        return({'added': self.transactions[start:end], 'modified': [], 'removed': [],
+                'next_cursor': str(end), 'has_more': end < len(self.transactions)})
+
+
+##################
+#### Pipeline ####
+##################
+PIPELINE_STAGES = ['generate', 'get_transactions', 'parse_accttype', 'parse_transcat', 'process_item', 'export_qfx']
+
+def run_pipeline(size, tmp, trace, options=[]):
+    # One pass through every stage for `size` transactions. Returns {stage: {'seconds': ..., 'peak_bytes': ...}}.
+    # With trace, peak memory is measured with tracemalloc (which slows things down, so times from that pass are thrown away).
+    # options are any more plaid2qfx.py arguments to run with.
+    import plaid2qfx
+
+    workdir = make_workdir(tmp, 'pipeline_' + str(size) + ('_traced' if trace else ''))
+    os.chdir(workdir)
+    plaid2qfx.args = plaid2qfx.parse_args(['-o', 'each', '-p', '500'] + options)
+    plaid2qfx.conf = ConfigParser()
+    plaid2qfx.load_conf()
+    plaid2qfx.GLOBAL_DB = None
+    plaid2qfx.import_conf_links()
+    link = plaid2qfx.get_link('BENCH')
+
+    stages = {}
+    def stage(name, function, *params):
+        if trace:
+            tracemalloc.start()
+        start = time.perf_counter()
+        result = function(*params)
+        seconds = time.perf_counter() - start
+        peak = None
+        if trace:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        stages[name] = {'seconds': seconds, 'peak_bytes': peak}
+        return(result)
+
+    accounts = synthetic_accounts(0)
+    transactions = stage('generate', synthetic_transactions, size, accounts, 0)
+    plaid2qfx.GLOBAL_CLIENT = SyntheticPlaid(transactions, accounts, link['ins_id'])
+
+    # Download on its own...
+    added = stage('get_transactions', plaid2qfx.get_transactions, 'BENCH')[0]
+    # process_item() only classifies each account once, but time it per transaction so it lines up with the rest
+    types = {account['account_id']: (account['type'], account['subtype']) for account in accounts}
+    stage('parse_accttype', lambda: [plaid2qfx.parse_accttype(*types[trans.account_id]) for trans in added])
+    # (get_transactions already classified them on the way in, this is the same work again from Plaid's fields)
+    stage('parse_transcat', lambda: [plaid2qfx.parse_transcat(trans['category'], trans['personal_finance_category']) for trans in transactions])
+    added = None # let go of them before the next stage
+
+    # ...then the whole conversion again from the top (which downloads again, so compare it with get_transactions)
+    plaid2qfx.update_link('BENCH', cursor='')
+    partitions = []
+    stage('process_item', plaid2qfx.process_item, 'BENCH', partitions)
+    stage('export_qfx', plaid2qfx.export_qfx, 'BENCH', partitions, False)
+
+    plaid2qfx.GLOBAL_DB.close()
+    os.chdir(here)
+    return(stages)
+
+def bench_pipeline(opts):
+    results = {'benchmark': 'pipeline', 'revision': git_revision(), 'python': sys.version.split()[0], 'results': []}
+    options = (['--fastofx'] if opts.fastofx else []) + ['--convertjobs', str(opts.convertjobs)]
+    results['options'] = options
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # A small untimed pass first, so one-time costs like importing plaid and ofxtools don't land on the first size
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            run_pipeline(10, tmp, False, options)
+
+        for size in opts.sizes:
+            print("Running the pipeline with " + str(size) + " transactions...", file=sys.stderr)
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull): # plaid2qfx is chatty
+                stages = run_pipeline(size, tmp, False, options)
+                if opts.memory:
+                    traced = run_pipeline(size, tmp, True, options)
+                    for name in stages:
+                        stages[name]['peak_bytes'] = traced[name]['peak_bytes']
+            for name in PIPELINE_STAGES:
+                results['results'].append({'transactions': size, 'stage': name, **stages[name]})
+
+    baseline = {}
+    if opts.baseline:
+        with open(opts.baseline) as file_handle:
+            baseline = {(result['transactions'], result['stage']): result for result in json.load(file_handle)['results']}
+
+    print("Transactions".rjust(12) + "  " + "Stage".ljust(18) + "Seconds".rjust(10) + "Per txn (us)".rjust(14) + "Peak (MB)".rjust(11) + ("vs baseline".rjust(13) if baseline else ""))
+    for result in results['results']:
+        line = str(result['transactions']).rjust(12) + "  " + result['stage'].ljust(18) + f"{result['seconds']:10.3f}" + f"{result['seconds'] / result['transactions'] * 1e6:14.1f}"
+        line += f"{result['peak_bytes'] / 1e6:11.1f}" if result['peak_bytes'] is not None else "-".rjust(11)
+        before = baseline.get((result['transactions'], result['stage']))
+        if before and before['seconds'] > 0:
+            line += f"{result['seconds'] / before['seconds']:12.2f}x"
+        print(line)
+    return(results)
+
+
+####################
+#### OFX Writer ####
+####################
+# --fastofx writes transactions straight to text instead of through ofxtools. This checks, statement by statement,
+# that it writes exactly what ofxtools does (or fails or warns exactly as ofxtools does) for made-up transactions
+# full of awkward cases, then times the two on plainer ones.
+AWKWARD_STRINGS = [None, "", " ", "Corner Cafe", "Gas & Go", "AT&amp;T", "<b>bold</b>", "Tom's \"Diner\"", "&quot;&apos;&nbsp;&lt;",
+                   "Caf\u00e9 \u00fcber \u2603", "tab\there", "a & b > c < d", "&&&&", "&bogus;"]
+AWKWARD_AMOUNTS = ["0", "-0.01", "12.5", "-1234567.89", "1E+2", "0.000", "-3.14159", "100"]
+
+def awkward_zones():
+    zones = [datetime.timezone.utc, datetime.timezone(datetime.timedelta(hours=-5)),
+             datetime.timezone(datetime.timedelta(hours=5, minutes=30), "IST"), datetime.timezone(datetime.timedelta(hours=-3, minutes=-30))]
+    try:
+        from zoneinfo import ZoneInfo
+        zones.append(ZoneInfo("America/New_York"))
+    except Exception:
+        pass # no time zone database here, the fixed offsets will have to do
+    from ofxtools.utils import UTC
+    zones.append(UTC)
+    return(zones)
+
+def awkward_transaction(rnd, zones, trntypes):
+    # Mostly fine, but now and then too long (which ofxtools either rejects or warns about) or not a valid type
+    def string(length):
+        if rnd.random() < 0.003:
+            return("x" * (length + rnd.randrange(1, 5)))
+        if rnd.random() < 0.05:
+            return("y" * length)
+        return(rnd.choice([text for text in AWKWARD_STRINGS if text is None or len(text) <= length]))
+    when = datetime.datetime(2000 + rnd.randrange(40), rnd.randrange(1, 13), rnd.randrange(1, 29), rnd.randrange(24), rnd.randrange(60), rnd.randrange(60),
+                             rnd.choice([0, 0, 499, 500, 999499, 999500, 999999, rnd.randrange(1000000)]), tzinfo=rnd.choice(zones))
+    return({'trntype': rnd.choice(trntypes) if rnd.random() > 0.002 else "BOGUS",
+            'dtposted': when,
+            'trnamt': decimal.Decimal(rnd.choice(AWKWARD_AMOUNTS)),
+            'fitid': string(255) or "fitid" + str(rnd.randrange(10**9)),
+            'checknum': string(12) if rnd.random() < 0.3 else None,
+            'name': string(32),
+            'memo': string(255)})
+
+def write_statement(plaid2qfx, transactions, creditcard):
+    # The same statement process_item() would put together, as text. Returns (text or the error, warnings).
+    from ofxtools.models import STMTTRN, BANKTRANLIST, STMTRS, STMTTRNRS, CCSTMTRS, CCSTMTTRNRS, BANKACCTFROM, CCACCTFROM, LEDGERBAL, STATUS
+
+    fast = plaid2qfx.args.fastofx
+    when = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        try:
+            stmttrns = [(plaid2qfx.fast_stmttrn if fast else STMTTRN)(**transaction) for transaction in transactions]
+            banktranlist = BANKTRANLIST(*([] if fast else stmttrns), dtstart=when, dtend=when)
+            ledgerbal = LEDGERBAL(balamt=decimal.Decimal("12.34"), dtasof=when)
+            if creditcard:
+                trnrs = CCSTMTTRNRS(trnuid='0', status=STATUS(code=0, severity='INFO'),
+                                    ccstmtrs=CCSTMTRS(curdef='USD', ccacctfrom=CCACCTFROM(acctid='1234'), banktranlist=banktranlist, ledgerbal=ledgerbal))
+            else:
+                trnrs = STMTTRNRS(trnuid='0', status=STATUS(code=0, severity='INFO'),
+                                  stmtrs=STMTRS(curdef='USD', bankacctfrom=BANKACCTFROM(bankid='123456789', acctid='1234', accttype='CHECKING'), banktranlist=banktranlist, ledgerbal=ledgerbal))
+            result = plaid2qfx.serialize_statement(trnrs, plaid2qfx.stmttrn_text(stmttrns, 5) if fast else None)
+        except Exception as exc:
+            result = type(exc).__name__ + ": " + str(exc)
+    return(result, [str(warning.message) for warning in caught])
+
+def bench_ofxwriter(opts):
+    import plaid2qfx
+    from ofxtools.models.bank.stmt import TRNTYPES
+
+    plaid2qfx.args = plaid2qfx.parse_args([])
+    results = {'benchmark': 'ofxwriter', 'revision': git_revision(), 'python': sys.version.split()[0], 'statements': opts.statements, 'mismatches': 0, 'results': []}
+
+    # Same output?
+    rnd = random.Random(opts.seed)
+    zones = awkward_zones()
+    failures = 0
+    for n in range(opts.statements):
+        transactions = [awkward_transaction(rnd, zones, TRNTYPES) for i in range(rnd.randrange(0, 25))]
+        creditcard = rnd.random() < 0.3
+        plaid2qfx.args.fastofx = False
+        expected = write_statement(plaid2qfx, transactions, creditcard)
+        plaid2qfx.args.fastofx = True
+        got = write_statement(plaid2qfx, transactions, creditcard)
+        if not expected[0].startswith("<"):
+            failures += 1
+        if got != expected:
+            results['mismatches'] += 1
+            if results['mismatches'] <= 3:
+                print("MISMATCH in statement " + str(n) + ":\n  ofxtools:  " + repr(expected)[:2000] + "\n  --fastofx: " + repr(got)[:2000])
+    print("Compared " + str(opts.statements) + " statements (" + str(failures) + " of them ones ofxtools rejects): " +
+          (str(results['mismatches']) + " MISMATCHED" if results['mismatches'] else "all the same"))
+
+    # How much quicker? Plain transactions like Plaid's this time, all in one statement.
+    accounts = synthetic_accounts(0)
+    for size in opts.sizes:
+        transactions = [{'trntype': trans.trntype, 'dtposted': trans.dtposted, 'trnamt': trans.trnamt(), 'fitid': trans.transaction_id,
+                         'checknum': trans.check_number, 'name': trans.merchant_name, 'memo': None if trans.check_number else trans.name}
+                        for trans in map(plaid2qfx.TransactionRecord.from_plaid, synthetic_transactions(size, accounts, 0))]
+        seconds = {}
+        for fast in (False, True):
+            plaid2qfx.args.fastofx = fast
+            times = []
+            for i in range(opts.runs):
+                start = time.perf_counter()
+                write_statement(plaid2qfx, transactions, False)
+                times.append(time.perf_counter() - start)
+            seconds[fast] = min(times)
+        results['results'].append({'transactions': size, 'ofxtools_s': seconds[False], 'fastofx_s': seconds[True], 'speedup': seconds[False] / seconds[True]})
+
+    print("Transactions".rjust(12) + "ofxtools (s)".rjust(14) + "--fastofx (s)".rjust(15) + "Speedup".rjust(10))
+    for result in results['results']:
+        print(str(result['transactions']).rjust(12) + f"{result['ofxtools_s']:14.3f}" + f"{result['fastofx_s']:15.3f}" + f"{result['speedup']:9.1f}x")
+    if results['mismatches']:
+        sys.exit(1)
+    return(results)
+
+
+##############
+#### MAIN ####
+##############
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for plaid2qfx.py. Nothing here talks to Plaid.")
+    parser.add_argument("--json", help="Also save the results as JSON to this file.")
+    benchmarks = parser.add_subparsers(dest='benchmark', required=True)
+
+    startup = benchmarks.add_parser('startup', help="Time how long the script takes to start for --help and --showaccounts.")
+    startup.add_argument("--runs", type=int, default=10, help="How many times to run each command. Defaults to 10.")
+    startup.add_argument("--compare", action='append', metavar='REV', help="Also time the plaid2qfx.py from this git revision. Can be given more than once.")
+    startup.set_defaults(func=bench_startup)
+
+    pipeline = benchmarks.add_parser('pipeline', help="Time each step from download to QFX export on synthetic transactions.")
+    pipeline.add_argument("--sizes", type=lambda text: [int(size) for size in text.split(',')], default=[1000, 100000, 1000000], help="Comma-separated numbers of transactions to try. Defaults to 1000,100000,1000000.")
+    pipeline.add_argument("--no-memory", dest='memory', action='store_false', help="Skip measuring peak memory, which needs a second, slower pass at each size.")
+    pipeline.add_argument("--baseline", metavar='FILE', help="An earlier --json result to compare times against.")
+    pipeline.add_argument("--fastofx", action='store_true', help="Run the pipeline with plaid2qfx.py's --fastofx.")
+    pipeline.add_argument("--convertjobs", type=int, default=1, metavar='N', help="Run the pipeline with plaid2qfx.py's --convertjobs N.")
+    pipeline.set_defaults(func=bench_pipeline)
+
+    ofxwriter = benchmarks.add_parser('ofxwriter', help="Check that --fastofx writes exactly what ofxtools does, and time the two.")
+    ofxwriter.add_argument("--statements", type=int, default=2000, help="How many made-up statements to compare. Defaults to 2000.")
+    ofxwriter.add_argument("--seed", type=int, default=0, help="For making up different statements. Defaults to 0.")
+    ofxwriter.add_argument("--sizes", type=lambda text: [int(size) for size in text.split(',')], default=[1000, 100000], help="Comma-separated numbers of transactions to time. Defaults to 1000,100000.")
+    ofxwriter.add_argument("--runs", type=int, default=3, help="How many times to time each. Defaults to 3.")
+    ofxwriter.set_defaults(func=bench_ofxwriter)
+
+    opts = parser.parse_args()
+    results = opts.func(opts)
+    if opts.json:
+        write_results(results, opts.json)
+
+if __name__ == "__main__":
+    main()
@@ -2,86 +2,203 @@
 import sys
 import os.path
 import argparse
+import asyncio
 import datetime
 import json
+import csv
+import io
 import xml.etree.ElementTree as ET
+import xml.sax.saxutils as saxutils
 import secrets
+import hashlib
+import random
+import shutil
+import time
 import getpass
+import subprocess
+import sqlite3
+import threading
+import functools
+import atexit
+import tracemalloc
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from decimal import Decimal
 from configparser import ConfigParser
 
 # Non-standard Dependencies
-import plaid # Lots of these because of the way the plaid module works... or I just can't figure out how it's intended to work
-from plaid.api import plaid_api
-from plaid.model.link_token_create_request import LinkTokenCreateRequest
-from plaid.model.link_token_create_request_user import LinkTokenCreateRequestUser
-from plaid.model.item_public_token_exchange_request import ItemPublicTokenExchangeRequest
-from plaid.model.accounts_get_request import AccountsGetRequest
-from plaid.model.transactions_sync_request import TransactionsSyncRequest
-from plaid.model.products import Products
-from plaid.model.country_code import CountryCode
-from plaid.model.item_get_request import ItemGetRequest
-from plaid.model.institutions_get_by_id_request import InstitutionsGetByIdRequest
-from ofxtools.models import *
-from ofxtools.header import make_header
-from ofxtools.utils import UTC
+# plaid and ofxtools take a good while to import, so each function imports what it needs from them when it runs.
+# That way things like --help and --showaccounts start quickly, and importing this file doesn't cost anything.
 
 
 #######################
 #### Configuration ####
 #######################
-# Parse arguments
-parser = argparse.ArgumentParser()
-parser.add_argument("-u", "--updateconf", action="store_true", help="Update previously stored API and other configuration items, then exit.")
-parser.add_argument("-l", "--linkaccount", action="store_true", help="Link an additional account. You'll be prompted interactively for the link account name.")
-parser.add_argument("-s", "--showaccounts", action="store_true", help="Just enumerate the linked accounts in config then exit. Access tokens will NOT be displayed.")
-parser.add_argument("-a", "--account", help="Use this if you only want to work with a specific linked account instead of all saved accounts. Use the label you specified for this account when first set up.")
-parser.add_argument("-o", "--outformat", help="Specify how you would like files exported. 'combined' pretends all of your linked banks are one bank and exports only one file. 'each' will export a separate file for each bank (but multiple accounts at the same bank will still be one file). 'both' is the default behavior.")
-args = parser.parse_args()
-
-# Some arg validation and defaults
-if args.outformat:
-    if "comb" in args.outformat.lower():
-        args.outformat = "combined"
-    elif "ea" in args.outformat.lower():
-        args.outformat = "each"
-    elif "both" in args.outformat.lower():
-        args.outformat = "both"
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-u", "--updateconf", action="store_true", help="Update previously stored API and other configuration items, then exit.")
+    parser.add_argument("-l", "--linkaccount", action="store_true", help="Link an additional account. You'll be prompted interactively for the link account name.")
+    parser.add_argument("-s", "--showaccounts", action="store_true", help="Just enumerate the linked accounts in config then exit. Access tokens will NOT be displayed.")
+    parser.add_argument("-a", "--account", help="Use this if you only want to work with a specific linked account instead of all saved accounts. Use the label you specified for this account when first set up.")
+    parser.add_argument("-o", "--outformat", help="Specify how you would like files exported. 'combined' pretends all of your linked banks are one bank and exports only one file. 'each' will export a separate file for each bank (but multiple accounts at the same bank will still be one file). 'both' is the default behavior.")
+    parser.add_argument("-f", "--formats", default="qfx", help="Which kinds of files to export, separated by commas: qfx (for Quicken), ofx, csv and jsonl. The data is only downloaded and converted once however many you ask for. Defaults to qfx.")
+    parser.add_argument("-p", "--pagesize", type=int, default=100, help="How many transactions to ask Plaid for at a time while downloading, up to 500. Bigger pages mean fewer round trips on a large first download. Defaults to 100.")
+    engine = parser.add_mutually_exclusive_group()
+    engine.add_argument("-j", "--jobs", type=int, default=1, help="When processing all linked accounts, how many to download and convert at the same time. Defaults to 1, one after another.")
+    engine.add_argument("--concurrency", type=int, metavar="N", help="When processing all linked accounts, download them all at once with up to N requests to Plaid in flight, converting each as it finishes. Meant for a great many linked accounts.")
+    parser.add_argument("--partition", metavar="month|N", help="Split exports into a file per calendar month ('month'), or into files of at most N transactions. Handy for a first download with years of history.")
+    parser.add_argument("--backfill", action="store_true", help="For a linked account's first download, get its history a month at a time, several months at once, instead of one page after another. Much quicker for busy accounts.")
+    parser.add_argument("--fastofx", action="store_true", help="Write transactions into QFX and OFX files directly instead of through ofxtools. The files come out the same, only quicker, which shows on a big download.")
+    parser.add_argument("--convertjobs", type=int, default=1, metavar="N", help="Convert a big linked account's transactions in N processes at once instead of one. Defaults to 1.")
+    parser.add_argument("--categorymap", metavar="FILE", help="A file of your own Plaid category to OFX transaction type mappings, used ahead of the built-in ones. See the README for the format.")
+    parser.add_argument("--force", action="store_true", help="Download transactions for every linked account, even ones Plaid hasn't updated since they were last exported, or whose bank has been failing lately.")
+    parser.add_argument("--refresh", action="store_true", help="Ask Plaid for institution details again, even if recent ones were saved by an earlier run.")
+    parser.add_argument("--connections", type=int, metavar="N", help="How many connections to Plaid to keep open for reuse. Defaults to enough for --jobs (and --backfill).")
+    parser.add_argument("--retries", type=int, default=5, metavar="N", help="How many times to retry a Plaid request that failed because of a rate limit or a temporary error at Plaid, waiting a little longer each time. Defaults to 5.")
+    parser.add_argument("--timeout", type=float, default=60, metavar="SECONDS", help="How long to wait on any one request to Plaid before giving up on it (and retrying it, like any other failure). Defaults to 60.")
+    parser.add_argument("--itemtimeout", type=float, default=900, metavar="SECONDS", help="How long any one linked account can take before it's left out of this run, so a bank having trouble can't hold up the rest. What it downloaded is kept for next time. Defaults to 900.")
+    parser.add_argument("--apistats", action="store_true", help="Print how many requests were made to each Plaid endpoint, how long they took and how many were retried, before exiting.")
+    parser.add_argument("--profile", action="store_true", help="Print how long each part of the run took, and how much memory it used, for everything and for each linked account, before exiting.")
+    parser.add_argument("--metrics-out", metavar="FILE", help="Save the same numbers as --profile (and --apistats) to this file at the end of the run, as JSON, or for Prometheus if the name ends in .prom.")
+    parser.add_argument("--daemon", action="store_true", help="Keep running, and download and export a linked account whenever Plaid sends a webhook saying it has new transactions. See the README for setting it up.")
+    parser.add_argument("--listen", metavar="[HOST:]PORT", default="127.0.0.1:8765", help="Where --daemon listens for webhooks. Defaults to 127.0.0.1:8765.")
+    parser.add_argument("--sendwebhook", metavar="ACCOUNT", help="Send a running --daemon the webhook Plaid would when this linked account has new transactions, to try it out.")
+    parser.add_argument("--secret", metavar="SOURCE", help="Where to read the client API secret from instead of asking: env:NAME for an environment variable, fd:N for an open file descriptor, or keyring:[SERVICE[:USERNAME]] for your system's keyring. Can also be set as secret_source in the config file.")
+    parser.add_argument("--batch", metavar="FILE", help="Run for every profile directory listed in FILE (one per line, each with its own config), without prompting, and summarize how each one went. The rest of the command line applies to each profile.")
+    parser.add_argument("--batchjobs", type=int, default=4, metavar="N", help="How many --batch profiles to run at the same time. Defaults to 4.")
+    parser.add_argument("--batchtimeout", type=float, default=3600, metavar="SECONDS", help="How long each --batch profile gets before it's stopped and counted as failed. Defaults to 3600 (an hour).")
+    recording = parser.add_mutually_exclusive_group()
+    recording.add_argument("--record", metavar="DIR", help="Save a copy of everything Plaid sends for each linked account into this directory, so the export can be replayed later with --replay.")
+    recording.add_argument("--replay", metavar="DIR", help="Export from responses saved earlier with --record instead of asking Plaid. Nothing is downloaded, and cursors and the ledger of exported transactions are left alone, so you can replay as often as you like (with different --outformat settings, for example).")
+    args = parser.parse_args(argv)
+
+    # Some arg validation and defaults
+    if args.outformat:
+        if "comb" in args.outformat.lower():
+            args.outformat = "combined"
+        elif "ea" in args.outformat.lower():
+            args.outformat = "each"
+        elif "both" in args.outformat.lower():
+            args.outformat = "both"
+        else:
+            print("Invalid outformat argument value provided. Please specify either 'combined', 'each', or 'both' when you try again.")
+            sys.exit()
     else:
-        print("Invalid outformat argument value provided. Please specify either 'combined', 'each', or 'both' when you try again.")
+        # Not specified, so set default to output both formats
+        args.outformat = "both"
+    args.formats = list(dict.fromkeys(output_format.strip().lower() for output_format in args.formats.split(',') if output_format.strip()))
+    if len(args.formats) == 0 or any(not output_format in OUTPUT_FORMATS for output_format in args.formats):
+        print("Invalid formats argument value provided. Please specify one or more of " + ", ".join(OUTPUT_FORMATS) + ", separated by commas, when you try again.")
+        sys.exit()
+    if args.pagesize < 1 or args.pagesize > 500:
+        print("Invalid pagesize argument value provided. Please specify a number from 1 to 500 when you try again.")
+        sys.exit()
+    if args.jobs < 1:
+        print("Invalid jobs argument value provided. Please specify a number of 1 or more when you try again.")
+        sys.exit()
+    if args.partition is not None:
+        if "month" in args.partition.lower():
+            args.partition = "month"
+        elif args.partition.isdigit() and int(args.partition) > 0:
+            args.partition = int(args.partition)
+        else:
+            print("Invalid partition argument value provided. Please specify either 'month' or a number of transactions per file when you try again.")
+            sys.exit()
+    if args.convertjobs < 1:
+        print("Invalid convertjobs argument value provided. Please specify a number of 1 or more when you try again.")
+        sys.exit()
+    if args.concurrency is not None and args.concurrency < 1:
+        print("Invalid concurrency argument value provided. Please specify a number of 1 or more when you try again.")
+        sys.exit()
+    if args.timeout <= 0:
+        print("Invalid timeout argument value provided. Please specify a number of seconds greater than 0 when you try again.")
+        sys.exit()
+    if args.itemtimeout <= 0:
+        print("Invalid itemtimeout argument value provided. Please specify a number of seconds greater than 0 when you try again.")
+        sys.exit()
+    if args.connections is not None and args.connections < 1:
+        print("Invalid connections argument value provided. Please specify a number of 1 or more when you try again.")
+        sys.exit()
+    if args.retries < 0:
+        print("Invalid retries argument value provided. Please specify a number of 0 or more when you try again.")
+        sys.exit()
+    if args.replay and not args.batch and not os.path.isdir(args.replay): # (each batch profile checks its own)
+        print("The replay directory " + args.replay + " doesn't exist. Please record into it with --record first.")
         sys.exit()
-else:
-    # Not specified, so set default to output both formats
-    args.outformat = "both"
+    if args.secret:
+        (kind, colon, name) = args.secret.partition(':')
+        if not (kind == 'env' and name) and not (kind == 'fd' and name.isdigit()) and not kind == 'keyring':
+            print("Invalid secret argument value provided. Please specify env:NAME, fd:N or keyring:[SERVICE[:USERNAME]] when you try again.")
+            sys.exit()
+    if args.batchjobs < 1:
+        print("Invalid batchjobs argument value provided. Please specify a number of 1 or more when you try again.")
+        sys.exit()
+    if args.batchtimeout <= 0:
+        print("Invalid batchtimeout argument value provided. Please specify a number of seconds greater than 0 when you try again.")
+        sys.exit()
+    if args.batch and not os.path.isfile(args.batch):
+        print("The batch file " + args.batch + " doesn't exist. Please list a profile directory on each line of it.")
+        sys.exit()
+    if args.batch and (args.updateconf or args.linkaccount or args.daemon or args.sendwebhook):
+        print("Batch runs can't stop to ask questions, so they only work for exporting transactions.")
+        sys.exit()
+    (host, colon, port) = args.listen.rpartition(':')
+    if not port.isdigit() or int(port) > 65535:
+        print("Invalid listen argument value provided. Please specify a port, or a host and port like 127.0.0.1:8765, when you try again.")
+        sys.exit()
+    args.listen = (host or "127.0.0.1", int(port))
+    if args.replay and (args.updateconf or args.linkaccount):
+        print("Replaying only works for exporting transactions from accounts you've already linked.")
+        sys.exit()
+    if args.replay and args.daemon:
+        print("Replaying is already over and done with, there's nothing for --daemon to wait for.")
+        sys.exit()
+    return(args)
+
+# Set by main() from the command line.
+args = None
 
 # Most of this is managed in an config file stored wherever the script is run.
 conffile = 'plaid2qfx.conf'
 conf = ConfigParser()
-if os.path.exists(conffile):
-    try:
-        conf.read(conffile)
-    except:
-        print("I was unable to open the configuration file. You may not have provided the right key. Exiting.")
-        sys.exit(404)
-else:
-    # Generate the basic Plaid API and user config
-    conf.add_section('PLAID')
-    conf['PLAID']['client_id'] = input("Please provide your Plaid API client_id: ")
-    conf['PLAID']['client_user_id'] = secrets.token_hex(16) # This is intended for identifying multiple users of a production application, not really useful for a single-user script implementation, so randomly assigned one.
-    
-    # Set up some location variables
-    homedir = os.path.expanduser("~")
-    conf['PLAID']['ofxloc'] = input("Where would you like output files stored? [" + homedir + "]: ") or homedir
-    while not os.path.isdir(conf['PLAID']['ofxloc']):
-        conf['PLAID']['ofxloc'] = input("That path doesn't seem to be a directory, please try again (" + homedir + "): ")
+def load_conf():
+    if os.path.exists(conffile):
+        try:
+            conf.read(conffile)
+        except:
+            print("I was unable to open the configuration file. You may not have provided the right key. Exiting.")
+            sys.exit(404)
+    else:
+        # Generate the basic Plaid API and user config
+        conf.add_section('PLAID')
+        conf['PLAID']['client_id'] = input("Please provide your Plaid API client_id: ")
+        conf['PLAID']['client_user_id'] = secrets.token_hex(16) # This is intended for identifying multiple users of a production application, not really useful for a single-user script implementation, so randomly assigned one.
+        
+        # Set up some location variables
+        homedir = os.path.expanduser("~")
+        conf['PLAID']['ofxloc'] = input("Where would you like output files stored? [" + homedir + "]: ") or homedir
+        while not os.path.isdir(conf['PLAID']['ofxloc']):
+            conf['PLAID']['ofxloc'] = input("That path doesn't seem to be a directory, please try again (" + homedir + "): ")
 
-    # Write the initial conffile
-    with open(conffile, 'w') as file_handle:
-        conf.write(file_handle)
+        # Write the initial conffile
+        with open(conffile, 'w') as file_handle:
+            conf.write(file_handle)
+
+# Items can be processed on several threads at once (see --jobs), so anything that changes conf or rewrites
+# the conffile needs to hold this lock. It is reentrant so a caller can update a few keys and save in one go.
+CONF_LOCK = threading.RLock()
+def save_conf():
+    with CONF_LOCK:
+        with open(conffile, 'w') as file_handle:
+            conf.write(file_handle)
+
+# Interactive prompts from worker threads (like re-authenticating an expired login) need to take turns.
+PROMPT_LOCK = threading.Lock()
 
 # And some static config things...
 client_name = "plaid2qfx_python"
-defaulttime = datetime.time(12, 0, 0, tzinfo=UTC) # Used when transactions only have date because OFX requires full datetime
+defaulttime = datetime.time(12, 0, 0, tzinfo=datetime.timezone.utc) # Used when transactions only have date because OFX requires full datetime
 
 
 ##################################
@@ -89,21 +206,47 @@ defaulttime = datetime.time(12, 0, 0, tzinfo=UTC) # Used when transactions only
 ##################################
 # Start initiation some Plaid endpoints
 GLOBAL_CLIENT = None
+CLIENT_LOCK = threading.Lock()
 def get_client():
     global GLOBAL_CLIENT
-    if GLOBAL_CLIENT is None:  #initialize GLOBAL_CLIENT only once even if get_client() is called more than once
-
-        client_secret = getpass.getpass('Please provide your client API Secret: ')
-
-        plaid_api_configuration = plaid.Configuration(
-            host=plaid.Environment.Production, # Available environments are 'Production', 'Development', and 'Sandbox'
-            api_key={
-                'clientId': conf['PLAID']['client_id'],
-                'secret': client_secret,
-            }
-        )
-        api_client = plaid.ApiClient(plaid_api_configuration)
-        GLOBAL_CLIENT = plaid_api.PlaidApi(api_client)
+    with CLIENT_LOCK:  # with --jobs, several threads may ask for the client at once, but we only want to prompt once
+        if GLOBAL_CLIENT is None and args.replay:
+            # No secret needed, everything comes from the recorded responses
+            GLOBAL_CLIENT = ReplayClient(args.replay)
+
+        if GLOBAL_CLIENT is None:  #initialize GLOBAL_CLIENT only once even if get_client() is called more than once
+            import plaid # Lots of these because of the way the plaid module works... or I just can't figure out how it's intended to work
+            from plaid.api import plaid_api
+
+            with Phase('secret'):
+                with CONF_LOCK:
+                    secret_source = args.secret or conf['PLAID'].get('secret_source')
+                if secret_source:
+                    client_secret = read_secret(secret_source)
+                elif os.environ.get(BATCH_ENV):
+                    # Nobody's there to answer, and the prompt would wait for them regardless (it reads the terminal, not stdin)
+                    print("There's no --secret or secret_source in " + conffile + " to read the client API secret from, and a batch run can't ask for it.")
+                    sys.exit(1)
+                else:
+                    client_secret = getpass.getpass('Please provide your client API Secret: ')
+
+            plaid_api_configuration = plaid.Configuration(
+                host=plaid.Environment.Production, # Available environments are 'Production', 'Development', and 'Sandbox'
+                api_key={
+                    'clientId': conf['PLAID']['client_id'],
+                    'secret': client_secret,
+                }
+            )
+            # One client (and one pool of kept-alive connections) serves every linked account. Each job can have two
+            # requests out at once (a transactions page downloading ahead, plus the rest), or with --backfill, one per
+            # window it's downloading, so size the pool for that, or for --concurrency. Never smaller than the
+            # client's own default though.
+            requests_per_job = max(2, BACKFILL_WORKERS) if args.backfill else 2
+            plaid_api_configuration.connection_pool_maxsize = args.connections or max(plaid_api_configuration.connection_pool_maxsize, requests_per_job*args.jobs + 1, args.concurrency or 0)
+            api_client = plaid.ApiClient(plaid_api_configuration)
+            GLOBAL_CLIENT = RetryingClient(plaid_api.PlaidApi(api_client), args.retries, args.timeout)
+            if args.record:
+                GLOBAL_CLIENT = RecordingClient(GLOBAL_CLIENT, args.record)
     return GLOBAL_CLIENT
 
 
@@ -118,33 +261,43 @@ def get_client():
 ##############
 #### MAIN ####
 ##############
-def main():
-
-    # To join multiple accounts into one file we have to collect stmttrnrs sections (and the CC equivalent)
-    creditcardmsgsrs_list = []
-    stmttrnrs_list = []
+def main(argv=None):
+    global args
+    args = parse_args(argv)
+    if args.batch:
+        run_batch(argv)
+        sys.exit()
+    if args.profile or args.metrics_out:
+        start_metrics()
+    load_conf()
+    if args.categorymap:
+        load_categorymap(args.categorymap)
+
+    # To join multiple accounts into one file we have to collect their statements (in Partitions, see --partition)
+    partitions = []
     isjoint= False   # set to True only when exporting transactions from multiple links to one file.
     link_name = ""
+
+    # Older config files kept each linked account's details in their own section. Move them to the state store.
+    import_conf_links()
         
     # If updateconf was specified in arguments...
     if args.updateconf:
         update_config(conffile)
     
-    # If we don't have any accounts defined, gotta link one. The first conf section is Plaid API stuff. We need at least two.
-    elif len(conf.sections()) < 2:
+    # If we don't have any accounts defined, gotta link one.
+    elif len(get_links()) < 1:
         print("Doesn't look like we have any accounts defined yet. Let's set one up.")
         link_name = link_account()
         print("Thank you. It looks like ", link_name, " was added successfully. As your first linked account, it will also become the financial instituion that the combined output format uses.")
         
         # Save our first link info to the conffile
-        conf['PLAID']['firstlink'] = link_name
-        with open(conffile, 'w') as file_handle:
-            conf.write(file_handle)        
+        set_setting('firstlink', link_name)
         
         # Download transactions for the newly linked account?
         reply = input("Would you like to go ahead and export transactions for this account? You could say no, and re-run the script with the --linkaccount option to add more first. (y/n) ")
         if reply in ('y', 'yes', 'Y', 'Yes', 'YES'):
-            process_item(link_name, creditcardmsgsrs_list, stmttrnrs_list)
+            process_item(link_name, partitions)
 
         
 
@@ -157,57 +310,74 @@ def main():
         # Download transactions for the newly linked account?
         reply = input("Would you like to go ahead and export transactions for just this account? (y/n) ")
         if reply in ('y', 'yes', 'Y', 'Yes', 'YES'):
-            process_item(link_name, creditcardmsgsrs_list, stmttrnrs_list)
+            process_item(link_name, partitions)
 
     # If showaccounts was specified in arguments...
     elif args.showaccounts:
         showaccounts(True)
 
+    # Wait for webhooks
+    elif args.daemon:
+        run_daemon()
+
+    elif args.sendwebhook:
+        send_webhook(args.sendwebhook)
+
     # If a specific account was targeted in arguments...
     elif args.account:
-        if args.account in conf.sections():
+        if get_link(args.account) is not None:
             link_name = args.account
-            process_item(link_name, creditcardmsgsrs_list, stmttrnrs_list)
+            with ItemGuard(link_name) as guard:
+                if not guard.skipped:
+                    process_item(link_name, partitions)
         else: 
             print("I could not find the specified account. Exiting.")
             sys.exit(302)
 
     # Otherwise, start processing all accounts
     else:
-        for section in conf.sections():
-            if (section == 'PLAID'):
-                continue
-
-            creditcardmsgsrs_section_list = []
-            stmttrnrs_section_list = []
-        
-            process_item(section, creditcardmsgsrs_section_list, stmttrnrs_section_list)
-            if args.outformat == "each" or args.outformat == "both":
-                export_qfx(section, creditcardmsgsrs_section_list, stmttrnrs_section_list, False)
+        sections = get_links()
+        if args.replay:
+            # Only the linked accounts that were recorded
+            sections = [section for section in sections if os.path.isdir(os.path.join(args.replay, section))]
+
+        # Each linked account is downloaded and converted on its own, optionally several at a time (--jobs).
+        # Either way the results come back in config order, so the combined file is put together the same.
+        if args.concurrency:
+            results = sync_all_async(sections)
+        elif args.jobs > 1 and len(sections) > 1:
+            get_client() # Ask for the secret up front rather than from inside one of the worker threads
+            with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+                results = list(pool.map(guarded_sync_item, sections))
+        else:
+            results = [guarded_sync_item(section) for section in sections]
 
-            if args.outformat == "combined" or args.outformat == "both":
-                creditcardmsgsrs_list += creditcardmsgsrs_section_list
-                stmttrnrs_list += stmttrnrs_section_list
+        if args.outformat == "combined" or args.outformat == "both":
+            partitions = combine_partitions(results)
         
         # Export single-file format
         if args.outformat == "combined" or args.outformat == "both":
-            if not conf.has_option('PLAID', 'firstlink'):
+            if get_setting('firstlink') is None:
                 print("It appears you have an older config file that isn't prepared for exporting multiple financial institutions accounts in a single file. We need to specify which single bank your single file will place all of your accounts in.")
                 showaccounts(False)
                 firstlink = input("Which linked account would you like to use as the single institution for single-file export? ")
-                while not firstlink in conf.sections():
+                while get_link(firstlink) is None:
                     print("You entered '" + firstlink + "' which is not a valid linked account name. Please specify one from below.")
                     showaccounts(False)
                     firstlink = input("Please enter a valid value: ")
-                conf['PLAID']['firstlink'] = firstlink
-                with open(conffile, 'w') as file_handle:
-                    conf.write(file_handle)
-            link_name = conf['PLAID']['firstlink']
+                set_setting('firstlink', firstlink)
+            link_name = get_setting('firstlink')
             isjoint = True
 
     # export any accumulated transactions.   These could be from a single account or gathered from multiple accounts. 
-    export_qfx(link_name, creditcardmsgsrs_list, stmttrnrs_list, isjoint)
+    export_qfx(link_name, partitions, isjoint)
+    print_skipped_items()
+
+    if args.apistats:
+        print_api_stats()
 
+    if METRICS is not None:
+        METRICS.completed = True
     sys.exit()
 
 
@@ -255,12 +425,18 @@ def update_config(conffile):
 #### New Accounts ####
 ######################
 def link_account():
+    from plaid.model.link_token_create_request import LinkTokenCreateRequest
+    from plaid.model.link_token_create_request_user import LinkTokenCreateRequestUser
+    from plaid.model.item_public_token_exchange_request import ItemPublicTokenExchangeRequest
+    from plaid.model.products import Products
+    from plaid.model.country_code import CountryCode
+
     # Get and validate the new account label
     if args.account:
         link_name = args.account
     else:
         link_name = input("For the purposes of this script, what label would you like to give this linked account? ")
-    if link_name in conf.sections():
+    if link_name in ('PLAID', 'DEFAULT') or get_link(link_name) is not None:
         print("ERROR - The name of the new account has already been used. Please try again with a unique name. Unfortunately I'm not smart enough yet to update existing accounts.")
         sys.exit(1)
     
@@ -274,6 +450,10 @@ def link_account():
                 client_user_id=conf['PLAID']['client_user_id']
             )
         )
+    # With a webhook address set up for --daemon, new links send theirs there too
+    token = get_setting('webhook_token')
+    if conf['PLAID'].get('webhook_url') and token is not None:
+        request['webhook'] = conf['PLAID']['webhook_url'].rstrip('/') + '/' + token
     response = get_client().link_token_create(request)
 
     # Generate auth page with that link token
@@ -295,11 +475,7 @@ def link_account():
     (accounts, ins_id) = get_accounts(response['access_token'], True)
     
     # And we will need the routing number for this institution later.
-    request2 = InstitutionsGetByIdRequest(
-        institution_id=ins_id,
-        country_codes=[CountryCode('US')]
-    )
-    response2 = get_client().institutions_get_by_id(request2)
+    response2 = get_institution(ins_id)
     if len(response2['institution']['routing_numbers']) > 1:
         print("Known routing numbers for this institution:")
         for rn in response2['institution']['routing_numbers']:
@@ -316,15 +492,13 @@ def link_account():
     bid = input("BID: ")
 
         
-    # Store all of this in our config file
-    conf.add_section(link_name)
-    conf[link_name]['access_token'] = response['access_token']
-    conf[link_name]['item_id'] = response['item_id'] 
-    conf[link_name]['ins_id'] = ins_id
-    conf[link_name]['routing_number'] = rn
-    conf[link_name]['bid'] = bid
-    with open(conffile, 'w') as file_handle:
-        conf.write(file_handle)
+    # Store all of this in our state store
+    add_link(link_name,
+             access_token=response['access_token'],
+             item_id=response['item_id'],
+             ins_id=ins_id,
+             routing_number=rn,
+             bid=bid)
 
     # Clean up
     os.remove(page_path)
@@ -374,12 +548,19 @@ def generate_auth_page(link_token):
 #### Getting Accounts from an Item ####
 #######################################
 def get_accounts(access_token, print_it):
+    # The item's accounts and their balances. Never cached: an old copy could have old balances, or be missing an
+    # account added since, whose transactions would then be left out.
+    import plaid
+    from plaid.model.accounts_get_request import AccountsGetRequest
+
     request = AccountsGetRequest(
         access_token=access_token
     )
     try:
         response = get_client().accounts_get(request)
     except plaid.ApiException as e:
+        if item_trouble(e):
+            raise # Not something resolve_error() can fix, see ItemGuard
         resolve_error(e, [access_token])
         try:
             response = get_client().accounts_get(request)
@@ -390,112 +571,627 @@ def get_accounts(access_token, print_it):
     accounts = response['accounts']
     
     if print_it:
-        print("-----------------------")
-        print("Accounts:")
-        for item in accounts:
-            text = "  " + str(item['name']) + " x" + str(item['mask'])
-            text = text.ljust(32)
-            print(text + ": " + item['account_id'])
-        print("-----------------------")
+        print_accounts(accounts)
     return(accounts, response['item']['institution_id'])
 
+def print_accounts(accounts):
+    print("-----------------------")
+    print("Accounts:")
+    for item in accounts:
+        text = "  " + str(item['name']) + " x" + str(item['mask'])
+        text = text.ljust(32)
+        print(text + ": " + item['account_id'])
+    print("-----------------------")
+
+def get_item(access_token):
+    # The item's details, mostly for when Plaid last updated its transactions. Never cached, since that's how we
+    # tell whether there's anything new (see item_unchanged()).
+    from plaid.model.item_get_request import ItemGetRequest
+
+    request = ItemGetRequest(access_token=access_token)
+    return(get_client().item_get(request))
+
+def item_unchanged(link, item_response):
+    # True if Plaid hasn't updated this item since the last time we finished downloading it, so there's nothing new.
+    # Not if the last download was interrupted though, or with --force.
+    last_update = item_response['status']['transactions']['last_successful_update']
+    if args.force or last_update is None or link['last_update'] != last_update.isoformat() or checkpoint_pending(link['link_name']):
+        return(False)
+    print("Plaid hasn't updated " + link['link_name'] + " since it was last exported (" + last_update.strftime("%a, %B %d, %Y %I:%M%p %Z") + "), so skipping it. Use --force to check anyway.")
+    return(True)
+
+def get_institution(ins_id):
+    from plaid.model.institutions_get_by_id_request import InstitutionsGetByIdRequest
+    from plaid.model.institutions_get_by_id_response import InstitutionsGetByIdResponse
+    from plaid.model.country_code import CountryCode
+
+    request = InstitutionsGetByIdRequest(
+        institution_id=ins_id,
+        country_codes=[CountryCode('US')]
+    )
+    return(cached_call('institution', ins_id, lambda: get_client().institutions_get_by_id(request), InstitutionsGetByIdResponse))
+
 
 ##############################
 #### Getting Transactions ####
 ##############################
-def get_transactions(link_name):
-    
-    # Blank for the first time
-    if not 'cursor' in conf[link_name]:
-        cursor = ''
-    else:
-        cursor = conf[link_name]['cursor']
-    
-    # Initialize
-    added = []
-    modified = []
-    removed = []
-    has_more = True
+class SyncRestart(Exception):
+    # Plaid changed the transactions while we were paging through them, so everything handed out so far is void
+    pass
+
+def transaction_pages(link_name):
+    # Yields the download one transactions_sync page at a time, as (added, modified, removed), so the caller can
+    # get to work on each page as it arrives. While it does, the next page is already downloading in the background.
+    # If Plaid makes us start over this raises SyncRestart, and the caller should toss what it has and call again.
+    (link, cursor, saved) = sync_start(link_name)
+    if backfill_wanted(link, saved):
+        backfilled = backfill(link)
+        if backfilled is not None:
+            (saved, cursor) = (backfilled, backfilled[-1][3])
+    page = len(saved)
+    total = 0
 
     # Iterate through pages of new transactions
     print("Loading transactions...")
-    while has_more:
-        request = TransactionsSyncRequest(
-            access_token=conf[link_name]['access_token'],
-            cursor=cursor,
-        )
-        response = get_client().transactions_sync(request)
+    with ThreadPoolExecutor(max_workers=1) as prefetch:
+        pending = prefetch.submit(sync_fetch, link, cursor)
+
+        # The saved pages go first, while the first new one downloads
+        for (added, modified, removed, next_cursor) in saved:
+            total += len(added) + len(modified) + len(removed)
+            yield(added, modified, removed)
+        saved = None
+
+        while pending is not None:
+            response = pending.result()
+
+            # Start on the next page right away
+            has_more = response['has_more']
+            cursor = response['next_cursor']
+            pending = prefetch.submit(sync_fetch, link, cursor) if has_more else None
+
+            (added, modified, removed) = sync_page(link_name, page, response)
+            response = None
+            page += 1
+
+            # Print number of transactions so far
+            total += len(added) + len(modified) + len(removed)
+            if has_more:
+                print("Loaded " + str(total) + "... ", end='\r')
+            else:
+                print("Finished downloading " + str(total) + " transactions.")
 
-        # Add this page of results
-        added.extend(response['added'])
-        modified.extend(response['modified'])
-        removed.extend(response['removed'])
+            yield(added, modified, removed)
 
-        # Update Cursor
-        has_more = response['has_more']
-        cursor = response['next_cursor']
-        
-        # Print number of transactions so far
-        total = len(added) + len(modified) + len(removed)
-        if has_more:
-            print("Loaded " + str(total) + "... ", end='\r')
-        else:
-            print("Finished downloading " + str(total) + " transactions.")
+    # Store updated cursor, and drop the saved pages now that they aren't needed, in one go.
+    if not args.replay:
+        checkpoint_commit(link_name, cursor)
 
-    # Store updated cursor
-    conf[link_name]['cursor'] = cursor
-    with open(conffile, 'w') as file_handle:
-        conf.write(file_handle)
-    
-    # Return retrieved data
+def sync_start(link_name):
+    # Where a download starts from: the link, its cursor, and any pages an interrupted run already saved
+    link = get_link(link_name)
+
+    # Blank for the first time
+    cursor = link['cursor'] or ''
+
+    # If a previous run was interrupted partway through, pick up its pages and carry on from its last cursor.
+    # (Not when replaying, that always starts from the first recorded page and leaves the real download alone.)
+    saved = [] if args.replay else checkpoint_load(link_name)
+    if len(saved) > 0:
+        print("Resuming an interrupted download for " + link_name + " after " + str(len(saved)) + " pages already saved.")
+        cursor = saved[-1][3]
+    return(link, cursor, saved)
+
+def sync_fetch(link, cursor):
+    # Asks Plaid for one page. Raises SyncRestart if Plaid wants the whole download started over.
+    import plaid
+    from plaid.model.transactions_sync_request import TransactionsSyncRequest
+
+    request = TransactionsSyncRequest(
+        access_token=link['access_token'],
+        cursor=cursor,
+        count=args.pagesize,
+    )
+    try:
+        with Phase('download', link['link_name']) as timing:
+            response = get_client().transactions_sync(request)
+            timing.transactions = len(response['added']) + len(response['modified']) + len(response['removed'])
+        return(response)
+    except plaid.ApiException as e:
+        # Plaid asks that we start the whole pagination over if the data changed underneath us
+        if plaid_error(e).get('error_code') != 'TRANSACTIONS_SYNC_MUTATION_DURING_PAGINATION':
+            raise
+        print("Transactions changed at the bank while downloading, so starting over for " + link['link_name'] + ".")
+        checkpoint_clear(link['link_name'])
+        restart_recording(link['access_token'])
+        raise SyncRestart(link['link_name'])
+
+def sync_page(link_name, page, response):
+    # Boil a page down to the few fields we use, so the Plaid objects can go as soon as we're done with them
+    added = [TransactionRecord.from_plaid(trans) for trans in response['added']]
+    modified = [TransactionRecord.from_plaid(trans) for trans in response['modified']]
+    removed = [trans['transaction_id'] for trans in response['removed']]
+
+    # Save this page before anything else, so an interrupted run can resume after it
+    if not args.replay:
+        checkpoint_save(link_name, page, added, modified, removed, response['next_cursor'])
     return(added, modified, removed)
 
+def get_transactions(link_name):
+    # The whole download as plain lists, for when you want it all at once. process_item() takes it page by page instead.
+    while True:
+        (added, modified, removed) = ([], [], [])
+        try:
+            for (page_added, page_modified, page_removed) in transaction_pages(link_name):
+                added.extend(page_added)
+                modified.extend(page_modified)
+                removed.extend(page_removed)
+        except SyncRestart:
+            continue
+        return(added, modified, removed)
+
+
+# --backfill: a brand new linked account's first transactions_sync download hands back up to two years of history
+# one page after another, each waiting on the last. transactions_get can be asked for any range of dates instead, so
+# the history is split into BACKFILL_WINDOW_DAYS windows and several are downloaded at once. Then it carries on with
+# transactions_sync from a cursor taken before any of that started, so anything that comes in meanwhile isn't
+# missed. That can send some of the same transactions again, and take back pending ones that posted meanwhile, so
+# fill_statements() puts each transaction in once and leaves out whatever was removed.
+BACKFILL_DAYS = 730          # as far back as Plaid goes
+BACKFILL_WINDOW_DAYS = 30
+BACKFILL_WORKERS = 4         # windows downloading at once
+BACKFILL_PAGE_SIZE = 500     # transactions_get's largest
+
+def backfill_wanted(link, saved):
+    # Only for a first download that hasn't started yet. Not while recording or replaying either, because the windows
+    # can come back in any order, and a replay goes through the recorded responses in order.
+    return(args.backfill and not args.record and not args.replay and not link['cursor'] and len(saved) == 0)
+
+def backfill(link):
+    # Downloads the history. Returns it as pages, like checkpoint_load() does, the last of which has the cursor for
+    # transactions_sync to carry on from. Or None if Plaid isn't ready yet, in which case use transactions_sync.
+    # (The async engine does the same in fetch_item(), with its own requests.)
+    import plaid
+
+    print("Backfilling the history for " + link['link_name'] + ", " + str(BACKFILL_WINDOW_DAYS) + " days at a time...")
+    try:
+        # The cursor comes first. Taken after, anything that came in during the download would fall in between.
+        cursor = backfill_cursor(link)
+        with ThreadPoolExecutor(max_workers=BACKFILL_WORKERS) as pool:
+            results = list(pool.map(lambda window: backfill_window(link, window[0], window[1]), backfill_windows()))
+    except plaid.ApiException as e:
+        if not backfill_not_ready(link, e):
+            raise
+        return(None)
+    return(backfill_pages(link, results, cursor))
+
+def backfill_cursor(link):
+    # Where transactions_sync should carry on from once the history is in: right now
+    from plaid.model.transactions_sync_request import TransactionsSyncRequest
+
+    request = TransactionsSyncRequest(access_token=link['access_token'], cursor='now')
+    with Phase('download', link['link_name']):
+        return(get_client().transactions_sync(request)['next_cursor'])
+
+def backfill_windows():
+    # (start, end) dates for each window, newest first
+    today = datetime.date.today()
+    first = today - datetime.timedelta(days=BACKFILL_DAYS)
+    windows = []
+    end = today
+    while end >= first:
+        start = max(first, end - datetime.timedelta(days=BACKFILL_WINDOW_DAYS - 1))
+        windows.append((start, end))
+        end = start - datetime.timedelta(days=1)
+    return(windows)
+
+def backfill_not_ready(link, e):
+    # True if the exception from a backfill request just means Plaid doesn't have the history ready yet
+    if plaid_error(e).get('error_code') != 'PRODUCT_NOT_READY':
+        return(False)
+    print("Plaid is still gathering the history for " + link['link_name'] + ", so downloading it the usual way instead.")
+    return(True)
+
+def backfill_pages(link, results, cursor):
+    # The windows' transactions (results, a list of them per window) as pages, saved for an interrupted run
+    link_name = link['link_name']
+
+    # Windows don't overlap, but paging through one while it changes can hand back the same transaction twice
+    transactions = {}
+    for records in results:
+        for trans in records:
+            transactions[trans.transaction_id] = trans
+    transactions = sorted(transactions.values(), key=lambda trans: (trans.dtposted, trans.transaction_id))
+    print("Backfilled " + str(len(transactions)) + " transactions.")
+
+    # Saved like any other downloaded pages, so an interrupted run picks up from here. They all carry the cursor,
+    # so they're saved all at once.
+    pages = []
+    for index in range(0, max(len(transactions), 1), args.pagesize):
+        pages.append((transactions[index:index + args.pagesize], [], [], cursor))
+    checkpoint_save_all(link_name, 0, pages)
+    return(pages)
+
+def backfill_window(link, start, end):
+    # Every transaction from start to end (dates, both included), BACKFILL_PAGE_SIZE at a time
+    from plaid.model.transactions_get_request import TransactionsGetRequest
+    from plaid.model.transactions_get_request_options import TransactionsGetRequestOptions
+
+    records = []
+    while True:
+        request = TransactionsGetRequest(
+            access_token=link['access_token'],
+            start_date=start,
+            end_date=end,
+            options=TransactionsGetRequestOptions(count=BACKFILL_PAGE_SIZE, offset=len(records), include_personal_finance_category=True),
+        )
+        with Phase('download', link['link_name']) as timing:
+            response = get_client().transactions_get(request)
+            timing.transactions = len(response['transactions'])
+        records += [TransactionRecord.from_plaid(trans) for trans in response['transactions']]
+        if len(response['transactions']) == 0 or len(records) >= response['total_transactions']:
+            return(records)
+
+
+###########################
+#### Async Sync Engine ####
+###########################
+# With --concurrency N, main() hands the linked accounts to this instead of the --jobs threads. Every Plaid request
+# for every linked account is its own task, and at most N of them are out at once across all of them, so a run
+# over a great many items keeps N requests in flight the whole time rather than waiting on one round trip per
+# item. Each linked account is converted as soon as its download finishes, one at a time, while the rest carry on
+# downloading. The requests themselves still go through the regular Plaid client (with its retries, --record and
+# --replay), each on a thread of a pool that's also N wide. --backfill's windows count against N too, and boiling
+# down and saving each page happens off the event loop, so neither holds up the other linked accounts.
+def sync_all_async(sections):
+    get_client() # Up front, like for --jobs in main()
+    return(asyncio.run(sync_all_tasks(sections)))
+
+async def sync_all_tasks(sections):
+    loop = asyncio.get_running_loop()
+    limit = asyncio.Semaphore(args.concurrency)
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as requests, ThreadPoolExecutor(max_workers=1) as converter:
+        async def plaid_request(function, *params):
+            async with limit:
+                return(await loop.run_in_executor(requests, function, *params))
+
+        async def off_loop(function, *params):
+            # For work that isn't a request (boiling down pages, saving them) but shouldn't hold up the event loop either
+            return(await loop.run_in_executor(None, function, *params))
+
+        async def one_item(link_name):
+            # On the clock from the first request to the export, see ItemGuard
+            partitions = []
+            with ItemGuard(link_name) as guard:
+                if not guard.skipped:
+                    fetched = await fetch_item(link_name, plaid_request, off_loop)
+                    if fetched is not None:
+                        partitions = await loop.run_in_executor(converter, sync_item, link_name, fetched)
+            return(partitions)
+
+        # gather() hands the results back in the same order as sections, for the combined file
+        return(await asyncio.gather(*[one_item(link_name) for link_name in sections]))
+
+async def fetch_item(link_name, plaid_request, off_loop):
+    # Everything process_item() needs from Plaid for one linked account, as (accounts, pages, item_get response),
+    # or None if Plaid has nothing new for it
+    import plaid
+
+    link = get_link(link_name)
+    item_response = None
+    if not args.replay:
+        with Phase('metadata', link_name):
+            item_response = await plaid_request(get_item, link['access_token'])
+        if item_unchanged(link, item_response):
+            finish_recording(link['access_token'])
+            return(None)
+    with Phase('metadata', link_name):
+        (accounts, ins_id) = await plaid_request(get_accounts, link['access_token'], False)
+
+    while True:
+        (link, cursor, saved) = sync_start(link_name)
+        if backfill_wanted(link, saved):
+            # The same as backfill(), but each window's requests take their turn with everything else's
+            print("Backfilling the history for " + link_name + ", " + str(BACKFILL_WINDOW_DAYS) + " days at a time...")
+            try:
+                backfill_start = await plaid_request(backfill_cursor, link)
+                results = await asyncio.gather(*[plaid_request(backfill_window, link, start, end) for (start, end) in backfill_windows()], return_exceptions=True)
+                for result in results:
+                    if isinstance(result, BaseException):
+                        raise result
+                backfilled = await off_loop(backfill_pages, link, results, backfill_start)
+            except plaid.ApiException as e:
+                if not backfill_not_ready(link, e):
+                    raise
+                backfilled = None
+            if backfilled is not None:
+                (saved, cursor) = (backfilled, backfilled[-1][3])
+        pages = [page[:3] for page in saved]
+        has_more = True
+        try:
+            while has_more:
+                response = await plaid_request(sync_fetch, link, cursor)
+                has_more = response['has_more']
+                cursor = response['next_cursor']
+                pages.append(await off_loop(sync_page, link_name, len(pages), response))
+                response = None
+        except SyncRestart:
+            continue
+        break
+    if not args.replay:
+        checkpoint_commit(link_name, cursor)
+    print("Finished downloading " + str(sum(len(added) + len(modified) + len(removed) for (added, modified, removed) in pages)) + " transactions for " + link_name + ".")
+
+    # A replay only has the item's details if there was something to export
+    if args.replay and any(len(added) + len(modified) > 0 for (added, modified, removed) in pages):
+        item_response = await plaid_request(get_item, link['access_token'])
+    return(accounts, pages, item_response)
+
+
+#############################
+#### Transaction Records ####
+#############################
+# Plaid's Transaction objects carry dozens of fields, and a good deal of overhead each, when we only ever use a
+# handful of them. So each page is boiled down to these as it arrives and the Plaid objects are let go.
+class TransactionRecord:
+    __slots__ = ('transaction_id', 'account_id', 'dtposted', 'amount', 'check_number', 'merchant_name', 'name', 'trntype', 'currency')
+
+    def __init__(self, transaction_id, account_id, dtposted, amount, check_number, merchant_name, name, trntype, currency):
+        self.transaction_id = transaction_id
+        self.account_id = account_id
+        self.dtposted = dtposted
+        self.amount = amount # Integer cents, with Plaid's sign (positive is money going out)
+        self.check_number = check_number
+        self.merchant_name = merchant_name
+        self.name = name
+        self.trntype = trntype
+        self.currency = currency
+
+    @classmethod
+    def from_plaid(cls, trans):
+        # Dates are a PITA, and I don't know why.
+        dtposted = trans['authorized_datetime'] or trans['authorized_date'] or trans['datetime'] or trans['date']
+        if not isinstance(dtposted, datetime.datetime):
+            dtposted = datetime.datetime.combine(dtposted, defaulttime)
+        # NOTE - Plaid sends amounts as floats with (at most) two decimal places, so cents lose nothing.
+        return(cls(trans['transaction_id'],
+                   trans['account_id'],
+                   dtposted,
+                   round(trans['amount'] * 100),
+                   trans['check_number'],
+                   trans['merchant_name'],
+                   trans['name'],
+                   parse_transcat(trans['category'], trans.get('personal_finance_category')),
+                   trans.get('iso_currency_code')))
+
+    def trnamt(self):
+        # OFX wants the opposite sign to Plaid. Going back through the float gives the same digits Plaid sent
+        # (12.5, not 12.50), so the export reads exactly as it did when we kept Plaid's objects around.
+        return(Decimal(str(self.amount / 100))*-1)
+
+    def to_row(self):
+        # For saving in the sync checkpoints
+        return([self.transaction_id, self.account_id, self.dtposted.isoformat(), self.amount, self.check_number,
+                self.merchant_name, self.name, self.trntype, self.currency])
+
+    @classmethod
+    def from_row(cls, row):
+        row = list(row)
+        row[2] = datetime.datetime.fromisoformat(row[2])
+        return(cls(*row))
+
+class AccountStatement:
+    # What process_item() collects for each account on its way to a STMTRS (or CCSTMTRS)
+    __slots__ = ('accttype', 'acctfrom', 'ledgerbal', 'availbal', 'curdef', 'stmttrns')
+
+    def __init__(self, accttype, acctfrom):
+        self.accttype = accttype
+        self.acctfrom = acctfrom
+        self.ledgerbal = None
+        self.availbal = None
+        self.curdef = None
+        self.stmttrns = []
+
 
 ######################
 #### Process Item ####
 # This how we string together the typical actions needed each time a 
 # certain plaid item (or "Linked Account") is processed.
 ######################
-def process_item(link_name, creditcardmsgsrs_list, stmttrnrs_list):
-    # To join multiple accounts into one file we have to collect stmttrnrs sections (and the CC equivalent)
-
-    assert len(creditcardmsgsrs_list) + len(stmttrnrs_list) == 0
+def sync_item(link_name, fetched=None):
+    # Process one linked account from the "all accounts" loop in main() and, if asked for, export its own file(s).
+    # Returns its Partitions so main() can also add them to the combined file(s). Safe to run on a worker thread.
+    partitions = []
+
+    process_item(link_name, partitions, fetched)
+    if args.outformat == "each" or args.outformat == "both":
+        export_qfx(link_name, partitions, False)
+
+    return(partitions)
+
+def guarded_sync_item(link_name):
+    # sync_item(), on the clock and skipped if its bank has been failing (see ItemGuard). Left out if it fails.
+    partitions = []
+    with ItemGuard(link_name) as guard:
+        if not guard.skipped:
+            partitions = sync_item(link_name)
+    return(partitions)
+
+def process_item(link_name, partitions, fetched=None, force=False):
+    # Downloads and converts one linked account into one or more Partitions (one per file, see --partition), added
+    # to partitions. The async engine does the downloading itself and passes what it got in as fetched,
+    # (accounts, pages, item_get response). force skips checking whether Plaid has updated the item first (for a
+    # webhook, which can come in before the item says so).
+    from ofxtools.models import BANKTRANLIST, LEDGERBAL, AVAILBAL, STATUS, STMTRS, STMTTRNRS, CCSTMTRS, CCSTMTTRNRS
+    assert len(partitions) == 0
 
     print("")
     print("######################################")
     print("# Working on account " + link_name)
     print("######################################")
-    (accounts, ins_id) = get_accounts(conf[link_name]['access_token'], True)
-    (added, modified, removed) = get_transactions(link_name)
+    link = get_link(link_name)
+    if fetched is None:
+        # One cheap call first to see whether Plaid has anything new for us (not for a replay, that's all old news)
+        item_response = None
+        if not args.replay and not force:
+            with Phase('metadata', link_name):
+                item_response = get_item(link['access_token'])
+            if item_unchanged(link, item_response):
+                finish_recording(link['access_token'])
+                return
+        with Phase('metadata', link_name):
+            (accounts, ins_id) = get_accounts(link['access_token'], True)
+        pages = lambda: transaction_pages(link_name)
+    else:
+        (accounts, fetched_pages, item_response) = fetched
+        print_accounts(accounts)
+        pages = lambda: fetched_pages
 
-    # Modified and Removed Transactions not yet supported
-    if len(modified) > 0:
-        print("WARNING!! There are modified transactions that I don't know how (or even if) OFX handles. These will not be included in your export.")
-    if len(removed) > 0:
-        print("WARNING!! There are removed transactions that I don't know how (or even if) OFX handles. These will not be included in your export.")
+    # Transactions are converted page by page as they download, and sorted into a statement for each account.
+    while True:
+        statements = new_statements(accounts, link)
+        try:
+            (dtstart, ledger_rows, count) = fill_statements(link_name, statements, pages())
+        except SyncRestart:
+            continue
+        break
+    if item_response is not None:
+        remember_update(link_name, item_response)
 
-    # Do I have anything else to process?
-    if len(added) < 1: 
+    # Did I have anything to process?
+    if count < 1: 
         print("No transactions to process for linked account " + link_name + ".")
+        finish_recording(link['access_token'])
         return
     else:
-        print("Processing " + str(len(added)) + " transactions for linked account " + link_name + ".")
+        print("Processed " + str(count) + " transactions for linked account " + link_name + ".")
     
-    # Initialize Accounts structure we will use to organize unsorted transactions across multiple accounts
-    objaccounts = {}
-
     # What was the latest transactions update for this item / link_name?
-    request = ItemGetRequest(access_token=conf[link_name]['access_token'])
-    response = get_client().item_get(request)
+    response = item_response
+    if response is None:
+        response = get_item(link['access_token'])
+        remember_update(link_name, response)
+    finish_recording(link['access_token'])
     dtasof = response['status']['transactions']['last_successful_update']
-    dtstart = dtasof
+    if dtstart is None or dtasof < dtstart:
+        dtstart = dtasof
     dtend = dtasof
-    if conf[link_name]['ins_id'] != response['item']['institution_id']:
+    if link['ins_id'] != response['item']['institution_id']:
         print("WARNING - The instituion ID Plaid sent in response to my /item/get request does not match the ID stored in this scripts configuration, and I can't think of any good reasons for that to happen. I'll update my configuration to match what Plaid sent, but something may be seriously screwed up.")
-        conf[link_name]['ins_id'] = response['item']['institution_id']
+        update_link(link_name, ins_id=response['item']['institution_id'])
     print("By the way, transactions for linked account " + link_name + " were last updated in Plaid on " + dtasof.strftime("%a, %B %d, %Y %I:%M%p %Z") + ".")
 
-    # First we will initialize ofx entries in this item's accounts object. This is just to organize our data for export.
+    # Add the balances
+    for account in accounts:
+        statement = statements[account['account_id']]
+
+        # Plaid reports a positive balance for a credit card with a negative balance so negate it.
+        balamt=Decimal(str(account['balances']['current']))
+        if statement.accttype == "CREDITCARD":
+            balamt = -balamt
+        statement.ledgerbal = LEDGERBAL(balamt=balamt, dtasof=dtasof)
+
+        if account['balances']['available']:
+            statement.availbal = AVAILBAL(balamt=Decimal(str(account['balances']['available'])),
+                                          dtasof=dtasof)
+        else:
+            statement.availbal = AVAILBAL(balamt=Decimal('0'),
+                                          dtasof=dtasof)
+
+    # Did we get a currency code? Why I overengineer for some potential errors and just pray for the rest...
+    for accountid in statements:
+        if statements[accountid].curdef is None:
+            print("WARNING - No currency code was found in transactions for account " + accountid + ". Assuming USD.")
+            statements[accountid].curdef = "USD"
+
+    # Now generate the statement for each account, in one file's worth or several (--partition). Balances are only
+    # known as of now, so going back from the newest file, each older one gets the balance less what came after it.
+    periods = split_periods(statements, dtstart, dtend)
+    balances = {accountid: statements[accountid].ledgerbal.balamt for accountid in statements}
+    item_partitions = []
+    pending = [] # with --convertjobs, (PartitionStatement, STMTTRNRS or CCSTMTTRNRS, PendingTransactions) to convert
+    for (label, period_start, period_end, period_stmttrns) in reversed(periods):
+        newest = len(item_partitions) == 0
+        partition = Partition(link_name, label)
+        for accountid in statements:
+            statement = statements[accountid]
+            stmttrns = period_stmttrns.get(accountid, [])
+            if not newest and len(stmttrns) == 0:
+                continue # The newest file has every account, for their balances. Older ones just what's needed.
+
+            if newest:
+                ledgerbal = statement.ledgerbal
+                availbal = statement.availbal
+            else:
+                ledgerbal = LEDGERBAL(balamt=balances[accountid], dtasof=period_end)
+                availbal = None
+            balances[accountid] -= sum(stmttrn.trnamt for stmttrn in stmttrns)
+            part = PartitionStatement(link_name, statement.accttype, accountid, statement.curdef, period_start, period_end, ledgerbal, availbal)
+
+            # Only what the chosen --formats need. Everything else about the statement is above.
+            if output_needs('rows') and args.convertjobs == 1:
+                part.transactions = [stmttrn_row(stmttrn) for stmttrn in stmttrns]
+            trnrs = None
+            if output_needs('ofx'):
+                with Phase('convert', link_name):
+                    # BANKTRANLIST (empty with --fastofx or --convertjobs, the transactions are written in by serialize_statement())
+                    banktranlist = BANKTRANLIST(dtstart=period_start, dtend=period_end, *([] if args.fastofx or args.convertjobs > 1 else stmttrns))
+
+                    status = STATUS(code=0, severity='INFO')
+                    if statement.accttype == "CREDITCARD":
+                        ccstmtrs = CCSTMTRS(curdef=statement.curdef,
+                                            ccacctfrom=statement.acctfrom,
+                                            banktranlist=banktranlist,
+                                            ledgerbal=ledgerbal,
+                                            availbal=availbal)
+                        trnrs = CCSTMTTRNRS(trnuid='0', status=status, ccstmtrs=ccstmtrs)
+
+                    else:
+                        stmtrs = STMTRS(curdef=statement.curdef,
+                                            bankacctfrom=statement.acctfrom,
+                                            banktranlist=banktranlist,
+                                            ledgerbal=ledgerbal,
+                                            availbal=availbal)
+                        trnrs = STMTTRNRS(trnuid='0', status=status, stmtrs=stmtrs)
+
+                if args.convertjobs == 1:
+                    with Phase('serialize', link_name, len(stmttrns)):
+                        part.text = serialize_statement(trnrs, stmttrn_text(stmttrns, 5) if args.fastofx else None)
+            if args.convertjobs > 1:
+                pending.append((part, trnrs, stmttrns))
+            partition.statements.append(part)
+            partition.count += len(stmttrns)
+        item_partitions.append(partition)
+
+    # With --convertjobs, every statement's transactions are converted now, all at once
+    if len(pending) > 0:
+        with Phase('convert', link_name):
+            converted = convert_statements([stmttrns for (part, trnrs, stmttrns) in pending])
+        for ((part, trnrs, stmttrns), (text, rows)) in zip(pending, converted):
+            part.transactions = rows
+            if trnrs is not None:
+                with Phase('serialize', link_name, len(stmttrns)):
+                    part.text = serialize_statement(trnrs, text)
+    partitions.extend(reversed(item_partitions))
+
+    # Remember what we exported for next time
+    if not args.replay:
+        ledger_record(ledger_rows)
+    
+    return
+
+def remember_update(link_name, item_response):
+    # How up to date the download was, for item_unchanged() next time
+    if not args.replay:
+        last_update = item_response['status']['transactions']['last_successful_update']
+        update_link(link_name, last_update=last_update.isoformat() if last_update else None)
+
+def new_statements(accounts, link):
+    # An empty statement for each of this item's accounts, for fill_statements() to sort transactions into
+    from ofxtools.models import BANKACCTFROM, CCACCTFROM
+
+    statements = {}
     for account in accounts:
         
         # What type of account is it?
@@ -504,108 +1200,140 @@ def process_item(link_name, creditcardmsgsrs_list, stmttrnrs_list):
         if accttype == "CREDITCARD":
             acctfrom = CCACCTFROM(acctid=account['account_id'][:22])
         else:
-            acctfrom = BANKACCTFROM(bankid=conf[link_name]['routing_number'],
+            acctfrom = BANKACCTFROM(bankid=link['routing_number'],
                                     acctid=account['account_id'][:22],
                                     accttype=accttype)
-        
-        # Add some details
-
-        # Plaid reports a positive balance for a credit card with a negative balance so negate it.
-        balamt=Decimal(str(account['balances']['current']))
-        if accttype == "CREDITCARD":
-            balamt = -balamt
-        ledgerbal = LEDGERBAL(balamt=balamt, dtasof=dtasof)
+        statements[account['account_id']] = AccountStatement(accttype, acctfrom)
+    return(statements)
+
+def fill_statements(link_name, statements, pages):
+    # Works through the download (pages of (added, modified, removed)), turning each transaction into a STMTTRN on its account's statement
+    # (a FastTransaction with --fastofx, a PendingTransaction with --convertjobs). Returns the earliest date posted (or None), the rows for the ledger, and how many transactions there were.
+    # Each transaction goes in once, however many times the download hands it over, and anything the download
+    # removes further along (a pending transaction that posted meanwhile, say) is taken back out again.
+    from ofxtools.models import STMTTRN
+
+    make_stmttrn = STMTTRN
+    if args.convertjobs > 1:
+        make_stmttrn = PendingTransaction # made into the real thing later, by convert_statements()
+    elif args.fastofx:
+        make_stmttrn = fast_stmttrn
+
+    dtstart = None
+    exported = {}    # transaction_id: (its statement, its STMTTRN), for everything in the statements so far
+    ledger_rows = {} # transaction_id: row
+    count = 0
+    skipped = 0
+    repeated = 0
+    withdrawn = 0
+    modified = []
 
-        if account['balances']['available']:
-            availbal = AVAILBAL(balamt=Decimal(str(account['balances']['available'])),
-                                dtasof=dtasof)
-        else:
-            availbal = AVAILBAL(balamt=Decimal('0'),
-                                dtasof=dtasof)
-
-        # Store to our dictionary
-        objaccounts[account['account_id']] = account
-        objaccounts[account['account_id']]['ledgerbal'] = ledgerbal
-        objaccounts[account['account_id']]['availbal'] = availbal
-        objaccounts[account['account_id']]['accttype'] = accttype
-        objaccounts[account['account_id']]['acctfrom'] = acctfrom
-        objaccounts[account['account_id']]['stmttrns'] = []
-        
+    def convert(trans):
+        nonlocal dtstart, count
+        count += 1
 
-    # Focus on added transactions
-    for trans in added:
-        
         # Make sure this transaction maps to a known account
-        if not trans['account_id'] in objaccounts:
-            print("WARNING!!! Skipping transaction for unknown account id: " + trans['account_id'])
-            continue
+        statement = statements.get(trans.account_id)
+        if statement is None:
+            print("WARNING!!! Skipping transaction for unknown account id: " + trans.account_id)
+            return
 
-        # Dates are a PITA, and I don't know why.
-        dtposted = trans['authorized_datetime'] or trans['authorized_date'] or trans['datetime'] or trans['date']
-        if not isinstance(dtposted, datetime.datetime):
-            dtposted = datetime.datetime.combine(dtposted, defaulttime) 
-        if dtposted < dtstart:
+        dtposted = trans.dtposted
+        if dtstart is None or dtposted < dtstart:
             dtstart = dtposted
 
         # Currency - OFX specifies currency at the statement level, Plaid provides it per transaction. 
         # Assume the first transaction's currency will match the rest, and watch for deviation.
-        if 'iso_currency_code' in trans and trans['iso_currency_code']: # the property exists and it is not none
-            if not 'curdef' in objaccounts[trans['account_id']]: # Set the first one.
-                objaccounts[trans['account_id']]['curdef'] = trans['iso_currency_code']
-            if objaccounts[trans['account_id']]['curdef'] != trans['iso_currency_code']: # Make sure the rest match
-                print("WARNING!!! The currency code for this transaction doesn't match others! First currency found for this account: " +  objaccounts[trans['account_id']]['curdef'] + ". Currency code for transaction id " + trans['transaction_id'] + " is: " + trans['iso_currency_code'])
+        if trans.currency:
+            if statement.curdef is None: # Set the first one.
+                statement.curdef = trans.currency
+            if statement.curdef != trans.currency: # Make sure the rest match
+                print("WARNING!!! The currency code for this transaction doesn't match others! First currency found for this account: " +  statement.curdef + ". Currency code for transaction id " + trans.transaction_id + " is: " + trans.currency)
                 # Don't do anything but warn though...
 
         # A little more info before we write a transaction entry.
-        trntype = parse_transcat(trans['category'])
+        trnamt = trans.trnamt()
 
         # Now write the properly formatted transaction entry. 
-        if trans['check_number']:
-            objaccounts[trans['account_id']]['stmttrns'].append(STMTTRN(trntype=trntype,
-                                                                  dtposted=dtposted,
-                                                                  trnamt=Decimal(str(trans['amount']))*-1,
-                                                                  fitid=trans['transaction_id'],
-                                                                  checknum=trans['check_number'], 
-                                                                  name=trans['merchant_name']))
+        if trans.check_number:
+            stmttrn = make_stmttrn(trntype=trans.trntype,
+                                   dtposted=dtposted,
+                                   trnamt=trnamt,
+                                   fitid=trans.transaction_id,
+                                   checknum=trans.check_number, 
+                                   name=trans.merchant_name)
         else:
-            objaccounts[trans['account_id']]['stmttrns'].append(STMTTRN(trntype=trntype,
-                                                                  dtposted=dtposted,
-                                                                  trnamt=Decimal(str(trans['amount']))*-1,
-                                                                  fitid=trans['transaction_id'],
-                                                                  name=trans['merchant_name'],
-                                                                  memo=trans['name']))
-
-    # Now generate the banktranlist for each account
-    for accountid in objaccounts:
-        
-        # Did we get a currency code? Why I overengineer for some potential errors and just pray for the rest... 
-        if not 'curdef' in objaccounts[accountid]:
-            print("WARNING - No currency code was found in transactions for account " + accountid + ". Assuming USD.")
-            objaccounts[accountid]['curdef'] = "USD"
-
-        # BANKTRANLIST
-        objaccounts[accountid]['banktranlist'] = BANKTRANLIST(dtstart=dtstart, dtend=dtend, *objaccounts[accountid]['stmttrns'])
-
-    for accountid in objaccounts:
-        if objaccounts[accountid]['accttype'] == "CREDITCARD":
-            ccstmtrs = CCSTMTRS(curdef=objaccounts[accountid]['curdef'],
-                                ccacctfrom=objaccounts[accountid]['acctfrom'],
-                                banktranlist=objaccounts[accountid]['banktranlist'],
-                                ledgerbal=objaccounts[accountid]['ledgerbal'],
-                                availbal=objaccounts[accountid]['availbal'])
-            status = STATUS(code=0, severity='INFO')
-            creditcardmsgsrs_list.append(CCSTMTTRNRS(trnuid='0', status=status, ccstmtrs=ccstmtrs))
+            stmttrn = make_stmttrn(trntype=trans.trntype,
+                                   dtposted=dtposted,
+                                   trnamt=trnamt,
+                                   fitid=trans.transaction_id,
+                                   name=trans.merchant_name,
+                                   memo=trans.name)
+        statement.stmttrns.append(stmttrn)
+        exported[trans.transaction_id] = (statement, stmttrn)
+        ledger_rows[trans.transaction_id] = (trans.transaction_id, link_name, trans.account_id, dtposted.isoformat(), str(trnamt), trans.merchant_name or trans.name)
+
+    def withdraw(transaction_ids):
+        # Takes these back out of the statements, if they're in them. Returns how many were.
+        nonlocal count
+        dropped = {} # id() of a statement: (the statement, id()s of its STMTTRNs to drop)
+        for transaction_id in transaction_ids:
+            if transaction_id in exported:
+                (statement, stmttrn) = exported.pop(transaction_id)
+                dropped.setdefault(id(statement), (statement, set()))[1].add(id(stmttrn))
+                del ledger_rows[transaction_id]
+                count -= 1
+        for (statement, stmttrn_ids) in dropped.values():
+            statement.stmttrns = [stmttrn for stmttrn in statement.stmttrns if not id(stmttrn) in stmttrn_ids]
+        return(sum(len(stmttrn_ids) for (statement, stmttrn_ids) in dropped.values()))
+
+    for (added, page_modified, removed) in pages:
+
+        # Check what we got against the ledger of transactions we've already exported.
+        # Anything "added" that we exported before (say, after a cursor reset) is skipped so Quicken doesn't see it twice.
+        # A replay re-creates an earlier export on purpose, so it neither checks nor updates the ledger.
+        with Phase('convert', link_name, len(added)):
+            # Same for anything this download already handed over (--backfill's history and the sync after it can overlap).
+            already_exported = set() if args.replay else ledger_lookup([trans.transaction_id for trans in added])
+            skipped += len(already_exported)
+            for trans in added:
+                if trans.transaction_id in exported:
+                    repeated += 1
+                elif not trans.transaction_id in already_exported:
+                    convert(trans)
+
+        # Modified transactions wait until the end so they land after everything added, same as they always have
+        modified.extend(page_modified)
+
+        # Removed before it was ever exported, so it never will be. That goes for its modified details too.
+        if len(removed) > 0:
+            withdrawn += withdraw(removed)
+            removed_ids = set(removed)
+            modified = [trans for trans in modified if not trans.transaction_id in removed_ids]
+
+        # OFX has no way to say a transaction was removed, so the best we can do is record it and tell you about it.
+        if len(removed) > 0 and not args.replay:
+            for row in ledger_remove(removed):
+                print("WARNING!! The bank removed a transaction you already exported. Quicken won't remove it on import, so you may want to delete it by hand: " + row['dtposted'][:10] + "  " + row['trnamt'].rjust(10) + "  " + str(row['name']))
+
+    if skipped > 0:
+        print("Skipped " + str(skipped) + " transactions that were already exported in an earlier run.")
+    if repeated > 0:
+        print("Skipped " + str(repeated) + " transactions that Plaid sent more than once in this download.")
+    if withdrawn > 0:
+        print("Left out " + str(withdrawn) + " transactions the bank removed before they were exported (most likely pending ones that have since posted).")
+
+    # Modified transactions get exported again with their new details, under the same FITID. If one is also in
+    # this download, or modified more than once, only its latest details go in.
+    if len(modified) > 0:
+        modified = list({trans.transaction_id: trans for trans in modified}.values())
+        print("NOTE: " + str(len(modified)) + " transactions were modified by the bank and will be exported again with their new details. Quicken matches on the transaction ID, so if it skips them as duplicates you may need to update them by hand.")
+        with Phase('convert', link_name, len(modified)):
+            withdraw([trans.transaction_id for trans in modified])
+            for trans in modified:
+                convert(trans)
 
-        else:
-            stmtrs = STMTRS(curdef=objaccounts[accountid]['curdef'],
-                                bankacctfrom=objaccounts[accountid]['acctfrom'],
-                                banktranlist=objaccounts[accountid]['banktranlist'],
-                                ledgerbal=objaccounts[accountid]['ledgerbal'],
-                                availbal=objaccounts[accountid]['availbal'])  
-            status = STATUS(code=0, severity='INFO')
-            stmttrnrs_list.append(STMTTRNRS(trnuid='0', status=status, stmtrs=stmtrs))
-    
-    return
+    return(dtstart, list(ledger_rows.values()), count)
 
 def parse_accttype(typ, subtype):
     # There are a lot of account types you might see in Plaid. https://plaid.com/docs/api/accounts/#account-type-schema
@@ -627,98 +1355,1849 @@ def parse_accttype(typ, subtype):
     else:
         return("CHECKING")
 
-def parse_transcat(category):
-    # There are a lot of categories used by Plaid. Access the list by running categories = get_client().categories_get({}).
-    # These have to be mapped to a handful of OFX specified categories found in ofxtools TRNTYPES.
-    # Again, best effort is more than enough for now. 
-    try:
-        if category[0] == "Bank Fees":
-            trntype = "FEE"
-        elif category[0] == "Cash Advance":
-            trntype = "CASH"
-        elif category[0] == "Interest":
-            trntype = "INT"
-        elif category[0] == "Payment":
-            trntype = "PAYMENT"
-        elif category[0] == "Tax":
-            if len(category) > 1 and category[1] == "Payment":
-                trntype = "DEBIT"
-            elif len(category) > 1 and category[1] == "Refund":
-                trntype = "CREDIT"
-            else:
-                trntype = "CREDIT"
-        elif category[0] == "Transfer":
-            if len(category) > 1 and category[1] == "Check":
-                trntype = "CHECK"
-            elif len(category) > 2 and category[2] == "Check":
-                trntype = "CHECK"
-            elif len(category) > 1 and category[1] == "Deposit":
-                trntype = "DEP"
-            elif len(category) > 2 and category[2] == "ATM":
-                trntype = "ATM"
-            else:
-                trntype = "XFER"
-        else: 
-            trntype = "DEBIT" # Use this for the vast majority of categories
-    
-    except:
-        print("WARNING!!! Category parsing failed on category " + category + " . Attempting to continue... but could get ugly.")
-        return("CAT_ERROR")
-    
+# There are a lot of categories used by Plaid. Access the list by running categories = get_client().categories_get({}).
+# These have to be mapped to a handful of OFX specified categories found in ofxtools TRNTYPES.
+# Again, best effort is more than enough for now.
+#
+# Older items come with a category path like ["Transfer", "Deposit"]. These rules are checked in order and the
+# first match wins; None matches anything at that position, and a rule matches any longer path that starts the same.
+TRANSCAT_RULES = [
+    (("Bank Fees",), "FEE"),
+    (("Cash Advance",), "CASH"),
+    (("Interest",), "INT"),
+    (("Payment",), "PAYMENT"),
+    (("Tax", "Payment"), "DEBIT"),
+    (("Tax",), "CREDIT"),
+    (("Transfer", "Check"), "CHECK"),
+    (("Transfer", None, "Check"), "CHECK"),
+    (("Transfer", "Deposit"), "DEP"),
+    (("Transfer", None, "ATM"), "ATM"),
+    (("Transfer",), "XFER"),
+]
+# Newer items may only have Plaid's personal_finance_category, so we also look at its detailed value, then its primary.
+PERSONAL_FINANCE_CATEGORY_MAP = {
+    "INCOME_DIVIDENDS": "DIV",
+    "INCOME_INTEREST_EARNED": "INT",
+    "INCOME_TAX_REFUND": "CREDIT",
+    "TRANSFER_IN_CASH_ADVANCES_AND_LOANS": "CASH",
+    "TRANSFER_IN_DEPOSIT": "DEP",
+    "LOAN_PAYMENTS_CREDIT_CARD_PAYMENT": "PAYMENT",
+    "GOVERNMENT_AND_NON_PROFIT_TAX_PAYMENT": "DEBIT",
+    "BANK_FEES": "FEE",
+    "INCOME": "DEP",
+    "LOAN_PAYMENTS": "PAYMENT",
+    "TRANSFER_IN": "XFER",
+    "TRANSFER_OUT": "XFER",
+}
+# Your own overrides (see --categorymap) are keyed on the full category path (joined with " > ") or on a
+# personal_finance_category value, and win over everything above.
+TRANSCAT_OVERRIDES = {}
+# Every transaction needs a TRNTYPE, but there are only so many different categories, so each answer is remembered.
+TRANSCAT_CACHE = {}
+
+def parse_transcat(category, personal_finance_category=None):
+    path = tuple(category) if category else ()
+    pfc = (personal_finance_category['primary'], personal_finance_category['detailed']) if personal_finance_category else (None, None)
+    key = (path, pfc)
+    trntype = TRANSCAT_CACHE.get(key)
+    if trntype is None:
+        trntype = TRANSCAT_CACHE[key] = classify_transcat(path, pfc)
     return(trntype)
 
+def classify_transcat(path, pfc):
+    (primary, detailed) = pfc
+
+    # Your overrides first: the full path, then personal_finance_category detailed, then primary
+    for key in (" > ".join(path), detailed, primary):
+        if key and key in TRANSCAT_OVERRIDES:
+            return(TRANSCAT_OVERRIDES[key])
+
+    if len(path) > 0:
+        for (pattern, trntype) in TRANSCAT_RULES:
+            if len(path) >= len(pattern) and all(want is None or want == got for (want, got) in zip(pattern, path)):
+                return(trntype)
+        return("DEBIT") # Use this for the vast majority of categories
+
+    for key in (detailed, primary):
+        if key in PERSONAL_FINANCE_CATEGORY_MAP:
+            return(PERSONAL_FINANCE_CATEGORY_MAP[key])
+    return("DEBIT")
+
+def load_categorymap(path):
+    # Read TRNTYPE overrides from a file like:
+    #   [category]
+    #   Transfer > Payroll = DIRECTDEP
+    #   [personal_finance_category]
+    #   INCOME_WAGES = DIRECTDEP
+    from ofxtools.models.bank.stmt import TRNTYPES
+
+    categorymap = ConfigParser(delimiters=('=',))
+    categorymap.optionxform = str # keep the case of category names
+    try:
+        with open(path, encoding="utf-8") as file_handle:
+            categorymap.read_file(file_handle)
+    except OSError:
+        print("I was unable to open the category map file " + path + ". Exiting.")
+        sys.exit(1)
+    for section in categorymap.sections():
+        for (key, trntype) in categorymap.items(section):
+            if trntype.upper() not in TRNTYPES:
+                print("The category map says '" + key + "' should be '" + trntype + "', but OFX only allows these: " + ", ".join(TRNTYPES) + ". Exiting.")
+                sys.exit(1)
+            TRANSCAT_OVERRIDES[key] = trntype.upper()
+    TRANSCAT_CACHE.clear()
+
+############################
+#### Partitioned Output ####
+############################
+# A first download can bring in years of history, and Quicken is slow to import (or gives up on) one huge file.
+# --partition month writes a file per calendar month, and --partition N files of at most N transactions. Each file
+# gets its own DTSTART/DTEND, and balances as of its end (worked back from today's). Without it, a linked account
+# is one Partition, same as always.
+class Partition:
+    # The statements that go in one file (or one of each of the --formats)
+    __slots__ = ('link_name', 'label', 'statements', 'count')
+
+    def __init__(self, link_name, label):
+        self.link_name = link_name
+        self.label = label  # For the file name. None when not partitioning.
+        self.statements = []  # PartitionStatements
+        self.count = 0  # transactions
+
+    def add(self, other):
+        self.statements.extend(other.statements)
+        self.count += other.count
+
+class PartitionStatement:
+    # One account's statement, worked out once by process_item() and written out by every writer in OUTPUT_FORMATS
+    # without going back to Plaid or ofxtools. transactions are (fitid, dtposted, trnamt, trntype, name, memo,
+    # checknum) for the formats that go transaction by transaction, and text is the statement as OFX for the ones
+    # that are OFX (see serialize_statement()). Each is only filled in if one of the --formats needs it.
+    __slots__ = ('link_name', 'accttype', 'account_id', 'curdef', 'dtstart', 'dtend', 'ledgerbal', 'availbal', 'transactions', 'text')
+
+    def __init__(self, link_name, accttype, account_id, curdef, dtstart, dtend, ledgerbal, availbal):
+        self.link_name = link_name
+        self.accttype = accttype
+        self.account_id = account_id
+        self.curdef = curdef
+        self.dtstart = dtstart
+        self.dtend = dtend
+        self.ledgerbal = ledgerbal  # LEDGERBAL
+        self.availbal = availbal  # AVAILBAL, or None
+        self.transactions = None
+        self.text = None
+
+def stmttrn_row(stmttrn):
+    # A PartitionStatement's transactions entry for a STMTTRN (or FastTransaction)
+    return((stmttrn.fitid, stmttrn.dtposted, stmttrn.trnamt, stmttrn.trntype, stmttrn.name, stmttrn.memo, stmttrn.checknum))
+
+def split_periods(statements, dtstart, dtend):
+    # Splits the statements' transactions up per --partition, oldest first, as (label, DTSTART, DTEND, {account: STMTTRNs})
+    if args.partition is None:
+        return([(None, dtstart, dtend, {accountid: statements[accountid].stmttrns for accountid in statements})])
+
+    # Every transaction, with its account, oldest first
+    everything = sorted(((stmttrn.dtposted, accountid, stmttrn) for accountid in statements for stmttrn in statements[accountid].stmttrns), key=lambda entry: entry[0])
+    periods = []
+    if args.partition == 'month':
+        for (dtposted, accountid, stmttrn) in everything:
+            dtposted = dtposted.astimezone(datetime.timezone.utc)
+            label = f"{dtposted:%Y-%m}"
+            if len(periods) == 0 or periods[-1][0] != label:
+                month = datetime.datetime(dtposted.year, dtposted.month, 1, tzinfo=datetime.timezone.utc)
+                next_month = datetime.datetime(dtposted.year + dtposted.month // 12, dtposted.month % 12 + 1, 1, tzinfo=datetime.timezone.utc)
+                periods.append((label, month, next_month, {}))
+            periods[-1][3].setdefault(accountid, []).append(stmttrn)
+    else:
+        for index in range(0, len(everything), args.partition):
+            chunk = everything[index:index + args.partition]
+            # Each file picks up where the one before it left off, and ends where the next one starts
+            start = dtstart if index == 0 else chunk[0][0]
+            end = everything[index + args.partition][0] if index + args.partition < len(everything) else chunk[-1][0]
+            periods.append(("part" + f"{len(periods) + 1:03d}", start, end, {}))
+            for (dtposted, accountid, stmttrn) in chunk:
+                periods[-1][3].setdefault(accountid, []).append(stmttrn)
+
+    if len(periods) == 0:
+        return([(None, dtstart, dtend, {})])
+    # The newest file runs up to when Plaid last updated, like an unpartitioned one, unless that's before it even starts
+    (label, start, end, stmttrns) = periods[-1]
+    if dtend >= start:
+        periods[-1] = (label, start, dtend, stmttrns)
+    return(periods)
+
+def combine_partitions(results):
+    # Puts every linked account's Partitions together for the combined file(s). results is a list (one per linked
+    # account) of lists of Partitions.
+    combined = []
+    if args.partition is None or args.partition == 'month':
+        # The same month (or everything) from each linked account goes in one file
+        by_label = {}
+        for partitions in results:
+            for partition in partitions:
+                if not partition.label in by_label:
+                    by_label[partition.label] = Partition(None, partition.label)
+                by_label[partition.label].add(partition)
+        for label in sorted(by_label, key=lambda label: label or ""):
+            combined.append(by_label[label])
+    else:
+        # Fill each file up to the limit, but don't put two pieces of the same linked account in one file
+        link_names = set()
+        for partitions in results:
+            for partition in partitions:
+                if len(combined) == 0 or combined[-1].count + partition.count > args.partition or partition.link_name in link_names:
+                    combined.append(Partition(None, "part" + f"{len(combined) + 1:03d}"))
+                    link_names = set()
+                combined[-1].add(partition)
+                link_names.add(partition.link_name)
+    return(combined)
+
+
 #######################
 #### Exporting QFX ####
 #######################
-def export_qfx(link_name, creditcardmsgsrs_list, stmttrnrs_list, isjoint):
+def export_qfx(link_name, partitions, isjoint):
+    # Writes each Partition out in each of the --formats, several files at a time if there's more than one.
+    # link_name is the institution the files are from, as far as QFX and OFX are concerned.
 
-    if len(creditcardmsgsrs_list) == 0 and len(stmttrnrs_list) == 0:
+    partitions = [partition for partition in partitions if len(partition.statements) > 0]
+    if len(partitions) == 0:
         return
 
     assert link_name != ""
+    link = get_link(link_name)
+
+    outputs = []
+    for partition in partitions:
+        filename = "AllAccounts_" if isjoint else link_name + "_"
+        if partition.label:
+            filename += partition.label + "_"
+        filename += f"{datetime.datetime.now():%Y-%m-%d_%H%M%S%f}"
+        for output_format in args.formats:
+            outputs.append((partition, output_format, os.path.join(conf['PLAID']['ofxloc'], filename + OUTPUT_FORMATS[output_format][0])))
+
+    export = lambda output: write_output(link, isjoint, *output)
+    if len(outputs) == 1:
+        paths = [export(outputs[0])]
+    else:
+        with ThreadPoolExecutor(max_workers=min(len(outputs), EXPORT_WRITERS)) as pool:
+            paths = list(pool.map(export, outputs))
+    for path in paths:
+        print("Successfully exported transactions to: " + path)
+
+    return
+
+EXPORT_WRITERS = 4 # files written at once when there's more than one
+
+def write_output(link, isjoint, partition, output_format, fullpath):
+    with Phase('export', "AllAccounts" if isjoint else link['link_name'], partition.count), open(fullpath, 'w', encoding="utf-8") as file_handle:
+        OUTPUT_FORMATS[output_format][1](file_handle, link, partition)
+    return(fullpath)
+
+def write_qfx(file_handle, link, partition):
+    write_ofx_document(file_handle, partition, signon_text(link, True))
+
+def write_ofx(file_handle, link, partition):
+    write_ofx_document(file_handle, partition, signon_text(link, False))
+
+def signon_text(link, quicken):
+    # The signon block, with the Quicken proprietary tag in it for QFX.
+    from ofxtools.models import STATUS, FI, SONRS, SIGNONMSGSRSV1
+    from ofxtools.utils import UTC
 
     # Some preface o
     status = STATUS(code=0, severity='INFO')
 
     # More wrapping and formatting
-    fi = FI(org=link_name, fid=conf[link_name]['routing_number'])
+    fi = FI(org=link['link_name'], fid=link['routing_number'])
     sonrs = SONRS(status=status,
                 dtserver=datetime.datetime.now(UTC),
                 language="ENG",
                 fi=fi)
     signonmsgs = SIGNONMSGSRSV1(sonrs=sonrs)
 
-    # Final putting together of the OFX body, depending on what account types were present
-    if len(creditcardmsgsrs_list) > 0 and len(stmttrnrs_list) > 0:
-        creditcardmsgsrs = CREDITCARDMSGSRSV1(*creditcardmsgsrs_list)
-        bankmsgsrs = BANKMSGSRSV1(*stmttrnrs_list)
-        ofx = OFX(signonmsgsrsv1=signonmsgs, creditcardmsgsrsv1=creditcardmsgsrs, bankmsgsrsv1=bankmsgsrs)
-    elif len(creditcardmsgsrs_list) > 0:
-        creditcardmsgsrs = CREDITCARDMSGSRSV1(*creditcardmsgsrs_list)
-        ofx = OFX(signonmsgsrsv1=signonmsgs, creditcardmsgsrsv1=creditcardmsgsrs)
+    signon = signonmsgs.to_etree()
+    if quicken:
+        tag = ET.SubElement(signon[0], 'INTU.BID')
+        tag.text = link['bid']
+    ET.indent(signon, level=1)
+    return(ET.tostring(signon, encoding='unicode'))
+
+def write_ofx_document(file_handle, partition, signon):
+    from ofxtools.header import make_header
+
+    # Final putting together of the OFX body, depending on what account types were present.
+    # OFX wants bank statements ahead of credit card statements, same order ofxtools' OFX aggregate uses.
+    msgsrs_list = []
+    stmttrnrs_list = [statement.text for statement in partition.statements if statement.accttype != "CREDITCARD"]
+    creditcardmsgsrs_list = [statement.text for statement in partition.statements if statement.accttype == "CREDITCARD"]
+    if len(stmttrnrs_list) > 0:
+        msgsrs_list.append(('BANKMSGSRSV1', stmttrnrs_list))
+    if len(creditcardmsgsrs_list) > 0:
+        msgsrs_list.append(('CREDITCARDMSGSRSV1', creditcardmsgsrs_list))
+
+    # And export. Woot!!! The statements were already turned into text by process_item(), so they're just
+    # copied in, the same text for a linked account's own file and the AllAccounts file.
+    file_handle.write(str(make_header(version=102)))
+    file_handle.write("<OFX>" + INDENT_TEXT[1])
+    file_handle.write(signon)
+    for (tagname, statements) in msgsrs_list:
+        file_handle.write(INDENT_TEXT[1] + "<" + tagname + ">")
+        for statement in statements:
+            file_handle.write(INDENT_TEXT[2])
+            file_handle.write(statement)
+        file_handle.write(INDENT_TEXT[1] + "</" + tagname + ">")
+    file_handle.write(INDENT_TEXT[0] + "</OFX>")
+
+# CSV and JSONL have a line per transaction, with amounts as OFX has them (negative for money going out).
+TRANSACTION_FIELDS = ('link', 'account_id', 'account_type', 'date', 'amount', 'currency', 'type', 'name', 'memo', 'check_number', 'transaction_id')
+
+def transaction_rows(partition):
+    for statement in partition.statements:
+        for (fitid, dtposted, trnamt, trntype, name, memo, checknum) in statement.transactions:
+            yield((statement.link_name, statement.account_id, statement.accttype, dtposted.isoformat(), str(trnamt), statement.curdef, trntype, name, memo, checknum, fitid))
+
+def write_csv(file_handle, link, partition):
+    writer = csv.writer(file_handle, lineterminator="\n")
+    writer.writerow(TRANSACTION_FIELDS)
+    writer.writerows(transaction_rows(partition))
+
+def write_jsonl(file_handle, link, partition):
+    # Amounts stay strings so they're exactly what the bank said
+    for row in transaction_rows(partition):
+        file_handle.write(json.dumps(dict(zip(TRANSACTION_FIELDS, row)), ensure_ascii=False) + "\n")
+
+# The --formats, as file extension, writer(file_handle, link, partition), and what it needs from each
+# PartitionStatement: 'ofx' for its text, 'rows' for its transactions. Adding a format is adding a writer here.
+OUTPUT_FORMATS = {
+    'qfx': ('.qfx', write_qfx, 'ofx'),
+    'ofx': ('.ofx', write_ofx, 'ofx'),
+    'csv': ('.csv', write_csv, 'rows'),
+    'jsonl': ('.jsonl', write_jsonl, 'rows'),
+}
+
+def output_needs(need):
+    return(any(OUTPUT_FORMATS[output_format][2] == need for output_format in args.formats))
+
+
+# The streaming writer below produces exactly what ET.indent() followed by ET.tostring() would for the
+# whole document: two spaces per level, children on their own lines, closing tags back at the parent's level.
+INDENT_TEXT = ["\n" + "  " * level for level in range(16)]
+
+def serialize_statement(trnrs, stmttrns_text=None):
+    # A STMTTRNRS or CCSTMTTRNRS as text, indented for where it always sits in our files (<OFX>, then the message
+    # set). process_item() keeps this instead of the aggregate, which is a good deal smaller, and export_qfx()
+    # copies it into every file it belongs in, so "both" doesn't have to convert anything twice.
+    # With --fastofx or --convertjobs the BANKTRANLIST comes in empty, and its transactions already written out
+    # as stmttrns_text (see stmttrn_text()).
+    buffer = io.StringIO()
+    write_aggregate(buffer, trnrs, 2)
+    text = buffer.getvalue()
+    if stmttrns_text:
+        # BANKTRANLIST is always 4 deep (<OFX>, message set, STMTTRNRS, STMTRS), its transactions 5
+        end = INDENT_TEXT[4] + "</BANKTRANLIST>"
+        assert text.count(end) == 1
+        text = text.replace(end, stmttrns_text + end)
+    return(text)
+
+def write_element(file_handle, elem, level):
+    # Write one ElementTree element (and everything under it) as if it sat `level` deep in the document.
+    ET.indent(elem, level=level)
+    file_handle.write(ET.tostring(elem, encoding='unicode'))
+
+def write_aggregate(file_handle, aggregate, level):
+    # Write an ofxtools aggregate one child at a time. Anything holding a list (message sets, statements,
+    # BANKTRANLIST) is walked here so only one transaction's ElementTree exists at a time; everything else
+    # is small and goes through ofxtools' own to_etree(). Mirrors Aggregate.to_etree() otherwise.
+    from ofxtools.models.base import Aggregate
+    from ofxtools.Types import ListAggregate, ListElement
+
+    if not holds_list(aggregate) or type(aggregate).ungroom is not Aggregate.ungroom:
+        write_element(file_handle, aggregate.to_etree(), level)
+        return
+
+    cls = aggregate.__class__
+    tagname = cls.__name__
+    children = []
+    list_processed = False
+    for attr, type_ in aggregate.spec.items():
+        if isinstance(type_, (ListAggregate, ListElement)):
+            if not list_processed:
+                children.extend(aggregate)
+                list_processed = True
+        else:
+            value = getattr(aggregate, attr)
+            if value is None:
+                continue
+            elif isinstance(value, Aggregate):
+                children.append(value)
+            else:
+                elem = ET.Element(attr.upper())
+                elem.text = cls._superdict[attr].unconvert(value)
+                children.append(elem)
+
+    if len(children) == 0:
+        file_handle.write("<" + tagname + " />")
+        return
+    file_handle.write("<" + tagname + ">")
+    for child in children:
+        file_handle.write(INDENT_TEXT[level + 1])
+        if isinstance(child, Aggregate):
+            write_aggregate(file_handle, child, level + 1)
+        else:
+            write_element(file_handle, child, level + 1)
+    file_handle.write(INDENT_TEXT[level] + "</" + tagname + ">")
+
+def holds_list(aggregate):
+    # True if this aggregate, or any aggregate inside it, has list members (like BANKTRANLIST's STMTTRNs).
+    from ofxtools.models.base import Aggregate
+    from ofxtools.Types import ListAggregate, ListElement
+
+    if len(aggregate) > 0:
+        return True
+    for attr, type_ in aggregate.spec.items():
+        if isinstance(type_, (ListAggregate, ListElement)):
+            continue
+        value = getattr(aggregate, attr)
+        if isinstance(value, Aggregate) and holds_list(value):
+            return True
+    return False
+
+
+###########################
+#### Fast OFX Writer ####
+#########################
+# Going through ofxtools means building a STMTTRN for every transaction, checking every field on the way in and
+# again on the way out, then an ElementTree, then text. With --fastofx, fill_statements() keeps a FastTransaction
+# for each one instead, and serialize_statement() writes their markup directly. Everything around the transactions
+# (accounts, balances, the signon) still goes through ofxtools. The output is the same, character for character;
+# `py benchmark.py ofxwriter` checks that against ofxtools on made-up transactions, and times the two.
+FAST_LENGTHS = (('fitid', 255), ('checknum', 12), ('name', 32), ('memo', 255)) # ofxtools' limits for these STMTTRN fields
+
+class FastTransaction:
+    # The STMTTRN fields we use, holding exactly what the STMTTRN would (see fast_stmttrn())
+    __slots__ = ('trntype', 'dtposted', 'trnamt', 'fitid', 'checknum', 'name', 'memo')
+
+    def __init__(self, trntype, dtposted, trnamt, fitid, checknum, name, memo):
+        self.trntype = trntype
+        self.dtposted = dtposted
+        self.trnamt = trnamt
+        self.fitid = fitid
+        self.checknum = checknum
+        self.name = name
+        self.memo = memo
+
+def fast_stmttrn(trntype, dtposted, trnamt, fitid, checknum=None, name=None, memo=None):
+    # Takes the same arguments as STMTTRN and makes the same conversions ofxtools would: an empty string is left
+    # out, and entities like &amp; are unescaped. Anything ofxtools would complain about (too long, not a valid
+    # type, no time zone) is handed to ofxtools after all, so it complains just the same.
+    from ofxtools.models.bank.stmt import TRNTYPES
+
+    strings = []
+    for (value, (field, length)) in zip((fitid, checknum, name, memo), FAST_LENGTHS):
+        if value is not None and not isinstance(value, str):
+            break
+        if value == "":
+            value = None
+        elif value is not None and "&" in value:
+            value = saxutils.unescape(value, {"&nbsp;": " ", "&apos;": "'", "&quot;": '"'})
+        if value is not None and len(value) > length:
+            break
+        strings.append(value)
+    else:
+        if (trntype in TRNTYPES and strings[0] is not None and isinstance(trnamt, Decimal)
+                and isinstance(dtposted, datetime.datetime) and dtposted.utcoffset() is not None):
+            return(FastTransaction(trntype, dtposted, trnamt, *strings))
+
+    from ofxtools.models import STMTTRN
+    return(STMTTRN(trntype=trntype, dtposted=dtposted, trnamt=trnamt, fitid=fitid, checknum=checknum, name=name, memo=memo))
+
+def stmttrn_text(stmttrns, level):
+    # The transactions' markup, each on its own line `level` deep, as write_aggregate() would write their STMTTRNs.
+    # Plenty of transactions share a posting time, so each one's text is only worked out once.
+    from ofxtools.Types import format_datetime
+
+    outer = INDENT_TEXT[level]
+    inner = INDENT_TEXT[level + 1]
+    dates = {}
+    parts = []
+    for stmttrn in stmttrns:
+        parts.append(outer)
+        if not isinstance(stmttrn, FastTransaction):
+            # A real STMTTRN (without --fastofx, or one that fast_stmttrn() left to ofxtools)
+            buffer = io.StringIO()
+            write_aggregate(buffer, stmttrn, level)
+            parts.append(buffer.getvalue())
+            continue
+
+        # Equal times (the same moment) only read the same with the same offset and zone name
+        dtposted = stmttrn.dtposted
+        key = (dtposted, dtposted.utcoffset(), dtposted.tzname())
+        dttext = dates.get(key)
+        if dttext is None:
+            dttext = dates[key] = format_datetime("%Y%m%d%H%M%S", dtposted)
+
+        parts.append("<STMTTRN>" + inner + "<TRNTYPE>" + stmttrn.trntype + "</TRNTYPE>" +
+                     inner + "<DTPOSTED>" + dttext + "</DTPOSTED>" +
+                     inner + "<TRNAMT>" + str(stmttrn.trnamt) + "</TRNAMT>" +
+                     inner + "<FITID>" + saxutils.escape(stmttrn.fitid) + "</FITID>")
+        if stmttrn.checknum is not None:
+            parts.append(inner + "<CHECKNUM>" + saxutils.escape(stmttrn.checknum) + "</CHECKNUM>")
+        if stmttrn.name is not None:
+            parts.append(inner + "<NAME>" + saxutils.escape(stmttrn.name) + "</NAME>")
+        if stmttrn.memo is not None:
+            parts.append(inner + "<MEMO>" + saxutils.escape(stmttrn.memo) + "</MEMO>")
+        parts.append(outer + "</STMTTRN>")
+    return("".join(parts))
+
+
+##############################
+#### Conversion Processes ####
+##############################
+# Making and writing out a STMTTRN for every transaction is most of the work of converting a big download, and it
+# all happens on one core. With --convertjobs N, fill_statements() only keeps what each STMTTRN will be made from
+# (a PendingTransaction), and once they're sorted into statements, process_item() sends them off a chunk at a time
+# to N processes. Each chunk comes back as its markup (and rows, for CSV and JSONL), put back together in the
+# order they were sent, so the files come out just as they would without it.
+CONVERT_CHUNK = 2000 # transactions. An item with fewer than this is converted right here, a process isn't worth it.
+STMTTRN_FIELDS = ('trntype', 'dtposted', 'trnamt', 'fitid', 'checknum', 'name', 'memo')
+CONVERT_POOL = None
+CONVERT_POOL_LOCK = threading.Lock()
+
+class PendingTransaction:
+    # STMTTRN's arguments, as given. dtposted and trnamt are already what the STMTTRN's will be.
+    __slots__ = STMTTRN_FIELDS
+
+    def __init__(self, trntype, dtposted, trnamt, fitid, checknum=None, name=None, memo=None):
+        self.trntype = trntype
+        self.dtposted = dtposted
+        self.trnamt = trnamt
+        self.fitid = fitid
+        self.checknum = checknum
+        self.name = name
+        self.memo = memo
+
+    def to_tuple(self):
+        # Much smaller to send to another process than the object
+        return((self.trntype, self.dtposted, self.trnamt, self.fitid, self.checknum, self.name, self.memo))
+
+def convert_pool():
+    # Started the first time it's needed and kept for the rest of the run. The processes are spawned (Windows'
+    # only choice anyway) rather than forked, so they don't inherit our threads, connections and open database.
+    global CONVERT_POOL
+    with CONVERT_POOL_LOCK:
+        if CONVERT_POOL is None:
+            import multiprocessing
+            CONVERT_POOL = ProcessPoolExecutor(max_workers=args.convertjobs, mp_context=multiprocessing.get_context('spawn'))
+    return(CONVERT_POOL)
+
+def convert_statements(statements):
+    # statements is a list of lists of PendingTransactions, one per statement. Returns (markup, rows) for each, in
+    # the same order: the STMTTRNs' markup for serialize_statement() if an OFX format is wanted, and their rows
+    # (see stmttrn_row()) if CSV or JSONL is. Whichever isn't wanted is None.
+    want_text = output_needs('ofx')
+    want_rows = output_needs('rows')
+    chunks = []
+    for (index, stmttrns) in enumerate(statements):
+        for start in range(0, len(stmttrns), CONVERT_CHUNK):
+            chunks.append((index, [stmttrn.to_tuple() for stmttrn in stmttrns[start:start + CONVERT_CHUNK]]))
+
+    convert = functools.partial(convert_chunk, fastofx=args.fastofx, want_text=want_text, want_rows=want_rows)
+    if len(chunks) > 1:
+        results = convert_pool().map(convert, [transactions for (index, transactions) in chunks])
     else:
-        assert len(stmttrnrs_list) > 0
-        bankmsgsrs = BANKMSGSRSV1(*stmttrnrs_list)
-        ofx = OFX(signonmsgsrsv1=signonmsgs, bankmsgsrsv1=bankmsgsrs)
-
-    # Add the Quicken proprietary tag and export. Woot!!!
-    root = ofx.to_etree()
-    tag = ET.SubElement(root[0][0], 'INTU.BID')
-    tag.text = conf[link_name]['bid']
-    ET.indent(root)
-    text = ET.tostring(root, encoding='unicode')
-    header = str(make_header(version=102))
-    text = header+text
-    if isjoint:
-        filename = "AllAccounts_"+ f"{datetime.datetime.now():%Y-%m-%d_%H%M%S%f}" + ".qfx"
+        results = [convert(transactions) for (index, transactions) in chunks]
+
+    texts = [[] for stmttrns in statements]
+    rows = [[] for stmttrns in statements]
+    for ((index, transactions), (chunk_text, chunk_rows)) in zip(chunks, results):
+        if want_text:
+            texts[index].append(chunk_text)
+        if want_rows:
+            rows[index].extend(chunk_rows)
+    return([("".join(texts[index]) if want_text else None, rows[index] if want_rows else None) for index in range(len(statements))])
+
+def convert_chunk(transactions, fastofx, want_text, want_rows):
+    # Runs in a conversion process (or right here, for a small item). Gets PendingTransaction.to_tuple()s, makes
+    # their STMTTRNs (FastTransactions with --fastofx) and returns (their markup, their rows).
+    from ofxtools.models import STMTTRN
+
+    make = fast_stmttrn if fastofx else STMTTRN
+    stmttrns = [make(**dict(zip(STMTTRN_FIELDS, transaction))) for transaction in transactions]
+    return((stmttrn_text(stmttrns, 5) if want_text else None,
+            [stmttrn_row(stmttrn) for stmttrn in stmttrns] if want_rows else None))
+
+
+######################
+#### Local Database ####
+########################
+# Everything the script learns as it runs (linked account details, cursors, what has been exported) lives in a
+# small SQLite database next to the config file. Updates are atomic, so a crash can't leave it half written,
+# and lookups go through indexes instead of scanning the whole config.
+dbfile = 'plaid2qfx.db'
+DB_SCHEMA = [
+    # One row per linked account (Plaid item). Rows keep the order they were added, which the combined export relies on.
+    """CREATE TABLE IF NOT EXISTS links (
+           link_name TEXT PRIMARY KEY,
+           access_token TEXT NOT NULL UNIQUE,
+           item_id TEXT UNIQUE,
+           ins_id TEXT,
+           routing_number TEXT,
+           bid TEXT,
+           cursor TEXT,
+           last_update TEXT
+       )""",
+    # Odds and ends, like which linked account the combined output format uses (firstlink).
+    """CREATE TABLE IF NOT EXISTS settings (
+           key TEXT PRIMARY KEY,
+           value TEXT
+       ) WITHOUT ROWID""",
+    # Every transaction that has been exported (see Transaction Ledger below).
+    """CREATE TABLE IF NOT EXISTS ledger (
+           transaction_id TEXT PRIMARY KEY,
+           link_name TEXT NOT NULL,
+           account_id TEXT NOT NULL,
+           dtposted TEXT NOT NULL,
+           trnamt TEXT NOT NULL,
+           name TEXT,
+           removed INTEGER NOT NULL DEFAULT 0
+       ) WITHOUT ROWID""",
+    # Pages of an in-progress transactions_sync download (see transaction_pages()), cleared once the cursor is saved.
+    """CREATE TABLE IF NOT EXISTS sync_pages (
+           link_name TEXT NOT NULL,
+           page INTEGER NOT NULL,
+           response TEXT NOT NULL,
+           PRIMARY KEY (link_name, page)
+       ) WITHOUT ROWID""",
+    # Banks that have been failing lately, by Plaid institution ID (see Timeouts and Circuit Breaker below).
+    """CREATE TABLE IF NOT EXISTS breakers (
+           ins_id TEXT PRIMARY KEY,
+           failures INTEGER NOT NULL,
+           open_until REAL NOT NULL,
+           last_error TEXT
+       ) WITHOUT ROWID""",
+    # Recent institutions_get_by_id responses (see Metadata Cache below). Earlier versions kept account details
+    # (balances and all) and item details here too, which aren't used anymore, so they're cleared out.
+    """CREATE TABLE IF NOT EXISTS metadata_cache (
+           key TEXT PRIMARY KEY,
+           fetched REAL NOT NULL,
+           response TEXT NOT NULL
+       ) WITHOUT ROWID""",
+    "DELETE FROM metadata_cache WHERE key LIKE 'accounts:%' OR key LIKE 'item:%'",
+]
+# Columns added since a table was first created, so older databases get them too
+DB_COLUMNS = [
+    ('links', 'last_update', 'TEXT'), # Plaid's last_successful_update for the item, as of the last finished download
+]
+GLOBAL_DB = None
+DB_LOCK = threading.RLock() # One connection shared by all threads (see --jobs), so take turns using it.
+def get_db():
+    global GLOBAL_DB
+    with DB_LOCK:
+        if GLOBAL_DB is None:
+            db = sqlite3.connect(dbfile, check_same_thread=False)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            for statement in DB_SCHEMA:
+                db.execute(statement)
+            for (table, column, coltype) in DB_COLUMNS:
+                if not column in [row['name'] for row in db.execute("PRAGMA table_info(" + table + ")")]:
+                    db.execute("ALTER TABLE " + table + " ADD COLUMN " + column + " " + coltype)
+            db.commit()
+            GLOBAL_DB = db
+    return GLOBAL_DB
+
+
+#####################
+#### State Store ####
+#####################
+# Linked accounts used to be sections in the config file, and every cursor update rewrote the whole file.
+# Now each one is a row in the links table, updated on its own.
+LINK_FIELDS = ('access_token', 'item_id', 'ins_id', 'routing_number', 'bid', 'cursor', 'last_update')
+
+def get_links():
+    # Names of all linked accounts, in the order they were added
+    with DB_LOCK:
+        return([row['link_name'] for row in get_db().execute("SELECT link_name FROM links ORDER BY rowid")])
+
+def get_link(link_name):
+    # Everything we know about one linked account, or None if there's no such link
+    with DB_LOCK:
+        return(get_db().execute("SELECT * FROM links WHERE link_name = ?", (link_name,)).fetchone())
+
+def find_link(access_token=None, item_id=None):
+    # Look up a linked account by its access_token or item_id instead of its name
+    with DB_LOCK:
+        if access_token is not None:
+            return(get_db().execute("SELECT * FROM links WHERE access_token = ?", (access_token,)).fetchone())
+        return(get_db().execute("SELECT * FROM links WHERE item_id = ?", (item_id,)).fetchone())
+
+def add_link(link_name, **values):
+    with DB_LOCK:
+        db = get_db()
+        with db:
+            db.execute("INSERT INTO links (link_name, " + ", ".join(values) + ") VALUES (?" + ", ?" * len(values) + ")", (link_name, *values.values()))
+
+def update_link(link_name, **values):
+    assert all(key in LINK_FIELDS for key in values)
+    with DB_LOCK:
+        db = get_db()
+        with db:
+            db.execute("UPDATE links SET " + ", ".join(key + " = ?" for key in values) + " WHERE link_name = ?", (*values.values(), link_name))
+
+def get_setting(key):
+    with DB_LOCK:
+        row = get_db().execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+    return(None if row is None else row['value'])
+
+def set_setting(key, value):
+    with DB_LOCK:
+        db = get_db()
+        with db:
+            db.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
+
+def import_conf_links():
+    # One-time move of linked accounts (and firstlink) out of an older config file and into the state store.
+    # The old file is kept as a .bak, the same way decrypt_conf.py does it.
+    sections = [section for section in conf.sections() if section != 'PLAID']
+    if len(sections) == 0 and not conf.has_option('PLAID', 'firstlink'):
+        return
+
+    print("Moving your linked accounts out of " + conffile + " and into " + dbfile + ". Your old config is saved as " + conffile + ".bak.")
+    with DB_LOCK:
+        db = get_db()
+        with db:
+            for section in sections:
+                values = {key: conf[section][key] for key in LINK_FIELDS if key in conf[section]}
+                db.execute("INSERT OR IGNORE INTO links (link_name, " + ", ".join(values) + ") VALUES (?" + ", ?" * len(values) + ")", (section, *values.values()))
+            if conf.has_option('PLAID', 'firstlink'):
+                db.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('firstlink', ?)", (conf['PLAID']['firstlink'],))
+
+    with CONF_LOCK:
+        with open(conffile + ".bak", 'w') as file_handle:
+            conf.write(file_handle)
+        for section in sections:
+            conf.remove_section(section)
+        conf.remove_option('PLAID', 'firstlink')
+        save_conf()
+
+
+############################
+#### Transaction Ledger ####
+############################
+# A local record of every transaction (by transaction_id, which we use as the FITID) that has been exported.
+# It lets each run tell what's new, what changed, and what the bank took back. The table is keyed on
+# transaction_id without a separate rowid, so the primary key is the only index and checks stay fast even
+# with millions of historical transactions.
+# SQLite limits how many ? parameters a single statement can have, so look things up in batches.
+LEDGER_BATCH = 500
+
+def ledger_lookup(transaction_ids):
+    # Returns the set of these transaction ids that were already exported (and not since removed).
+    found = set()
+    with DB_LOCK:
+        db = get_db()
+        for i in range(0, len(transaction_ids), LEDGER_BATCH):
+            batch = transaction_ids[i:i+LEDGER_BATCH]
+            rows = db.execute("SELECT transaction_id FROM ledger WHERE removed = 0 AND transaction_id IN (" + ",".join("?" * len(batch)) + ")", batch)
+            found.update(row['transaction_id'] for row in rows)
+    return(found)
+
+def ledger_record(rows):
+    # Store (transaction_id, link_name, account_id, dtposted, trnamt, name) rows for exported transactions.
+    # A modified transaction simply replaces its old row.
+    with DB_LOCK:
+        db = get_db()
+        with db:
+            db.executemany("INSERT OR REPLACE INTO ledger (transaction_id, link_name, account_id, dtposted, trnamt, name, removed) VALUES (?, ?, ?, ?, ?, ?, 0)", rows)
+
+def ledger_remove(transaction_ids):
+    # Mark transactions as removed. Returns the ledger rows for the ones we had actually exported.
+    removed = []
+    with DB_LOCK:
+        db = get_db()
+        with db:
+            for i in range(0, len(transaction_ids), LEDGER_BATCH):
+                batch = transaction_ids[i:i+LEDGER_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                removed.extend(db.execute("SELECT * FROM ledger WHERE removed = 0 AND transaction_id IN (" + placeholders + ")", batch).fetchall())
+                db.execute("UPDATE ledger SET removed = 1 WHERE transaction_id IN (" + placeholders + ")", batch)
+    return(removed)
+
+
+##########################
+#### Sync Checkpoints ####
+##########################
+# Each transactions_sync page is saved as it arrives so a long first download that dies partway through can
+# resume from its last good cursor instead of starting over. Pages are kept as the same compact TransactionRecord
+# rows get_transactions() works with, which are a fraction of the size of what Plaid sent and quick to read back.
+def checkpoint_save(link_name, page, added, modified, removed, next_cursor):
+    checkpoint_save_all(link_name, page, [(added, modified, removed, next_cursor)])
+
+def checkpoint_save_all(link_name, first_page, pages):
+    # Saves several pages, (added, modified, removed, next_cursor) like checkpoint_load() returns them, numbered
+    # from first_page, in a single transaction. All of them are saved or none are, so a resumed download never
+    # picks up a cursor from past pages that didn't make it.
+    rows = []
+    for (page, (added, modified, removed, next_cursor)) in enumerate(pages, first_page):
+        rows.append((link_name, page, json.dumps({'added': [trans.to_row() for trans in added],
+                                                  'modified': [trans.to_row() for trans in modified],
+                                                  'removed': removed,
+                                                  'next_cursor': next_cursor})))
+    with DB_LOCK:
+        db = get_db()
+        with db:
+            db.executemany("INSERT OR REPLACE INTO sync_pages (link_name, page, response) VALUES (?, ?, ?)", rows)
+
+def checkpoint_load(link_name):
+    # Returns any saved pages for this link, in order, as (added, modified, removed, next_cursor)
+    with DB_LOCK:
+        rows = get_db().execute("SELECT response FROM sync_pages WHERE link_name = ? ORDER BY page", (link_name,)).fetchall()
+    pages = []
+    for row in rows:
+        saved = json.loads(row['response'])
+        try:
+            pages.append(([TransactionRecord.from_row(trans) for trans in saved['added']],
+                          [TransactionRecord.from_row(trans) for trans in saved['modified']],
+                          saved['removed'],
+                          saved['next_cursor']))
+        except (KeyError, TypeError, IndexError):
+            # Saved by an older version of this script as Plaid's own JSON. Not worth converting, just start over.
+            print("Couldn't read the saved pages of an interrupted download for " + link_name + ", so starting it over.")
+            checkpoint_clear(link_name)
+            return([])
+    return(pages)
+
+def checkpoint_pending(link_name):
+    # Are there saved pages from an interrupted download?
+    with DB_LOCK:
+        return(get_db().execute("SELECT 1 FROM sync_pages WHERE link_name = ? LIMIT 1", (link_name,)).fetchone() is not None)
+
+def checkpoint_clear(link_name):
+    with DB_LOCK:
+        db = get_db()
+        with db:
+            db.execute("DELETE FROM sync_pages WHERE link_name = ?", (link_name,))
+
+def checkpoint_commit(link_name, cursor):
+    # The download finished: save the new cursor and drop its saved pages in a single transaction
+    with DB_LOCK:
+        db = get_db()
+        with db:
+            db.execute("UPDATE links SET cursor = ? WHERE link_name = ?", (cursor, link_name))
+            db.execute("DELETE FROM sync_pages WHERE link_name = ?", (link_name,))
+
+
+########################
+#### Metadata Cache ####
+########################
+# An institution's details hardly ever change, so a copy of each response is kept in the database and handed back
+# again (instead of asking Plaid) until it's older than its time to live. That covers linking several accounts at
+# the same bank, in one run or over a few. Account and item details aren't cached, since an export needs them as
+# they are right now (see get_accounts() and get_item()); each export asks for them once and uses the one response
+# for everything in it. The time, in seconds, can be changed in the PLAID section of the config file as
+# cache_ttl_institution, 0 turns it off, and --refresh ignores it for a run.
+CACHE_TTL = {
+    'institution': 7*24*60*60,
+}
+
+def cache_ttl(kind):
+    with CONF_LOCK:
+        return(conf['PLAID'].getint('cache_ttl_' + kind, fallback=CACHE_TTL[kind]))
+
+def cached_call(kind, key, fetch, model_class):
+    # Returns a recent enough copy of this kind of response for key (an institution ID) if we have one, otherwise
+    # calls fetch() for a fresh one and keeps a copy of that.
+    if args.record or args.replay:
+        # Those need every request to go through the Plaid client (real or recorded), and mustn't spoil the cache
+        return(fetch())
+
+    # Hashed, so that nothing secret would ever end up as a key
+    cache_key = kind + ":" + hashlib.sha256(key.encode()).hexdigest()[:32]
+    ttl = cache_ttl(kind)
+    if ttl > 0 and not args.refresh:
+        with DB_LOCK:
+            row = get_db().execute("SELECT fetched, response FROM metadata_cache WHERE key = ?", (cache_key,)).fetchone()
+        if row is not None and 0 <= time.time() - row['fetched'] < ttl:
+            return(from_json(row['response'], model_class))
+
+    response = fetch()
+    if ttl > 0:
+        text = to_json(response)
+        with DB_LOCK:
+            db = get_db()
+            with db:
+                db.execute("INSERT OR REPLACE INTO metadata_cache (key, fetched, response) VALUES (?, ?, ?)", (cache_key, time.time(), text))
+    return(response)
+
+
+###########################
+#### Record and Replay ####
+###########################
+# --record saves every accounts_get, item_get and transactions_sync response into DIR/<link_name>/ as the JSON
+# Plaid sent. --replay DIR then stands in for the Plaid client and hands those responses back, so an export can
+# be re-created offline, as often as you like, without moving the cursor. A linked account's responses go into
+# DIR/<link_name>.partial/ at first, and only replace its recording once its download is done, so a recording is
+# always one whole run's worth. If Plaid had nothing new, or the run failed, the older recording stays as it was.
+def recording_path(directory, access_token, name):
+    link = find_link(access_token=access_token)
+    return(os.path.join(directory, link['link_name'], name + ".json"))
+
+def to_json(model):
+    # Plaid model object -> the same JSON text Plaid would have sent
+    import plaid
+    return(json.dumps(plaid.ApiClient.sanitize_for_serialization(model)))
+
+def from_json(text, model_class):
+    # And back again, the same way the Plaid client turns a response body into model objects
+    import plaid
+    from plaid.model_utils import validate_and_convert_types
+    return(validate_and_convert_types(json.loads(text), (model_class,), ['received_data'], True, True, configuration=plaid.Configuration()))
+
+class RecordingClient:
+    # Wraps the real Plaid client and saves a copy of the responses the export needs
+    def __init__(self, client, directory):
+        self.client = client
+        self.directory = directory
+        self.pages = {} # transactions_sync pages recorded so far this run, by access_token
+        self.started = {} # access_token: its link's directory, for each recording underway
+        self.lock = threading.Lock()
+
+    def save(self, access_token, name, response):
+        with self.lock:
+            if not access_token in self.started:
+                # An account being linked right now isn't a linked account yet, so there's nothing to record it under
+                link = find_link(access_token=access_token)
+                if link is None:
+                    return
+                # A new recording for this link, so clear out anything left by one that never finished
+                linkdir = os.path.join(self.directory, link['link_name'])
+                shutil.rmtree(linkdir + ".partial", ignore_errors=True)
+                os.makedirs(linkdir + ".partial")
+                self.started[access_token] = linkdir
+            partial = self.started[access_token] + ".partial"
+        with open(os.path.join(partial, name + ".json"), 'w', encoding="utf-8") as file_handle:
+            file_handle.write(to_json(response))
+
+    def restart(self, access_token):
+        # Plaid made us start the download over, so the pages recorded so far don't count
+        with self.lock:
+            self.pages.pop(access_token, None)
+            if access_token in self.started:
+                partial = self.started[access_token] + ".partial"
+                for filename in os.listdir(partial):
+                    if filename.startswith('transactions_sync_'):
+                        os.remove(os.path.join(partial, filename))
+
+    def finish(self, access_token):
+        # The link is done for this run. If it downloaded anything, that's its recording now.
+        with self.lock:
+            self.pages.pop(access_token, None)
+            linkdir = self.started.pop(access_token, None)
+            if linkdir is None:
+                return
+            if os.path.exists(os.path.join(linkdir + ".partial", 'transactions_sync_0000.json')):
+                shutil.rmtree(linkdir, ignore_errors=True)
+                os.replace(linkdir + ".partial", linkdir)
+            else:
+                shutil.rmtree(linkdir + ".partial", ignore_errors=True)
+
+    def accounts_get(self, request):
+        response = self.client.accounts_get(request)
+        self.save(request['access_token'], 'accounts_get', response)
+        return(response)
+
+    def item_get(self, request):
+        response = self.client.item_get(request)
+        self.save(request['access_token'], 'item_get', response)
+        return(response)
+
+    def transactions_sync(self, request):
+        response = self.client.transactions_sync(request)
+        with self.lock:
+            page = self.pages.get(request['access_token'], 0)
+            self.pages[request['access_token']] = page + 1
+        self.save(request['access_token'], 'transactions_sync_' + str(page).zfill(4), response)
+        return(response)
+
+    def __getattr__(self, name):
+        # Anything else (linking accounts and so on) goes straight to Plaid without being recorded
+        return(getattr(self.client, name))
+
+def restart_recording(access_token):
+    if isinstance(GLOBAL_CLIENT, RecordingClient):
+        GLOBAL_CLIENT.restart(access_token)
+
+def finish_recording(access_token):
+    if isinstance(GLOBAL_CLIENT, RecordingClient):
+        GLOBAL_CLIENT.finish(access_token)
+
+class ReplayClient:
+    # Stands in for the Plaid client, answering from responses saved with --record
+    def __init__(self, directory):
+        self.directory = directory
+        self.pages = {} # transactions_sync pages handed out so far, by access_token
+        self.lock = threading.Lock()
+
+    def load(self, access_token, name, model_class):
+        path = recording_path(self.directory, access_token, name)
+        if not os.path.exists(path):
+            print("I couldn't find " + path + " to replay. Was this linked account recorded with --record? Exiting.")
+            sys.exit(1)
+        with open(path, encoding="utf-8") as file_handle:
+            return(from_json(file_handle.read(), model_class))
+
+    def accounts_get(self, request):
+        from plaid.model.accounts_get_response import AccountsGetResponse
+        return(self.load(request['access_token'], 'accounts_get', AccountsGetResponse))
+
+    def item_get(self, request):
+        from plaid.model.item_get_response import ItemGetResponse
+        return(self.load(request['access_token'], 'item_get', ItemGetResponse))
+
+    def transactions_sync(self, request):
+        # Pages come back in the order they were recorded, whatever cursor is asked for
+        from plaid.model.transactions_sync_response import TransactionsSyncResponse
+        with self.lock:
+            page = self.pages.get(request['access_token'], 0)
+            self.pages[request['access_token']] = page + 1
+        return(self.load(request['access_token'], 'transactions_sync_' + str(page).zfill(4), TransactionsSyncResponse))
+
+    def __getattr__(self, name):
+        print("Plaid's " + name + " isn't available when replaying recorded responses. Exiting.")
+        sys.exit(1)
+
+
+#################################
+#### Retries and Rate Limits ####
+#################################
+# Plaid has per-item and per-client rate limits, and now and then a request just fails on their end. Rather than let
+# the first of those end a long run over many linked accounts, every request goes through this wrapper, which waits
+# a bit and tries again. Waits double each time (with some randomness so parallel jobs don't all come back at
+# once), and a rate limit holds off every job, not just the one that hit it.
+RETRY_BASE_DELAY = 1       # seconds, for a temporary error
+RATE_LIMIT_BASE_DELAY = 5  # seconds, for a rate limit. Plaid's limits are per minute, so no point hammering.
+RETRY_MAX_DELAY = 60
+RETRY_STATUS = (429, 500, 502, 503, 504)
+RETRY_ERROR_CODES = ('INTERNAL_SERVER_ERROR', 'PLANNED_MAINTENANCE', 'INSTITUTION_NOT_RESPONDING')
+# Exchanging a public token only works once, so if we can't tell whether it went through, don't try it again.
+RETRY_UNSAFE = ('item_public_token_exchange',)
+
+class RetryingClient:
+    # Wraps the real Plaid client, retrying what's worth retrying and keeping count per endpoint. Each request
+    # gets timeout seconds, or less if its linked account's time (see Timeouts and Circuit Breaker) is nearly up.
+    def __init__(self, client, retries, timeout=None):
+        self.client = client
+        self.retries = retries
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.resume_at = 0  # time.monotonic() before which nobody should send anything, after a rate limit
+        self.stats = {}
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return(attr)
+        return(lambda *params, **kwparams: self.call(name, attr, params, kwparams))
+
+    def call(self, name, method, params, kwparams):
+        import plaid
+        import urllib3
+
+        deadline = request_deadline(params)
+        attempt = 0
+        while True:
+            # Hold off if someone just got rate limited
+            with self.lock:
+                wait = self.resume_at - time.monotonic()
+            if wait > 0:
+                time_left(deadline, name, wait)
+                time.sleep(wait)
+
+            timeout = time_left(deadline, name)
+            if self.timeout is not None:
+                timeout = self.timeout if timeout is None else min(timeout, self.timeout)
+            if timeout is not None:
+                kwparams['_request_timeout'] = timeout
+            start = time.monotonic()
+            try:
+                response = method(*params, **kwparams)
+                self.count(name, time.monotonic() - start, False, False)
+                return(response)
+            except (plaid.ApiException, urllib3.exceptions.HTTPError) as e:
+                seconds = time.monotonic() - start
+                (retry, rate_limited) = retry_reason(e, name)
+                if not retry or attempt >= self.retries:
+                    self.count(name, seconds, False, True)
+                    raise
+                self.count(name, seconds, True, False)
+                retry_after = getattr(e, 'headers', None) and e.headers.get('Retry-After')
+
+            # Jittered exponential backoff, unless Plaid said how long to wait
+            delay = min(RETRY_MAX_DELAY, (RATE_LIMIT_BASE_DELAY if rate_limited else RETRY_BASE_DELAY) * 2**attempt)
+            delay = delay * random.uniform(0.5, 1)
+            if retry_after and str(retry_after).isdigit():
+                delay = max(delay, int(retry_after))
+            time_left(deadline, name, 0 if rate_limited else delay)
+            attempt += 1
+            print("Plaid " + ("rate limited" if rate_limited else "had trouble with") + " a " + name + " request, trying again in " + str(round(delay, 1)) + " seconds (retry " + str(attempt) + " of " + str(self.retries) + ").")
+            if rate_limited:
+                with self.lock:
+                    self.resume_at = max(self.resume_at, time.monotonic() + delay)
+            else:
+                time.sleep(delay)
+
+    def count(self, name, seconds, retried, failed):
+        with self.lock:
+            stats = self.stats.setdefault(name, {'requests': 0, 'retries': 0, 'failures': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            stats['requests'] += 1
+            stats['retries'] += retried
+            stats['failures'] += failed
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+def plaid_error(e):
+    # The error Plaid sent with an ApiException, as a dict. Empty if there's no body, or it isn't Plaid's JSON (a
+    # proxy's error page, say, or a connection that failed before Plaid answered at all).
+    try:
+        error = json.loads(e.body)
+    except (TypeError, ValueError):
+        return({})
+    return(error if isinstance(error, dict) else {})
+
+def retry_reason(e, name):
+    # Returns (worth retrying, because of a rate limit) for an exception from the Plaid client
+    import plaid
+
+    if not isinstance(e, plaid.ApiException) or e.status == 0:
+        # Couldn't reach Plaid, or the connection dropped (the Plaid client reports an SSL error as status 0)
+        return(not name in RETRY_UNSAFE, False)
+    error = plaid_error(e)
+    if e.status == 429 or error.get('error_type') == 'RATE_LIMIT_EXCEEDED':
+        return(True, True)
+    if name in RETRY_UNSAFE:
+        return(False, False)
+    return((e.status in RETRY_STATUS or error.get('error_code') in RETRY_ERROR_CODES), False)
+
+def retrying_client():
+    # The RetryingClient with the counts in it, if any requests went to Plaid
+    client = GLOBAL_CLIENT
+    while client is not None and not isinstance(client, RetryingClient):
+        client = getattr(client, 'client', None)  # --record wraps it once more
+    return(client)
+
+def print_api_stats():
+    client = retrying_client()
+    if client is None:
+        print("No requests were sent to Plaid.")
+        return
+    print("-----------------------")
+    print("Plaid requests:")
+    print("  " + "Endpoint".ljust(30) + "Requests".rjust(10) + "Retries".rjust(10) + "Failures".rjust(10) + "Avg ms".rjust(10) + "Max ms".rjust(10))
+    with client.lock:
+        for name in sorted(client.stats):
+            stats = client.stats[name]
+            print("  " + name.ljust(30) + str(stats['requests']).rjust(10) + str(stats['retries']).rjust(10) + str(stats['failures']).rjust(10)
+                  + str(round(1000 * stats['seconds'] / stats['requests'])).rjust(10) + str(round(1000 * stats['max_seconds'])).rjust(10))
+    print("-----------------------")
+
+
+######################################
+#### Timeouts and Circuit Breaker ####
+######################################
+# Now and then a bank's connection to Plaid goes bad, and requests for its linked accounts hang or fail over and
+# over. So that one bank can't hold up all the others (and the combined file), every request gives up after
+# --timeout seconds (and is retried like any other failure), and each linked account gets --itemtimeout seconds
+# all told. One that runs out of time, or whose bank is having trouble, is left out of this run's export and
+# reported at the end; whatever it downloaded is kept, so it picks up from there next time.
+# Banks that keep failing (by Plaid institution ID) are remembered in plaid2qfx.db. After BREAKER_THRESHOLD
+# failed runs in a row their linked accounts are skipped for a while, an hour at first and twice as long after
+# each further failure. Any run after a failure only gives them BREAKER_TRIAL_TIMEOUT seconds, until they work
+# again. --force tries them anyway. A linked account's first download (or --backfill) can take a long while just
+# because there's a lot of history, so running out of time on that isn't held against its bank, nor cut short.
+BREAKER_THRESHOLD = 2
+BREAKER_COOLDOWN = 3600      # seconds
+BREAKER_MAX_COOLDOWN = 86400 # seconds
+BREAKER_TRIAL_TIMEOUT = 120  # seconds
+BREAKER_ERROR_CODES = ('INSTITUTION_DOWN', 'INSTITUTION_NOT_RESPONDING', 'INSTITUTION_NOT_AVAILABLE', 'PLANNED_MAINTENANCE', 'INTERNAL_SERVER_ERROR')
+ITEM_DEADLINES = {}  # access_token: [seconds it gets, time.monotonic() by when, once its first request goes out]
+SKIPPED_ITEMS = []   # (link_name, why), for the report at the end of the run
+GUARD_LOCK = threading.Lock()
+
+class ItemTimeout(Exception):
+    # A linked account ran out of time (see --itemtimeout)
+    pass
+
+class ItemGuard:
+    # Everything done for one linked account goes inside "with ItemGuard(link_name) as guard:", and nothing at all
+    # if guard.skipped. It puts the linked account on the clock (which starts with its first request to Plaid, so
+    # not while it waits for the secret or its turn), and if it runs out of time or its bank is having trouble,
+    # notes that (for the breaker and the report) and lets the run carry on with the rest.
+    __slots__ = ('link_name', 'access_token', 'ins_id', 'first_download', 'skipped')
+
+    def __init__(self, link_name):
+        self.link_name = link_name
+
+    def __enter__(self):
+        link = get_link(self.link_name)
+        self.access_token = link['access_token']
+        self.ins_id = link['ins_id'] or self.link_name
+        self.first_download = not link['cursor'] # (still the case if an earlier first try was interrupted)
+        self.skipped = False
+
+        seconds = args.itemtimeout
+        breaker = None if args.replay or args.force else get_breaker(self.ins_id)
+        if breaker is not None:
+            if breaker['open_until'] > time.time():
+                until = datetime.datetime.fromtimestamp(breaker['open_until'])
+                print("Skipping " + self.link_name + ", since its bank has failed the last " + str(breaker['failures']) + " times (most recently: " + breaker['last_error'] + "). It'll be tried again after " + until.strftime("%I:%M%p on %a, %B %d") + ", or use --force to try it now.")
+                skip_item(self.link_name, "its bank has been failing lately, skipped until " + until.strftime("%I:%M%p on %a, %B %d"))
+                self.skipped = True
+                return(self)
+            if not self.first_download:
+                seconds = min(seconds, BREAKER_TRIAL_TIMEOUT)
+                print("The last try for " + self.link_name + " failed (" + breaker['last_error'] + "), so it only gets " + str(round(seconds)) + " seconds this time.")
+
+        with GUARD_LOCK:
+            ITEM_DEADLINES[self.access_token] = [seconds, None]
+        return(self)
+
+    def __exit__(self, exc_type, exc, traceback):
+        if self.skipped:
+            return(False)
+        with GUARD_LOCK:
+            ITEM_DEADLINES.pop(self.access_token, None)
+        if exc is None:
+            if not args.replay:
+                clear_breaker(self.ins_id)
+            return(False)
+
+        why = item_trouble(exc)
+        if why is None:
+            return(False) # Not the bank's fault, so not ours to hide
+        print("Giving up on " + self.link_name + " for this run: " + why + ". Whatever it downloaded is saved, and it'll carry on from there next time.")
+        if isinstance(exc, ItemTimeout) and self.first_download:
+            print("That was its first download though, which can take a while, so it won't count against its bank.")
+        elif not args.replay:
+            trip_breaker(self.ins_id, why)
+        skip_item(self.link_name, why)
+        return(True)
+
+def item_trouble(e):
+    # What went wrong, if the exception means a linked account's bank (or the way to it) is in trouble. Otherwise None.
+    import plaid
+    import urllib3
+
+    if isinstance(e, ItemTimeout):
+        return(str(e))
+    if isinstance(e, urllib3.exceptions.HTTPError):
+        return("couldn't get an answer from Plaid (" + type(e).__name__ + ")")
+    if isinstance(e, plaid.ApiException):
+        error = plaid_error(e)
+        (retry, rate_limited) = retry_reason(e, "")
+        if error.get('error_code') in BREAKER_ERROR_CODES or (retry and not rate_limited):
+            return("Plaid said " + str(error.get('error_code') or e.status))
+    return(None)
+
+def request_deadline(params):
+    # The deadline for the linked account a Plaid request is for (by its access_token), if it has one
+    access_token = getattr(params[0], 'access_token', None) if len(params) > 0 else None
+    with GUARD_LOCK:
+        clock = ITEM_DEADLINES.get(access_token)
+        if clock is None:
+            return(None)
+        if clock[1] is None:
+            clock[1] = time.monotonic() + clock[0]
+        return(clock[1])
+
+def time_left(deadline, name, wait=0):
+    # Seconds until deadline (None for no deadline). Raises ItemTimeout if there isn't more than wait left.
+    if deadline is None:
+        return(None)
+    remaining = deadline - time.monotonic()
+    if remaining <= wait:
+        raise ItemTimeout("ran out of time (see --itemtimeout) waiting on a " + name + " request")
+    return(remaining)
+
+def restart_deadline(access_token):
+    # A fresh start on the clock, after something (like a re-login) that was waiting on you rather than the bank
+    with GUARD_LOCK:
+        if access_token in ITEM_DEADLINES:
+            ITEM_DEADLINES[access_token][1] = None
+
+def skip_item(link_name, why):
+    with GUARD_LOCK:
+        SKIPPED_ITEMS.append((link_name, why))
+
+def print_skipped_items():
+    if len(SKIPPED_ITEMS) == 0:
+        return
+    print("-----------------------")
+    print("These linked accounts were left out of this run's export:")
+    order = get_links()
+    for (link_name, why) in sorted(SKIPPED_ITEMS, key=lambda skipped: order.index(skipped[0]) if skipped[0] in order else len(order)):
+        print("  " + link_name.ljust(20) + why)
+    print("-----------------------")
+
+def get_breaker(ins_id):
+    with DB_LOCK:
+        return(get_db().execute("SELECT * FROM breakers WHERE ins_id = ?", (ins_id,)).fetchone())
+
+def trip_breaker(ins_id, why):
+    # One more failure in a row for this bank. Past the threshold, its linked accounts are skipped for a while.
+    with DB_LOCK:
+        db = get_db()
+        with db:
+            row = db.execute("SELECT failures FROM breakers WHERE ins_id = ?", (ins_id,)).fetchone()
+            failures = 1 if row is None else row['failures'] + 1
+            open_until = time.time()
+            if failures >= BREAKER_THRESHOLD:
+                open_until += min(BREAKER_MAX_COOLDOWN, BREAKER_COOLDOWN * 2**(failures - BREAKER_THRESHOLD))
+            db.execute("INSERT OR REPLACE INTO breakers (ins_id, failures, open_until, last_error) VALUES (?, ?, ?, ?)", (ins_id, failures, open_until, why))
+
+def clear_breaker(ins_id):
+    with DB_LOCK:
+        db = get_db()
+        with db:
+            db.execute("DELETE FROM breakers WHERE ins_id = ?", (ins_id,))
+
+
+#################
+#### Metrics ####
+#################
+# --profile prints where a run's time and memory went, phase by phase and linked account by linked account, and
+# --metrics-out saves the same numbers to a file so scheduled runs can be tracked over time: JSON, or Prometheus'
+# text format if the file name ends in .prom (for node_exporter's textfile collector). The phases are:
+#   secret     waiting on you to type the client API secret
+#   metadata   asking Plaid for account and item details
+#   download   transactions_sync requests to Plaid
+#   convert    turning transactions into ofxtools statements
+#   serialize  turning statements into OFX text
+#   export     writing the files
+# With --jobs or --concurrency the phases of different linked accounts overlap, so they add up to more than the
+# run's own time. Memory is the peak of Python's allocations (from tracemalloc, on every thread) while a phase was
+# running. Tracing allocations slows things down some, so nothing is measured unless one of the options is given.
+METRICS = None
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.completed = False  # set by main() when it gets to the end
+        self.phases = {}  # (phase, link_name or None): stats
+        self.active = []  # stats of the phases running right now
+        self.peak_bytes = 0
+        tracemalloc.start()
+
+    def enter(self, name, link_name):
+        with self.lock:
+            stats = self.phases.setdefault((name, link_name), {'calls': 0, 'transactions': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'peak_bytes': 0})
+            self.track_peak()
+            self.active.append(stats)
+        return(stats)
+
+    def exit(self, stats, seconds, transactions):
+        with self.lock:
+            self.track_peak()
+            for index in range(len(self.active)):
+                if self.active[index] is stats:
+                    del self.active[index]
+                    break
+            stats['calls'] += 1
+            stats['transactions'] += transactions
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+    def track_peak(self):
+        # Credits the peak since the last look to every phase running now, then starts a new one. Lock must be held.
+        peak = tracemalloc.get_traced_memory()[1]
+        for stats in self.active:
+            stats['peak_bytes'] = max(stats['peak_bytes'], peak)
+        self.peak_bytes = max(self.peak_bytes, peak)
+        tracemalloc.reset_peak()
+
+class Phase:
+    # Times what's inside "with Phase('download', link_name) as timing:". Set timing.transactions to how many
+    # transactions it handled, if that isn't known up front.
+    __slots__ = ('name', 'link_name', 'transactions', 'start', 'stats')
+
+    def __init__(self, name, link_name=None, transactions=0):
+        self.name = name
+        self.link_name = link_name
+        self.transactions = transactions
+        self.stats = None
+
+    def __enter__(self):
+        if METRICS is not None:
+            self.stats = METRICS.enter(self.name, self.link_name)
+            self.start = time.perf_counter()
+        return(self)
+
+    def __exit__(self, *exc_info):
+        if self.stats is not None:
+            METRICS.exit(self.stats, time.perf_counter() - self.start, self.transactions)
+        return(False)
+
+def start_metrics():
+    # Measure this run, and report on it when it exits (however it exits)
+    global METRICS
+    METRICS = Metrics()
+    atexit.register(finish_metrics)
+
+def finish_metrics():
+    with METRICS.lock:
+        METRICS.track_peak()
+    report = metrics_report()
+    if args.profile:
+        print_metrics(report)
+    if args.metrics_out:
+        try:
+            write_metrics(report, args.metrics_out)
+        except OSError as e:
+            print("Unable to write metrics to " + args.metrics_out + ": " + str(e))
+
+def metrics_report():
+    # Everything measured, as --metrics-out writes it in JSON
+    report = {
+        'started': datetime.datetime.fromtimestamp(METRICS.started, datetime.timezone.utc).isoformat(),
+        'completed': METRICS.completed,
+        'seconds': round(time.perf_counter() - METRICS.start, 6),
+        'peak_bytes': METRICS.peak_bytes,
+        'phases': {},    # each phase, all linked accounts together
+        'accounts': {},  # each linked account's phases
+        'requests': {},  # each Plaid endpoint, as for --apistats
+    }
+    with METRICS.lock:
+        for ((name, link_name), stats) in METRICS.phases.items():
+            stats = dict(stats)
+            total = report['phases'].setdefault(name, {'calls': 0, 'transactions': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'peak_bytes': 0})
+            for key in ('calls', 'transactions', 'seconds'):
+                total[key] += stats[key]
+            for key in ('max_seconds', 'peak_bytes'):
+                total[key] = max(total[key], stats[key])
+            if link_name is not None:
+                report['accounts'].setdefault(link_name, {})[name] = stats
+    client = retrying_client()
+    if client is not None:
+        with client.lock:
+            report['requests'] = {name: dict(stats) for (name, stats) in client.stats.items()}
+    return(report)
+
+def print_metrics(report):
+    print("-----------------------")
+    print("Run profile (" + str(round(report['seconds'], 2)) + " seconds, peak memory " + str(round(report['peak_bytes'] / 2**20, 1)) + " MB):")
+    print("  " + "Phase".ljust(24) + "Calls".rjust(10) + "Trans".rjust(10) + "Seconds".rjust(10) + "Max ms".rjust(10) + "Peak MB".rjust(10))
+    rows = [(name, report['phases'][name]) for name in PHASES if name in report['phases']]
+    for link_name in report['accounts']:
+        rows += [("  " + link_name + " " + name, report['accounts'][link_name][name]) for name in PHASES if name in report['accounts'][link_name]]
+    for (label, stats) in rows:
+        print("  " + label[:23].ljust(24) + str(stats['calls']).rjust(10) + str(stats['transactions']).rjust(10) + str(round(stats['seconds'], 2)).rjust(10)
+              + str(round(1000 * stats['max_seconds'])).rjust(10) + str(round(stats['peak_bytes'] / 2**20, 1)).rjust(10))
+    print("-----------------------")
+
+PHASES = ('secret', 'metadata', 'download', 'convert', 'serialize', 'export')
+
+def write_metrics(report, path):
+    if path.lower().endswith('.prom'):
+        text = prometheus_text(report)
     else:
-        filename = link_name + "_" + f"{datetime.datetime.now():%Y-%m-%d_%H%M%S%f}" + ".qfx"
-    fullpath = os.path.join(conf['PLAID']['ofxloc'], filename)
-    with open(fullpath, 'w', encoding="utf-8") as file_handle:
+        text = json.dumps(report, indent=2) + "\n"
+
+    # Write it alongside and swap it in, so whatever reads it never sees half a file
+    with open(path + ".tmp", 'w', encoding="utf-8") as file_handle:
         file_handle.write(text)
-        print("Successfully exported transactions to: " + fullpath)  
+    os.replace(path + ".tmp", path)
+
+def prometheus_text(report):
+    def label(value):
+        return('"' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"')
+
+    lines = []
+    def metric(name, help_text, samples):
+        lines.append("# HELP plaid2qfx_" + name + " " + help_text)
+        lines.append("# TYPE plaid2qfx_" + name + " gauge")
+        for (labels, value) in samples:
+            labels = ",".join(key + "=" + label(labels[key]) for key in labels)
+            lines.append("plaid2qfx_" + name + ("{" + labels + "}" if labels else "") + " " + repr(value))
+
+    metric('run_start_timestamp_seconds', "When the last run started.", [({}, round(METRICS.started, 3))])
+    metric('run_completed', "Whether the last run got to the end (1) or not (0).", [({}, int(report['completed']))])
+    metric('run_seconds', "How long the last run took.", [({}, report['seconds'])])
+    metric('run_peak_bytes', "Peak Python memory allocated during the last run.", [({}, report['peak_bytes'])])
+
+    # Phases that don't belong to a linked account (the secret prompt) have an empty account label
+    with METRICS.lock:
+        phases = [(name, link_name or "", dict(stats)) for ((name, link_name), stats) in METRICS.phases.items()]
+    for (key, help_text) in (('calls', "Times each phase ran."), ('transactions', "Transactions each phase handled."),
+                             ('seconds', "Time spent in each phase."), ('peak_bytes', "Peak Python memory allocated while each phase ran.")):
+        metric('phase_' + key, help_text, [({'phase': name, 'account': link_name}, stats[key]) for (name, link_name, stats) in phases])
+
+    for (key, help_text) in (('requests', "Requests sent to each Plaid endpoint."), ('retries', "Requests to each Plaid endpoint that were retried."),
+                             ('failures', "Requests to each Plaid endpoint that failed for good."), ('seconds', "Time spent on requests to each Plaid endpoint.")):
+        metric('plaid_' + key, help_text, [({'endpoint': name}, report['requests'][name][key]) for name in sorted(report['requests'])])
+    return("\n".join(lines) + "\n")
 
-    return  
+
+########################
+#### Webhook Daemon ####
+########################
+# --daemon keeps running, with the client (and its connections) ready to go, and waits for Plaid to say a linked
+# account has new transactions (a TRANSACTIONS SYNC_UPDATES_AVAILABLE webhook). Then it downloads and exports just
+# that one, instead of checking every linked account on a schedule. Plaid has to be able to reach the address it
+# listens on (--listen), so put it behind a tunnel or an https reverse proxy. Set webhook_url in the PLAID section of
+# the config file to the public address and it tells Plaid where to send them, with a random token on the end of the
+# path. Anything sent without that token is turned away.
+# Webhooks can come in bursts, so a linked account waits until things have been quiet for a few seconds before it's
+# synced (but not more than WEBHOOK_MAX_WAIT after the first), and one that's already syncing goes again once it's
+# done, never twice at once. A webhook sync doesn't wait for item_get to say the item's been updated, since the
+# webhook can get here first. With -o combined (or both), each sync also gets its own AllAccounts file.
+WEBHOOK_DEBOUNCE = 5   # seconds, can be changed with webhook_debounce in the PLAID section of the config file
+WEBHOOK_MAX_WAIT = 60  # seconds
+
+class WebhookQueue:
+    # Linked accounts waiting to be synced, and when each one is due
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.due = {}  # link_name: (first webhook, due, whether a webhook asked for it), in time.monotonic()
+        self.running = set()
+        self.stopping = False
+
+    def add(self, link_name, delay=None, webhook=True):
+        # webhook is False for a catch-up check, which only syncs the linked account if Plaid has updated it
+        with self.lock:
+            now = time.monotonic()
+            (first, due, asked) = self.due.get(link_name, (now, None, False))
+            delay = webhook_debounce() if delay is None else delay
+            self.due[link_name] = (first, min(now + delay, first + WEBHOOK_MAX_WAIT), asked or webhook)
+            self.lock.notify_all()
+
+    def next(self):
+        # Waits for a linked account that's due and isn't already syncing, and returns (link_name, whether a
+        # webhook asked for it). None once stopped.
+        with self.lock:
+            while not self.stopping:
+                now = time.monotonic()
+                waiting = [link_name for link_name in self.due if not link_name in self.running]
+                ready = [link_name for link_name in waiting if self.due[link_name][1] <= now]
+                if len(ready) > 0:
+                    link_name = min(ready, key=lambda link_name: self.due[link_name][1])
+                    webhook = self.due.pop(link_name)[2]
+                    self.running.add(link_name)
+                    return(link_name, webhook)
+                self.lock.wait(min(self.due[link_name][1] for link_name in waiting) - now if len(waiting) > 0 else None)
+            return(None)
+
+    def done(self, link_name):
+        with self.lock:
+            self.running.discard(link_name)
+            self.lock.notify_all()
+
+    def stop(self):
+        with self.lock:
+            self.stopping = True
+            self.lock.notify_all()
+
+def webhook_debounce():
+    with CONF_LOCK:
+        return(conf['PLAID'].getint('webhook_debounce', fallback=WEBHOOK_DEBOUNCE))
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    # Each request is handled on its own thread (see run_daemon()), and just queues the sync
+    def do_POST(self):
+        if not self.path.rstrip('/').endswith('/' + self.server.token):
+            self.send_error(404)
+            return
+        try:
+            webhook = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        except ValueError:
+            webhook = None
+        if not isinstance(webhook, dict):
+            self.send_error(400)
+            return
+
+        # Let Plaid know we got it right away, it doesn't need to wait for the sync
+        self.send_response(200)
+        self.end_headers()
+
+        if webhook.get('webhook_type') != 'TRANSACTIONS' or webhook.get('webhook_code') != 'SYNC_UPDATES_AVAILABLE':
+            print("Ignoring a " + str(webhook.get('webhook_type')) + " " + str(webhook.get('webhook_code')) + " webhook.")
+            return
+        link = find_link(item_id=webhook.get('item_id'))
+        if link is None:
+            print("Got a webhook for an item I don't know about (" + str(webhook.get('item_id')) + "), ignoring it.")
+            return
+        print("Plaid has new transactions for " + link['link_name'] + ".")
+        self.server.queue.add(link['link_name'])
+
+    def log_message(self, format, *params):
+        pass # Every webhook gets its own message above
+
+def run_daemon():
+    if (args.outformat == "combined" or args.outformat == "both") and get_setting('firstlink') is None:
+        print("The combined format goes under the linked account set as firstlink, and this config doesn't have one yet. Run the script once without --daemon to pick one, or use -o each.")
+        sys.exit()
+    get_client() # Ask for the secret now, not when the first webhook comes in
+
+    token = get_setting('webhook_token')
+    if token is None:
+        token = secrets.token_urlsafe(16)
+        set_setting('webhook_token', token)
+    with CONF_LOCK:
+        webhook_url = conf['PLAID'].get('webhook_url')
+    if webhook_url:
+        update_webhooks(webhook_url.rstrip('/') + '/' + token)
+
+    queue = WebhookQueue()
+    workers = [threading.Thread(target=webhook_worker, args=(queue,)) for i in range(args.jobs)]
+    for worker in workers:
+        worker.start()
+
+    # Catch up on anything that came in while we weren't running (item_unchanged() skips the rest quickly)
+    for link_name in get_links():
+        queue.add(link_name, 0, False)
+
+    server = ThreadingHTTPServer(args.listen, WebhookHandler)
+    server.daemon_threads = True
+    server.token = token
+    server.queue = queue
+    print("Listening for Plaid webhooks at http://" + args.listen[0] + ":" + str(args.listen[1]) + "/" + token + " (Ctrl+C to stop).")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopping once the syncs underway are done.")
+    finally:
+        server.server_close()
+        queue.stop()
+        for worker in workers:
+            worker.join()
+
+def webhook_worker(queue):
+    while True:
+        task = queue.next()
+        if task is None:
+            return
+        (link_name, webhook) = task
+        try:
+            # Plaid said there's something new, so don't let item_unchanged() tell us otherwise
+            partitions = []
+            with ItemGuard(link_name) as guard:
+                if not guard.skipped:
+                    process_item(link_name, partitions, force=webhook)
+            if args.outformat == "each" or args.outformat == "both":
+                export_qfx(link_name, partitions, False)
+            if args.outformat == "combined" or args.outformat == "both":
+                # The single-file format, with just this linked account in it, under the firstlink bank like always
+                export_qfx(get_setting('firstlink'), combine_partitions([partitions]), True)
+        except (Exception, SystemExit) as e:
+            # Keep going for the rest, it'll be tried again next time Plaid sends word
+            print("Syncing " + link_name + " failed, waiting for the next webhook: " + repr(e))
+        finally:
+            queue.done(link_name)
+
+def update_webhooks(url):
+    # Points every linked account's webhooks at url, if they aren't already
+    from plaid.model.item_webhook_update_request import ItemWebhookUpdateRequest
+
+    for link_name in get_links():
+        link = get_link(link_name)
+        if get_item(link['access_token'])['item'].get('webhook') != url:
+            get_client().item_webhook_update(ItemWebhookUpdateRequest(access_token=link['access_token'], webhook=url))
+            print("Told Plaid to send webhooks for " + link_name + " to " + url)
+
+def send_webhook(link_name):
+    # A stand-in for Plaid, for trying out --daemon: sends it the webhook Plaid would when link_name has new transactions
+    link = get_link(link_name)
+    if link is None:
+        print("I could not find the specified account. Exiting.")
+        sys.exit(302)
+    token = get_setting('webhook_token')
+    if token is None:
+        print("There's no webhook address yet. Start the daemon with --daemon first.")
+        sys.exit(1)
+
+    host = "127.0.0.1" if args.listen[0] in ('', '0.0.0.0') else args.listen[0]
+    url = "http://" + host + ":" + str(args.listen[1]) + "/" + token
+    body = json.dumps({
+        'webhook_type': 'TRANSACTIONS',
+        'webhook_code': 'SYNC_UPDATES_AVAILABLE',
+        'item_id': link['item_id'],
+        'initial_update_complete': True,
+        'historical_update_complete': True,
+        'environment': 'production',
+    }).encode()
+    request = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            print("Sent a SYNC_UPDATES_AVAILABLE webhook for " + link_name + ", and the daemon answered " + str(response.status) + ".")
+    except OSError as e:
+        print("Couldn't send the webhook to " + url + ": " + str(e))
+
+
+####################
+#### Batch Runs ####
+####################
+# --batch FILE runs the script for every profile listed in FILE, one directory per line, each with its own
+# plaid2qfx.conf and plaid2qfx.db (a household, say), with no one around to answer prompts. Each profile runs as
+# its own copy of the script, so one that fails or hangs doesn't take the others down with it, up to --batchjobs at
+# a time. Everything else on the command line is passed along to each of them. What each one printed is saved to
+# plaid2qfx.log in its directory, and a summary of them all comes at the end.
+# The secret comes from --secret, or secret_source in each profile's config file if they're different. A profile
+# with neither isn't started at all, and one that runs for more than --batchtimeout seconds is stopped.
+BATCH_LOG = 'plaid2qfx.log'
+BATCH_OPTIONS = ('--batch', '--batchjobs', '--batchtimeout', '--secret')  # for the runner, not passed along
+BATCH_ENV = 'PLAID2QFX_BATCH'  # set for each profile's run, so it fails rather than prompts
+
+class BatchResult:
+    __slots__ = ('profile', 'returncode', 'timed_out', 'seconds', 'transactions', 'files', 'last_line')
+
+    def __init__(self, profile):
+        self.profile = profile
+        self.returncode = None  # None if it never started, or was stopped
+        self.timed_out = False
+        self.seconds = 0.0
+        self.transactions = 0
+        self.files = 0
+        self.last_line = ""
+
+def run_batch(argv):
+    profiles = read_profiles(args.batch)
+    if len(profiles) < 1:
+        print("No profiles found in " + args.batch + ".")
+        sys.exit(1)
+
+    # What to pass along: the same command line, less the options that are just for the runner
+    child_argv = []
+    skip = False
+    for arg in (sys.argv[1:] if argv is None else argv):
+        if skip:
+            skip = False
+        elif arg in BATCH_OPTIONS:
+            skip = True
+        elif not arg.split('=')[0] in BATCH_OPTIONS:
+            child_argv.append(arg)
+
+    # A file descriptor can only be read once, so read it here and hand the secret on through the environment
+    env = dict(os.environ)
+    env[BATCH_ENV] = '1'
+    if args.secret and args.secret.startswith('fd:'):
+        env['PLAID2QFX_SECRET'] = read_secret(args.secret)
+        child_argv += ['--secret', 'env:PLAID2QFX_SECRET']
+    elif args.secret:
+        child_argv += ['--secret', args.secret]
+
+    print("Running " + str(len(profiles)) + " profiles, up to " + str(args.batchjobs) + " at a time.")
+    with ThreadPoolExecutor(max_workers=args.batchjobs) as pool:
+        results = list(pool.map(lambda profile: run_profile(profile, child_argv, env), profiles))
+    print_batch_summary(results)
+
+    # Let whatever started us know if anything went wrong
+    if any(result.returncode != 0 for result in results):
+        sys.exit(1)
+
+def read_profiles(path):
+    # Profile directories, one per line, relative to the list file. Blank lines and # comments are skipped.
+    profiles = []
+    with open(path, encoding="utf-8") as file_handle:
+        for line in file_handle:
+            line = line.split('#')[0].strip()
+            if line:
+                profiles.append(os.path.join(os.path.dirname(os.path.abspath(path)), os.path.expanduser(line)))
+    return(profiles)
+
+def run_profile(profile, child_argv, env):
+    result = BatchResult(profile)
+    if not os.path.exists(os.path.join(profile, conffile)):
+        result.last_line = "No " + conffile + " in " + profile
+        print("Skipping " + profile + ", there's no " + conffile + " there.")
+        return(result)
+
+    # The secret prompt reads straight from the terminal, so it would wait forever for an answer. Better not to start.
+    if not args.secret and not args.replay:
+        profile_conf = ConfigParser()
+        profile_conf.read(os.path.join(profile, conffile))
+        if not profile_conf.has_option('PLAID', 'secret_source'):
+            result.last_line = "No --secret or secret_source in its " + conffile + ", so it would have to ask for the secret"
+            print("Skipping " + profile + ", there's no --secret or secret_source in its " + conffile + " to read the client API secret from.")
+            return(result)
+
+    print("Starting " + profile)
+    start = time.monotonic()
+    # No stdin, so anything that would have waited on an answer fails instead
+    try:
+        process = subprocess.run([sys.executable, os.path.abspath(__file__)] + child_argv, cwd=profile, env=env, timeout=args.batchtimeout,
+                                 stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        result.returncode = process.returncode
+        output = process.stdout
+    except subprocess.TimeoutExpired as e:
+        # What it printed before it was stopped can come back as bytes, or not at all
+        result.timed_out = True
+        output = e.stdout or ""
+        if isinstance(output, bytes):
+            output = output.decode(errors='replace')
+        output += "\nStopped after " + str(round(args.batchtimeout)) + " seconds (see --batchtimeout).\n"
+    result.seconds = time.monotonic() - start
+
+    for line in output.splitlines():
+        if line.startswith("Processed ") and line.split()[1].isdigit():
+            result.transactions += int(line.split()[1])
+        elif line.startswith("Successfully exported transactions to: "):
+            result.files += 1
+        if line.strip():
+            result.last_line = line.strip()
+
+    try:
+        with open(os.path.join(profile, BATCH_LOG), 'a', encoding="utf-8") as file_handle:
+            file_handle.write("==== " + f"{datetime.datetime.now():%Y-%m-%d %H:%M:%S}" + " ====\n")
+            file_handle.write(output)
+    except OSError as e:
+        print("Unable to write " + BATCH_LOG + " for " + profile + ": " + str(e))
+    print(("Finished " if result.returncode == 0 else "TIMED OUT " if result.timed_out else "FAILED ") + profile + " in " + str(round(result.seconds, 1)) + " seconds.")
+    return(result)
+
+def print_batch_summary(results):
+    print("-----------------------")
+    print("Batch summary:")
+    print("  " + "Profile".ljust(40) + "Status".ljust(12) + "Seconds".rjust(10) + "Trans".rjust(10) + "Files".rjust(8))
+    for result in results:
+        if result.timed_out:
+            status = "timed out"
+        elif result.returncode is None:
+            status = "skipped"
+        elif result.returncode == 0:
+            status = "ok"
+        else:
+            status = "failed (" + str(result.returncode) + ")"
+        print("  " + result.profile[-39:].ljust(40) + status.ljust(12) + str(round(result.seconds, 1)).rjust(10) + str(result.transactions).rjust(10) + str(result.files).rjust(8))
+        if result.returncode != 0 and result.last_line:
+            print("      " + result.last_line[:100])
+    failed = len([result for result in results if result.returncode != 0])
+    print(str(len(results) - failed) + " of " + str(len(results)) + " profiles finished." + (" See " + BATCH_LOG + " in each profile for what went wrong." if failed > 0 else ""))
+    print("-----------------------")
+
+def read_secret(source):
+    # The client API secret from somewhere other than a prompt: env:NAME (an environment variable), fd:N (the first
+    # line read from an open file descriptor) or keyring:[SERVICE[:USERNAME]] (your system's keyring, which defaults
+    # to the service plaid2qfx and your client_id).
+    (kind, colon, name) = source.partition(':')
+    if kind == 'env':
+        secret = os.environ.get(name)
+    elif kind == 'fd':
+        with os.fdopen(int(name), 'r') as file_handle:
+            secret = file_handle.readline().rstrip('\r\n')
+    else:
+        try:
+            import keyring
+        except ImportError:
+            print("Reading the secret from a keyring needs the keyring package. Install it with pip install keyring.")
+            sys.exit(1)
+        (service, colon, username) = name.partition(':')
+        with CONF_LOCK:
+            secret = keyring.get_password(service or 'plaid2qfx', username or conf['PLAID']['client_id'])
+    if not secret:
+        print("No client API secret was found in " + source + ".")
+        sys.exit(1)
+    return(secret)
 
 
 ###################################
@@ -727,64 +3206,70 @@ def export_qfx(link_name, creditcardmsgsrs_list, stmttrnrs_list, isjoint):
 def showaccounts(detail):
     # Expects a boolean true/false for detail
 
-    for section in conf.sections():
-        if (section == 'PLAID'):
-            continue
+    for link_name in get_links():
         if detail:
             print("\n")
-        print("Linked Account --- " + section)
+        print("Linked Account --- " + link_name)
         if detail:
-            for key in conf[section]:
-                if key=="access_token" or key=="accounts":
+            link = get_link(link_name)
+            for key in link.keys():
+                if key=="link_name" or key=="access_token" or link[key] is None:
                     continue
                 print("    Key: " + key.ljust(15), end='  ')
-                print("Value: " + conf[section][key][0:22])
+                print("Value: " + link[key][0:22])
     return
 
 ########################
 #### Error Handling ####
 ########################
 def resolve_error(e, list_opts):
-    response = json.loads(e.body)
-    if response['error_code'] == 'ITEM_LOGIN_REQUIRED':
+    from plaid.model.link_token_create_request import LinkTokenCreateRequest
+    from plaid.model.link_token_create_request_user import LinkTokenCreateRequestUser
+    from plaid.model.country_code import CountryCode
+
+    error_code = plaid_error(e).get('error_code')
+    if error_code == 'ITEM_LOGIN_REQUIRED':
         # Parse what I expect to become a dynamic list of options as error handling expands
         access_token = list_opts[0]
 
         # Look up the link_name from access_token.
-        for section in conf:
-            if conf.has_option(section, 'access_token'):
-                if conf[section]['access_token'] == access_token:
-                    link_name = section
-        if not link_name:
+        link = find_link(access_token=access_token)
+        if link is None:
             print("While trying to resolve a ITEM_LOGIN_REQUIRED error, I failed to identify the link_name associated with the access_token that needs to be updated. Please contact the script author for debugging.")
+            link_name = "this linked account"
+        else:
+            link_name = link['link_name']
         
-        # Create a link_token for the given user
-        request = LinkTokenCreateRequest(
-                client_name=client_name,
-                country_codes=[CountryCode('US')],
-                language='en',
-                access_token = access_token, 
-                user=LinkTokenCreateRequestUser(
-                    client_user_id=conf['PLAID']['client_user_id']
+        # Only one re-authentication at a time. With --jobs, other items may hit this too, and they share the auth page.
+        with PROMPT_LOCK:
+            # Create a link_token for the given user
+            request = LinkTokenCreateRequest(
+                    client_name=client_name,
+                    country_codes=[CountryCode('US')],
+                    language='en',
+                    access_token = access_token, 
+                    user=LinkTokenCreateRequestUser(
+                        client_user_id=conf['PLAID']['client_user_id']
+                    )
                 )
-            )
-        response = get_client().link_token_create(request)
+            response = get_client().link_token_create(request)
         
-        # Create the html auth page
-        page_path = generate_auth_page(response['link_token'])
+            # Create the html auth page
+            page_path = generate_auth_page(response['link_token'])
         
-        # Get the resulting public ID from the user
-        print("Looks like your login has expired for " + link_name + ".")
-        print("Please open ", end='')
-        print("\033[01m \033[04m {}\033[00m" .format(page_path), end='')
-        print(" in your web browser to re-authenticate.")
-        _ = input("Press enter when you are finished and I will try again.")
-
-        # Clean up
-        os.remove(page_path)
+            # Get the resulting public ID from the user
+            print("Looks like your login has expired for " + link_name + ".")
+            print("Please open ", end='')
+            print("\033[01m \033[04m {}\033[00m" .format(page_path), end='')
+            print(" in your web browser to re-authenticate.")
+            _ = input("Press enter when you are finished and I will try again.")
+            restart_deadline(access_token)
+
+            # Clean up
+            os.remove(page_path)
         return
     else:
-        print("An error was passed to the `resolve_error` function that I don't know how to handle: " + response['error_code'] + ". Quitting.")
+        print("An error was passed to the `resolve_error` function that I don't know how to handle: " + str(error_code or e.status) + ". Quitting.")
         print(e)
         sys.exit()
 
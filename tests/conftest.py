@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import plaid2qfx
+
+
+@pytest.fixture
+def p2q(tmp_path, monkeypatch):
+    # plaid2qfx with default arguments and its own empty plaid2qfx.db
+    monkeypatch.setattr(plaid2qfx, 'args', plaid2qfx.parse_args([]))
+    monkeypatch.setattr(plaid2qfx, 'dbfile', str(tmp_path / 'plaid2qfx.db'))
+    monkeypatch.setattr(plaid2qfx, 'GLOBAL_DB', None)
+    monkeypatch.setattr(plaid2qfx, 'SKIPPED_ITEMS', [])
+    yield plaid2qfx
+    if plaid2qfx.GLOBAL_DB is not None:
+        plaid2qfx.GLOBAL_DB.close()
@@ -0,0 +1,22 @@
+def test_webhook_outlasts_catch_up(p2q):
+    # A catch-up check that a webhook joins still syncs like a webhook, whichever came first
+    queue = p2q.WebhookQueue()
+    queue.add('L1', 0, False)
+    queue.add('L1', 0)
+    queue.add('L2', 0)
+    queue.add('L2', 0, False)
+    queue.add('L3', 0, False)
+    got = dict(queue.next() for n in range(3))
+    assert got == {'L1': True, 'L2': True, 'L3': False}
+
+
+def test_webhook_skips_item_check(p2q, monkeypatch):
+    # item_get isn't asked whether there's anything new, the webhook already said so
+    checked = []
+    monkeypatch.setattr(p2q, 'get_link', lambda link_name: {'link_name': link_name, 'access_token': 'access-1'})
+    monkeypatch.setattr(p2q, 'get_item', lambda access_token: checked.append(access_token))
+    monkeypatch.setattr(p2q, 'get_accounts', lambda access_token, print_it: ([], 'ins_1'))
+    monkeypatch.setattr(p2q, 'transaction_pages', lambda link_name: [])
+    monkeypatch.setattr(p2q, 'fill_statements', lambda link_name, statements, pages: (None, {}, 0))
+    p2q.process_item('L1', [], force=True)
+    assert checked == []
@@ -0,0 +1,43 @@
+import json
+
+import plaid
+import pytest
+
+
+def api_exception(status, body):
+    e = plaid.ApiException(status=status, reason='x')
+    e.body = body
+    return(e)
+
+
+class Failing:
+    def __init__(self, e):
+        self.e = e
+
+    def transactions_sync(self, request):
+        raise self.e
+
+
+@pytest.mark.parametrize('e', [api_exception(502, '<html>Bad Gateway</html>'), api_exception(0, None), api_exception(503, '[]')],
+                         ids=['proxy page', 'no body', 'not an object'])
+def test_unreadable_error_is_bank_trouble(p2q, monkeypatch, e):
+    # Not something sync_fetch() can make sense of, so it's passed on as it was, and ItemGuard skips the bank
+    monkeypatch.setattr(p2q, 'GLOBAL_CLIENT', Failing(e))
+    with pytest.raises(plaid.ApiException) as raised:
+        p2q.sync_fetch({'link_name': 'L1', 'access_token': 'access-1'}, '')
+    assert raised.value is e
+    assert p2q.item_trouble(e) is not None
+
+
+def test_mutation_during_pagination_restarts(p2q, monkeypatch):
+    e = api_exception(400, json.dumps({'error_code': 'TRANSACTIONS_SYNC_MUTATION_DURING_PAGINATION'}))
+    monkeypatch.setattr(p2q, 'GLOBAL_CLIENT', Failing(e))
+    with pytest.raises(p2q.SyncRestart):
+        p2q.sync_fetch({'link_name': 'L1', 'access_token': 'access-1'}, '')
+
+
+def test_plaid_error(p2q):
+    assert p2q.plaid_error(api_exception(400, json.dumps({'error_code': 'ITEM_LOGIN_REQUIRED'}))) == {'error_code': 'ITEM_LOGIN_REQUIRED'}
+    assert p2q.plaid_error(api_exception(502, '<html></html>')) == {}
+    assert p2q.plaid_error(api_exception(0, None)) == {}
+    assert p2q.plaid_error(api_exception(500, '"oops"')) == {}
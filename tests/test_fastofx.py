@@ -0,0 +1,76 @@
+import datetime
+import decimal
+import random
+
+import pytest
+from ofxtools.models.bank.stmt import TRNTYPES
+
+import benchmark
+
+
+def both(p2q, transactions, creditcard=False):
+    # What ofxtools writes, and what --fastofx writes, for the same statement
+    p2q.args.fastofx = False
+    expected = benchmark.write_statement(p2q, transactions, creditcard)
+    p2q.args.fastofx = True
+    got = benchmark.write_statement(p2q, transactions, creditcard)
+    return(expected, got)
+
+
+def transaction(**fields):
+    values = {'trntype': 'DEBIT', 'dtposted': datetime.datetime(2024, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc),
+              'trnamt': decimal.Decimal("-12.34"), 'fitid': 'fitid1', 'checknum': None, 'name': 'Shop', 'memo': None}
+    values.update(fields)
+    return(values)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_made_up_statements(p2q, seed):
+    # The same awkward statements benchmark.py ofxwriter checks, a few hundred of them
+    rnd = random.Random(seed)
+    zones = benchmark.awkward_zones()
+    for n in range(60):
+        transactions = [benchmark.awkward_transaction(rnd, zones, TRNTYPES) for i in range(rnd.randrange(0, 25))]
+        (expected, got) = both(p2q, transactions, rnd.random() < 0.3)
+        assert got == expected
+
+
+@pytest.mark.parametrize('text', [text for text in benchmark.AWKWARD_STRINGS if text is not None])
+@pytest.mark.parametrize('field', ['fitid', 'checknum', 'name', 'memo'])
+def test_awkward_text(p2q, field, text):
+    # Escaped, unescaped and left out ("") the same way
+    if field == 'checknum':
+        text = text[:12]
+    (expected, got) = both(p2q, [transaction(**{field: text})])
+    assert got == expected
+
+
+@pytest.mark.parametrize('amount', benchmark.AWKWARD_AMOUNTS)
+def test_amounts(p2q, amount):
+    (expected, got) = both(p2q, [transaction(trnamt=decimal.Decimal(amount))])
+    assert got == expected
+
+
+@pytest.mark.parametrize('microsecond', [0, 499, 500, 999499, 999500, 999999])
+def test_times(p2q, microsecond):
+    # Rounding to milliseconds, and every kind of time zone, including a named one
+    for zone in benchmark.awkward_zones():
+        dtposted = datetime.datetime(2024, 12, 31, 23, 59, 59, microsecond, tzinfo=zone)
+        (expected, got) = both(p2q, [transaction(dtposted=dtposted)])
+        assert got == expected
+
+
+@pytest.mark.parametrize('fields', [{'name': 'x' * 33}, {'memo': 'x' * 256}, {'checknum': 'x' * 13}, {'fitid': 'x' * 256},
+                                    {'trntype': 'BOGUS'}, {'fitid': ''}, {'dtposted': datetime.datetime(2024, 1, 2)}],
+                         ids=['long name', 'long memo', 'long checknum', 'long fitid', 'bad type', 'no fitid', 'no zone'])
+def test_left_to_ofxtools(p2q, fields):
+    # Whatever ofxtools warns about or rejects, --fastofx hands to it, so it comes out the same
+    (expected, got) = both(p2q, [transaction(), transaction(**dict({'fitid': 'fitid2'}, **fields))])
+    assert got == expected
+
+
+@pytest.mark.parametrize('creditcard', [False, True], ids=['bank', 'credit card'])
+def test_no_transactions(p2q, creditcard):
+    (expected, got) = both(p2q, [], creditcard)
+    assert got == expected
+    assert got[0].startswith("<")
@@ -0,0 +1,86 @@
+import datetime
+
+import pytest
+
+
+def record(p2q, transaction_id, amount=1234, day=1):
+    dtposted = datetime.datetime(2024, 1, day, 12, tzinfo=datetime.timezone.utc)
+    return(p2q.TransactionRecord(transaction_id, 'acct', dtposted, amount, None, 'Shop', 'Purchase', 'DEBIT', 'USD'))
+
+
+def fill(p2q, pages):
+    statements = {'acct': p2q.AccountStatement('CHECKING', None)}
+    (dtstart, ledger_rows, count) = p2q.fill_statements('L1', statements, pages)
+    return([stmttrn.fitid for stmttrn in statements['acct'].stmttrns], {row[0]: row for row in ledger_rows}, count)
+
+
+@pytest.fixture(params=['ofxtools', 'fastofx', 'convertjobs'])
+def converter(request, p2q):
+    # fill_statements() makes STMTTRNs, FastTransactions or PendingTransactions, and each should be handled the same
+    if request.param == 'fastofx':
+        p2q.args.fastofx = True
+    elif request.param == 'convertjobs':
+        p2q.args.convertjobs = 2
+    return(p2q)
+
+
+def test_added_once_per_run(converter):
+    p2q = converter
+    pages = [([record(p2q, 'a'), record(p2q, 'b')], [], []),
+             ([record(p2q, 'b'), record(p2q, 'c')], [], [])]
+    (fitids, rows, count) = fill(p2q, pages)
+    assert fitids == ['a', 'b', 'c']
+    assert sorted(rows) == ['a', 'b', 'c']
+    assert count == 3
+
+
+def test_removed_later_in_the_run_is_left_out(converter):
+    p2q = converter
+    pages = [([record(p2q, 'pending'), record(p2q, 'b')], [], []),
+             ([record(p2q, 'posted')], [], ['pending'])]
+    (fitids, rows, count) = fill(p2q, pages)
+    assert fitids == ['b', 'posted']
+    assert sorted(rows) == ['b', 'posted']
+    assert count == 2
+
+
+def test_modified_takes_the_place_of_added(converter):
+    p2q = converter
+    pages = [([record(p2q, 'a', 100), record(p2q, 'b')], [], []),
+             ([], [record(p2q, 'a', 200)], []),
+             ([], [record(p2q, 'a', 300)], [])]
+    (fitids, rows, count) = fill(p2q, pages)
+    assert fitids == ['b', 'a']
+    assert rows['a'][4] == '-3.0'
+    assert count == 2
+
+
+def test_modified_then_removed_is_left_out(converter):
+    p2q = converter
+    pages = [([record(p2q, 'a'), record(p2q, 'b')], [], []),
+             ([], [record(p2q, 'a', 200), record(p2q, 'c', 300)], []),
+             ([], [], ['a', 'c'])]
+    (fitids, rows, count) = fill(p2q, pages)
+    assert fitids == ['b']
+    assert sorted(rows) == ['b']
+    assert count == 1
+
+
+def test_ledger_skips_earlier_runs_and_reports_removals(p2q, capsys):
+    (fitids, rows, count) = fill(p2q, [([record(p2q, 'a'), record(p2q, 'b')], [], [])])
+    p2q.ledger_record(list(rows.values()))
+    assert p2q.ledger_lookup(['a', 'b', 'c']) == {'a', 'b'}
+
+    # A cursor reset hands over what was already exported, and the bank takes one back
+    (fitids, rows, count) = fill(p2q, [([record(p2q, 'a'), record(p2q, 'c')], [], ['b'])])
+    assert fitids == ['c']
+    assert "already exported in an earlier run" in capsys.readouterr().out
+    assert p2q.ledger_lookup(['a', 'b', 'c']) == {'a'}
+    assert p2q.ledger_remove(['b']) == []
+
+
+def test_replay_ignores_the_ledger(p2q):
+    p2q.ledger_record([('a', 'L1', 'acct', '2024-01-01T12:00:00+00:00', '-12.34', 'Shop')])
+    p2q.args.replay = 'recording'
+    (fitids, rows, count) = fill(p2q, [([record(p2q, 'a')], [], [])])
+    assert fitids == ['a']
@@ -0,0 +1,117 @@
+import datetime
+from decimal import Decimal
+
+import plaid
+import pytest
+
+import benchmark
+
+
+class Interrupted(benchmark.SyntheticPlaid):
+    # Goes down for good after `pages` pages
+    def __init__(self, transactions, accounts, ins_id, pages):
+        super().__init__(transactions, accounts, ins_id)
+        self.pages = pages
+        self.cursors = []
+
+    def transactions_sync(self, request):
+        self.cursors.append(request['cursor'])
+        if len(self.cursors) > self.pages:
+            raise plaid.ApiException(status=503, reason='Service Unavailable')
+        return(super().transactions_sync(request))
+
+
+@pytest.fixture
+def synthetic(p2q, monkeypatch):
+    # One linked account, BENCH, with benchmark.py's made-up accounts and transactions
+    p2q.add_link('BENCH', access_token='access-bench', item_id='item-bench', ins_id='ins_bench', routing_number='123456789', bid='1234')
+    accounts = benchmark.synthetic_accounts(0)
+    transactions = benchmark.synthetic_transactions(500, accounts, 0)
+    monkeypatch.setattr(p2q, 'GLOBAL_CLIENT', benchmark.SyntheticPlaid(transactions, accounts, 'ins_bench'))
+    return(p2q, accounts, transactions)
+
+
+def run(p2q, argv):
+    p2q.args = p2q.parse_args(argv)
+    partitions = []
+    p2q.process_item('BENCH', partitions)
+    return(partitions)
+
+
+@pytest.mark.parametrize('partition', ['month', '37'])
+def test_partition_balances_add_up(synthetic, partition):
+    # Going back from the newest file, each one's balance is the newer one's less the transactions in it
+    (p2q, accounts, transactions) = synthetic
+    partitions = run(p2q, ['-f', 'qfx,csv', '--partition', partition, '-p', '100'])
+    assert sum(partition.count for partition in partitions) == len(transactions)
+    assert len(partitions) > 3
+    if partition != 'month':
+        assert all(partition.count <= 37 for partition in partitions)
+
+    for account in accounts:
+        balance = Decimal(str(account['balances']['current']))
+        if account['type'] == 'credit':
+            balance = -balance
+        for partition in reversed(partitions):
+            for statement in partition.statements:
+                if statement.account_id == account['account_id']:
+                    assert statement.ledgerbal.balamt == balance
+                    balance -= sum(row[2] for row in statement.transactions)
+
+
+def test_interrupted_download_resumes(synthetic, monkeypatch):
+    # The pages that made it are kept, and the next run asks for the rest, not the whole thing again
+    (p2q, accounts, transactions) = synthetic
+    client = Interrupted(transactions, accounts, 'ins_bench', 3)
+    monkeypatch.setattr(p2q, 'GLOBAL_CLIENT', client)
+    with pytest.raises(plaid.ApiException):
+        run(p2q, ['-p', '100'])
+    assert p2q.checkpoint_pending('BENCH')
+    assert len(p2q.checkpoint_load('BENCH')) == 3
+    assert not p2q.get_link('BENCH')['cursor']
+
+    client.pages = 100
+    client.cursors = []
+    partitions = run(p2q, ['-p', '100'])
+    assert client.cursors[0] == '300'
+    assert sum(partition.count for partition in partitions) == len(transactions)
+    assert not p2q.checkpoint_pending('BENCH')
+    assert p2q.get_link('BENCH')['cursor'] == '500'
+
+
+def guarded(p2q, e=None):
+    # Runs one linked account's turn under ItemGuard, failing with e. Returns whether it was skipped.
+    with p2q.ItemGuard('BENCH') as guard:
+        if not guard.skipped and e is not None:
+            raise e
+    return(guard.skipped)
+
+
+def test_breaker_opens_and_closes(synthetic):
+    (p2q, accounts, transactions) = synthetic
+    p2q.update_link('BENCH', cursor='500')  # not a first download
+    trouble = plaid.ApiException(status=503, reason='Service Unavailable')
+    assert not guarded(p2q, trouble)
+    assert p2q.get_breaker('ins_bench')['failures'] == 1
+    assert not guarded(p2q, trouble)
+    assert p2q.get_breaker('ins_bench')['open_until'] > datetime.datetime.now().timestamp()
+
+    # Open: skipped, unless forced, and working again closes it
+    assert guarded(p2q)
+    p2q.args.force = True
+    assert not guarded(p2q)
+    assert p2q.get_breaker('ins_bench') is None
+
+
+def test_first_download_timeout_not_held_against_bank(synthetic):
+    (p2q, accounts, transactions) = synthetic
+    assert not guarded(p2q, p2q.ItemTimeout("ran out of time"))
+    assert p2q.get_breaker('ins_bench') is None
+
+
+def test_not_the_banks_fault(synthetic):
+    # Anything else is passed on, and the bank isn't blamed
+    (p2q, accounts, transactions) = synthetic
+    with pytest.raises(KeyError):
+        guarded(p2q, KeyError('oops'))
+    assert p2q.get_breaker('ins_bench') is None
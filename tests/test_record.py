@@ -0,0 +1,51 @@
+import json
+import os
+
+
+class Plaid:
+    # Stands in for the Plaid client, answering every request with a plain dict
+    def accounts_get(self, request):
+        return({'accounts': []})
+
+    def item_get(self, request):
+        return({'item': {}})
+
+    def transactions_sync(self, request):
+        return({'next_cursor': request['cursor'] + 'x'})
+
+
+def recorded(directory, link_name):
+    path = os.path.join(directory, link_name)
+    return(sorted(os.listdir(path)) if os.path.isdir(path) else None)
+
+
+def test_account_being_linked_is_not_recorded(p2q, tmp_path):
+    client = p2q.RecordingClient(Plaid(), str(tmp_path / 'rec'))
+    assert client.accounts_get({'access_token': 'access-new'}) == {'accounts': []}
+    client.finish('access-new')
+    assert not os.path.exists(tmp_path / 'rec')
+
+
+def test_recording_is_one_whole_run(p2q, tmp_path):
+    directory = str(tmp_path / 'rec')
+    p2q.add_link('L1', access_token='access-1')
+    client = p2q.RecordingClient(Plaid(), directory)
+    client.item_get({'access_token': 'access-1'})
+    client.accounts_get({'access_token': 'access-1'})
+    client.transactions_sync({'access_token': 'access-1', 'cursor': ''})
+    client.transactions_sync({'access_token': 'access-1', 'cursor': 'x'})
+    assert recorded(directory, 'L1') is None  # Not until it's finished
+
+    # Plaid made the download start over, so only the pages after that count
+    client.restart('access-1')
+    client.transactions_sync({'access_token': 'access-1', 'cursor': 'a'})
+    client.finish('access-1')
+    assert recorded(directory, 'L1') == ['accounts_get.json', 'item_get.json', 'transactions_sync_0000.json']
+    with open(os.path.join(directory, 'L1', 'transactions_sync_0000.json')) as file_handle:
+        assert json.load(file_handle) == {'next_cursor': 'ax'}
+
+    # Nothing new next time, so the recording stays as it was
+    client.item_get({'access_token': 'access-1'})
+    client.finish('access-1')
+    assert recorded(directory, 'L1') == ['accounts_get.json', 'item_get.json', 'transactions_sync_0000.json']
+    assert not os.path.exists(os.path.join(directory, 'L1.partial'))